@@ -23,6 +23,21 @@ def split_obs(obs, split_shape):
         start_idx += split_shape[i][0]*split_shape[i][1]
     return split_obs
     
+# [threads, agents, ...] --> [threads*agents, ...]
+def _flatten_agents(x):
+    if isinstance(x, np.ndarray) and not x.flags.writeable:
+        # a broadcast view (de-duplicated share_obs): numpy's reshape makes the one copy torch needs
+        return torch.from_numpy(x.reshape(-1, *x.shape[2:]))
+    x = torch.as_tensor(x)
+    return x.reshape(-1, *x.shape[2:])
+
+# [threads*agents, ...] --> [threads, agents, ...], numpy unless the inputs were tensors
+def _unflatten_agents(n_rollout_threads, num_agents, x, to_numpy=True):
+    x = x.detach().reshape(n_rollout_threads, num_agents, *x.shape[1:])
+    if to_numpy:
+        return x.cpu().numpy()
+    return x
+
 class Flatten(nn.Module):
     def forward(self, x):
         return x.view(x.size(0), -1)
@@ -185,6 +200,52 @@ class Policy(nn.Module):
         
         return value, rnn_hxs_actor, rnn_hxs_critic
 
+    def act_all(self, agent_ids, share_inputs, inputs, rnn_hxs_actor, rnn_hxs_critic, masks, available_actions=None, deterministic=False):
+        """
+        act() for every agent of every rollout thread in a single forward pass.
+        Inputs are [threads, agents, ...] slices of RolloutStorage, agent_ids is a
+        [agents] (or [threads, agents]) tensor. Outputs are [threads, agents, ...]
+        arrays that can go straight into RolloutStorage.insert, numpy arrays for
+        numpy inputs and tensors on the policy device for tensor inputs.
+        """
+        n_rollout_threads, num_agents = inputs.shape[0:2]
+        to_numpy = not torch.is_tensor(inputs)
+        agent_ids = torch.as_tensor(agent_ids).to(self.device).expand(n_rollout_threads, num_agents).reshape(-1)
+        if available_actions is not None:
+            available_actions = _flatten_agents(available_actions)
+
+        value, action, action_log_prob, rnn_hxs_actor, rnn_hxs_critic = self.act(agent_ids,
+            _flatten_agents(share_inputs),
+            _flatten_agents(inputs),
+            _flatten_agents(rnn_hxs_actor),
+            _flatten_agents(rnn_hxs_critic),
+            _flatten_agents(masks),
+            available_actions,
+            deterministic)
+
+        return _unflatten_agents(n_rollout_threads, num_agents, value, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, action, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, action_log_prob, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, rnn_hxs_actor, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, rnn_hxs_critic, to_numpy)
+
+    def get_value_all(self, agent_ids, share_inputs, inputs, rnn_hxs_actor, rnn_hxs_critic, masks):
+        """get_value() counterpart of act_all, returns [threads, agents, ...] arrays."""
+        n_rollout_threads, num_agents = inputs.shape[0:2]
+        to_numpy = not torch.is_tensor(inputs)
+        agent_ids = torch.as_tensor(agent_ids).to(self.device).expand(n_rollout_threads, num_agents).reshape(-1)
+
+        value, rnn_hxs_actor, rnn_hxs_critic = self.get_value(agent_ids,
+            _flatten_agents(share_inputs),
+            _flatten_agents(inputs),
+            _flatten_agents(rnn_hxs_actor),
+            _flatten_agents(rnn_hxs_critic),
+            _flatten_agents(masks))
+
+        return _unflatten_agents(n_rollout_threads, num_agents, value, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, rnn_hxs_actor, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, rnn_hxs_critic, to_numpy)
+
     def evaluate_actions(self, agent_id, share_inputs, inputs, rnn_hxs_actor, rnn_hxs_critic, action, masks, high_masks=None):
     
         share_inputs = share_inputs.to(self.device)
@@ -854,7 +915,11 @@ class Embedding(nn.Module):
         N = len(x)
         
         x1 = []   
-        self_x = x[self_idx]     
+        if torch.is_tensor(self_idx) and self_idx.dim() > 0:
+            # one agent id per row, as passed by Policy.act_all
+            self_x = torch.stack(x, 1)[torch.arange(x[0].size(0)), self_idx]
+        else:
+            self_x = x[self_idx]     
         for i in range(N):
             K = self.split_shape[i][0]
             L = self.split_shape[i][1]
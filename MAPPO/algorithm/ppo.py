@@ -4,7 +4,10 @@ import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 import time
-import math
+from utils.returns import compute_advantages
+from utils.chunks import PinnedStaging
+from .stacked_policy import StackedPolicies
+from utils.metrics import MetricsAccumulator, metric_records
 
 def huber_loss(e, d):
     a = (abs(e)<=d).float()
@@ -12,11 +15,11 @@ def huber_loss(e, d):
     return a*e**2/2 + b*d*(abs(e)-d/2)
     
 def get_gard_norm(it):
-    sum_grad = 0
-    for x in it:
-        if x.grad is None:continue
-        sum_grad += x.grad.norm() ** 2    
-    return math.sqrt(sum_grad)
+    # a tensor on the gradients' device, reading it is left to the caller
+    norms = [x.grad.norm() for x in it if x.grad is not None]
+    if len(norms) == 0:
+        return torch.tensor(0.0)
+    return torch.norm(torch.stack(norms))
 
 class PopArt(nn.Module):
     """ Normalize a vector of observations - across the first norm_axes dimensions"""
@@ -47,38 +50,54 @@ class PopArt(nn.Module):
         debiased_var = (debiased_mean_sq - debiased_mean ** 2).clamp(min=1e-2)
         return debiased_mean, debiased_var
 
+    def update(self, input_vector):
+        """ Move the running statistics towards the batch input_vector """
+        # Detach input before adding it to running means to avoid backpropping through it on
+        # subsequent batches.
+        detached_input = input_vector.detach()
+        batch_mean = detached_input.mean(dim=tuple(range(self.norm_axes)))
+        batch_sq_mean = (detached_input ** 2).mean(dim=tuple(range(self.norm_axes)))
+
+        if self.per_element_update:
+            batch_size = np.prod(detached_input.size()[:self.norm_axes])
+            weight = self.beta ** batch_size
+        else:
+            weight = self.beta
+
+        self.running_mean.mul_(weight).add_(batch_mean * (1.0 - weight))
+        self.running_mean_sq.mul_(weight).add_(batch_sq_mean * (1.0 - weight))
+        self.debiasing_term.mul_(weight).add_(1.0 * (1.0 - weight))
+
     def forward(self, input_vector):
         # Make sure input is float32
         input_vector = input_vector.to(torch.float).to(self.device)
 
         if self.train:
-            # Detach input before adding it to running means to avoid backpropping through it on
-            # subsequent batches.
-            detached_input = input_vector.detach()            
-            batch_mean = detached_input.mean(dim=tuple(range(self.norm_axes)))
-            batch_sq_mean = (detached_input ** 2).mean(dim=tuple(range(self.norm_axes)))
-
-            if self.per_element_update:
-                batch_size = np.prod(detached_input.size()[:self.norm_axes])
-                weight = self.beta ** batch_size
-            else:
-                weight = self.beta
-
-            self.running_mean.mul_(weight).add_(batch_mean * (1.0 - weight))
-            self.running_mean_sq.mul_(weight).add_(batch_sq_mean * (1.0 - weight))
-            self.debiasing_term.mul_(weight).add_(1.0 * (1.0 - weight))
+            self.update(input_vector)
 
         mean, var = self.running_mean_var()
         out = (input_vector - mean[(None,) * self.norm_axes]) / torch.sqrt(var)[(None,) * self.norm_axes]
         return out
 
-    def denormalize(self, input_vector):
-        """ Transform normalized data back into original distribution """
-        input_vector = input_vector.to(torch.float).to(self.device)
-
+    def denormalize(self, input_vector, out=None):
+        """
+        Transform normalized data back into original distribution.
+        A numpy array or a tensor on any device is transformed where it lives, into out when given.
+        """
         mean, var = self.running_mean_var()
-        out = input_vector * torch.sqrt(var)[(None,) * self.norm_axes] + mean[(None,) * self.norm_axes]
-        return out
+        mean = mean[(None,) * self.norm_axes]
+        std = torch.sqrt(var)[(None,) * self.norm_axes]
+        if not torch.is_tensor(input_vector):
+            mean = mean.cpu().numpy()
+            std = std.cpu().numpy()
+            out = np.multiply(input_vector, std, out=out)
+            out += mean
+            return out
+        if out is None:
+            input_vector = input_vector.to(torch.float)
+            return input_vector * std.to(input_vector.device) + mean.to(input_vector.device)
+        torch.mul(input_vector, std.to(out.device), out=out)
+        return out.add_(mean.to(out.device))
 
 class PPO():
     def __init__(self,                 
@@ -101,6 +120,8 @@ class PPO():
                  huber_delta=2,
                  use_popart = True,
                  use_value_high_masks = False,
+                 use_pin_memory = False,
+                 metrics_interval = 'minibatch',
                  device = torch.device("cpu")):
 
         self.step=0
@@ -126,299 +147,163 @@ class PPO():
         self.optimizer = optim.Adam(actor_critic.parameters(), lr=lr, eps=eps, weight_decay=weight_decay)
         self.use_popart = use_popart
         self.use_value_high_masks = use_value_high_masks
+        self.use_pin_memory = use_pin_memory and self.device.type == 'cuda'
         if self.use_popart:
             self.value_normalizer = PopArt(1, device=self.device)
         else:
             self.value_normalizer = None
-
-    def update_single(self, agent_id, rollouts, turn_on=True):
+        # log every minibatch, or the mean of every 'epoch' / 'update'
+        self.metrics_interval = metrics_interval
+
+    def value_loss(self, values, value_preds_batch, return_batch, high_masks_batch, use_high_masks=True):
+        """
+        (Clipped) squared or huber value loss of a minibatch, averaged over the high masked
+        entries or over all of them. With PopArt the returns are normalized here, once, so the
+        running statistics move exactly once per minibatch.
+        """
         if self.use_popart:
-            advantages = rollouts.returns[:-1,:] - self.value_normalizer.denormalize(torch.tensor(rollouts.value_preds[:-1,:])).cpu().numpy()
+            return_batch = self.value_normalizer(return_batch)
+        if self.use_huber_loss:
+            loss = lambda error: huber_loss(error, self.huber_delta)
+        else:
+            loss = lambda error: 0.5 * error.pow(2)
+        value_losses = loss(return_batch - values)
+        if self.use_clipped_value_loss:
+            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
+            value_losses = torch.max(value_losses, loss(return_batch - value_pred_clipped))
+        if use_high_masks:
+            return (value_losses * high_masks_batch).sum() / high_masks_batch.sum()
+        return value_losses.mean()
+
+    # reduces the stats accumulated since the last call (one device sync), logs them and adds their sums to totals
+    def flush_metrics(self, metrics, totals, prefix=''):
+        num_minibatches = len(metrics)
+        stats = metrics.reduce()
+        if self.logger is not None:
+            for record in metric_records(stats, self.step, self.metrics_interval, prefix):
+                self.logger.add_scalars(*record)
+            self.step += num_minibatches
+        for name, values in stats.items():
+            totals[name] = totals.get(name, 0.0) + float(np.sum(values))
+
+    def epoch_generators(self, agent_id, rollouts, single=False):
+        """
+        One minibatch generator per ppo epoch over agent_id's data, from its own SingleRolloutStorage
+        with single (update_single) or from the RolloutStorage of all agents (update).
+        """
+        if single:
+            advantages = compute_advantages(rollouts.returns, rollouts.value_preds, self.use_popart, self.value_normalizer)
+            args = (advantages,)
         else:
-            advantages = rollouts.returns[:-1,:] - rollouts.value_preds[:-1,:]
-        advantages = (advantages - advantages.mean()) / (
-            advantages.std() + 1e-5)
+            advantages = compute_advantages(rollouts.returns[:,:,agent_id], rollouts.value_preds[:,:,agent_id], self.use_popart, self.value_normalizer)
+            args = (agent_id, advantages)
 
-        value_loss_epoch = 0
-        action_loss_epoch = 0
-        dist_entropy_epoch = 0
+        if self.actor_critic.is_recurrent:
+            chunks = rollouts.recurrent_chunks(*args, self.data_chunk_length)
+            staging = PinnedStaging(chunks, self.num_mini_batch) if self.use_pin_memory else False
 
         for e in range(self.ppo_epoch):
             if self.actor_critic.is_recurrent:
-                data_generator = rollouts.recurrent_generator(
-                     advantages, self.num_mini_batch, self.data_chunk_length)
+                yield rollouts.recurrent_generator(
+                    *args, self.num_mini_batch, self.data_chunk_length, chunks, staging, self.device)
             elif self.actor_critic.is_naive_recurrent:
-                data_generator = rollouts.naive_recurrent_generator(
-                     advantages, self.num_mini_batch)
+                yield rollouts.naive_recurrent_generator(*args, self.num_mini_batch)
             else:
-                data_generator = rollouts.feed_forward_generator(
-                    advantages, self.num_mini_batch)
+                yield rollouts.feed_forward_generator(*args, self.num_mini_batch)
 
-            for sample in data_generator:
-                share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, \
-                   value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, \
-                        adv_targ = sample
-                        
-                old_action_log_probs_batch = old_action_log_probs_batch.to(self.device)
-                adv_targ = adv_targ.to(self.device)
-                value_preds_batch = value_preds_batch.to(self.device)
-                return_batch = return_batch.to(self.device)
-                high_masks_batch = high_masks_batch.to(self.device)
-                
-                # Reshape to do in a single forward pass for all steps
-                values, action_log_probs, dist_entropy, _, _ = self.actor_critic.evaluate_actions(agent_id, share_obs_batch, 
-                obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, masks_batch, high_masks_batch)
+    def minibatch_loss(self, agent_id, sample, turn_on=True):
+        """ The loss to backprop for one update / update_single minibatch, and its stats """
+        share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, \
+           value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, \
+                adv_targ = sample
 
-                ratio = torch.exp(action_log_probs - old_action_log_probs_batch)
-                
-                KL_divloss = nn.KLDivLoss(reduction='batchmean')(old_action_log_probs_batch, torch.exp(action_log_probs))
-                
-                surr1 = ratio * adv_targ
-                surr2 = torch.clamp(ratio, 1.0 - self.clip_param, 1.0 + self.clip_param) * adv_targ                
-                action_loss = (-torch.min(surr1, surr2)* high_masks_batch).sum() / high_masks_batch.sum()
+        # Reshape to do in a single forward pass for all steps
+        values, action_log_probs, dist_entropy, _, _ = self.actor_critic.evaluate_actions(agent_id, share_obs_batch,
+        obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, masks_batch, high_masks_batch)
 
-                if self.use_clipped_value_loss:
-                    if self.use_huber_loss:
-                        if self.use_popart:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            error_clipped = self.value_normalizer(return_batch) - value_pred_clipped
-                            value_losses_clipped = huber_loss(error_clipped, self.huber_delta)
-                            error = self.value_normalizer(return_batch) - values
-                            value_losses = huber_loss(error,self.huber_delta)
-                            value_loss = (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum()
-                        else:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            error_clipped = (return_batch) - value_pred_clipped
-                            value_losses_clipped = huber_loss(error_clipped, self.huber_delta)
-                            error = (return_batch) - values
-                            value_losses = huber_loss(error,self.huber_delta)
-                            value_loss = (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum()
-                    else:
-                        if self.use_popart:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            value_losses = (values - self.value_normalizer(return_batch)).pow(2)
-                            value_losses_clipped = (value_pred_clipped - self.value_normalizer(return_batch)).pow(2)
-                            value_loss = 0.5 * ( (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum() )
-                        else:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            value_losses = (values - (return_batch)).pow(2)
-                            value_losses_clipped = (value_pred_clipped - return_batch).pow(2)
-                            value_loss = 0.5 * ( (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum() )
-                    
-                else:
-                    if self.use_huber_loss:
-                        if self.use_popart:
-                            error = self.value_normalizer(return_batch) - values
-                        else:
-                            error = return_batch - values
-                        value_loss = (huber_loss(error, self.huber_delta) * high_masks_batch).sum() / high_masks_batch.sum()
-                    else:
-                        if self.use_popart:
-                            value_loss = 0.5 * (((self.value_normalizer(return_batch) - values).pow(2) * high_masks_batch).sum() / high_masks_batch.sum())
-                        else:
-                            value_loss = 0.5 * (((return_batch - values).pow(2) * high_masks_batch).sum() / high_masks_batch.sum())
-                
-                self.optimizer.zero_grad()
-                
-                if self.use_common_layer:
-                    (value_loss * self.value_loss_coef + action_loss - dist_entropy * self.entropy_coef).backward()
-                else:              
-                    (value_loss * self.value_loss_coef).backward()
-                    if turn_on == True:
-                        (action_loss - dist_entropy * self.entropy_coef).backward()
-                
-                grad_norm = get_gard_norm(self.actor_critic.parameters())
-                       
-                if self.use_max_grad_norm:
-                    nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
-                    
-                self.optimizer.step()
-                
-                if self.logger is not None:
-                    self.logger.add_scalars('agent%i/value_loss' % agent_id,
-                        {'value_loss': value_loss},
-                        self.step)
-                    self.logger.add_scalars('agent%i/action_loss' % agent_id,
-                        {'action_loss': action_loss},
-                        self.step)
-                    self.logger.add_scalars('agent%i/dist_entropy' % agent_id,
-                        {'dist_entropy': dist_entropy},
-                        self.step)
-                    self.logger.add_scalars('agent%i/KL_divloss' % agent_id,
-                        {'KL_divloss': KL_divloss},
-                        self.step)
-                    self.logger.add_scalars('agent%i/grad_norm' % agent_id,
-                        {'grad_norm': grad_norm},
-                        self.step)
-                    self.step += 1
-
-                value_loss_epoch += value_loss.item()
-                action_loss_epoch += action_loss.item()
-                dist_entropy_epoch += dist_entropy.item()                
-                
-        num_updates = self.ppo_epoch * self.num_mini_batch
+        return self.ppo_loss(values, action_log_probs, dist_entropy, value_preds_batch, return_batch, high_masks_batch,
+                             old_action_log_probs_batch, adv_targ, turn_on)
 
-        value_loss_epoch /= num_updates
-        action_loss_epoch /= num_updates
-        dist_entropy_epoch /= num_updates
+    def ppo_loss(self, values, action_log_probs, dist_entropy, value_preds_batch, return_batch, high_masks_batch,
+                 old_action_log_probs_batch, adv_targ, turn_on=True):
+        """ The loss of minibatch_loss from the evaluated actions, and its stats """
+        old_action_log_probs_batch = old_action_log_probs_batch.to(self.device)
+        adv_targ = adv_targ.to(self.device)
+        value_preds_batch = value_preds_batch.to(self.device)
+        return_batch = return_batch.to(self.device)
+        high_masks_batch = high_masks_batch.to(self.device)
 
-        return value_loss_epoch, action_loss_epoch, dist_entropy_epoch
-        
-    def update(self, agent_id, rollouts, turn_on=True):
-        if self.use_popart:
-            advantages = rollouts.returns[:-1,:,agent_id] - self.value_normalizer.denormalize(torch.tensor(rollouts.value_preds[:-1,:,agent_id])).cpu().numpy()
-        else:
-            advantages = rollouts.returns[:-1,:,agent_id] - rollouts.value_preds[:-1,:,agent_id]
-        advantages = (advantages - advantages.mean()) / (
-            advantages.std() + 1e-5)
+        ratio = torch.exp(action_log_probs - old_action_log_probs_batch)
 
-        value_loss_epoch = 0
-        action_loss_epoch = 0
-        dist_entropy_epoch = 0
+        KL_divloss = nn.KLDivLoss(reduction='batchmean')(old_action_log_probs_batch, torch.exp(action_log_probs))
 
-        for e in range(self.ppo_epoch):
-            if self.actor_critic.is_recurrent:
-                data_generator = rollouts.recurrent_generator(
-                    agent_id, advantages, self.num_mini_batch, self.data_chunk_length)
-            elif self.actor_critic.is_naive_recurrent:
-                data_generator = rollouts.naive_recurrent_generator(
-                    agent_id, advantages, self.num_mini_batch)
-            else:
-                data_generator = rollouts.feed_forward_generator(
-                    agent_id, advantages, self.num_mini_batch)
+        surr1 = ratio * adv_targ
+        surr2 = torch.clamp(ratio, 1.0 - self.clip_param, 1.0 + self.clip_param) * adv_targ
+        action_loss = (-torch.min(surr1, surr2)* high_masks_batch).sum() / high_masks_batch.sum()
 
-            for sample in data_generator:
-                share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, \
-                   value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, \
-                        adv_targ = sample
-                        
-                old_action_log_probs_batch = old_action_log_probs_batch.to(self.device)
-                adv_targ = adv_targ.to(self.device)
-                value_preds_batch = value_preds_batch.to(self.device)
-                return_batch = return_batch.to(self.device)
-                high_masks_batch = high_masks_batch.to(self.device)
-                
-                # Reshape to do in a single forward pass for all steps
-                values, action_log_probs, dist_entropy, _, _ = self.actor_critic.evaluate_actions(agent_id, share_obs_batch, 
-                obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, masks_batch, high_masks_batch)
+        value_loss = self.value_loss(values, value_preds_batch, return_batch, high_masks_batch)
 
-                ratio = torch.exp(action_log_probs - old_action_log_probs_batch)
-                
-                KL_divloss = nn.KLDivLoss(reduction='batchmean')(old_action_log_probs_batch, torch.exp(action_log_probs))
-                
-                surr1 = ratio * adv_targ
-                surr2 = torch.clamp(ratio, 1.0 - self.clip_param, 1.0 + self.clip_param) * adv_targ                
-                action_loss = (-torch.min(surr1, surr2)* high_masks_batch).sum() / high_masks_batch.sum()
+        # the value and policy losses share one backward pass, their gradients add up
+        loss = value_loss * self.value_loss_coef
+        if self.use_common_layer or turn_on == True:
+            loss = loss + action_loss - dist_entropy * self.entropy_coef
+
+        return loss, dict(value_loss=value_loss, action_loss=action_loss, dist_entropy=dist_entropy, KL_divloss=KL_divloss)
+
+    # clips the gradients and returns their norm before clipping
+    def clip_gradients(self):
+        if self.use_max_grad_norm:
+            return nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
+        return get_gard_norm(self.actor_critic.parameters())
+
+    def epoch_losses(self, totals):
+        num_updates = self.ppo_epoch * self.num_mini_batch
+        return totals['value_loss'] / num_updates, totals['action_loss'] / num_updates, totals['dist_entropy'] / num_updates
+
+    def update_epochs(self, agent_id, epoch_generators, turn_on=True):
+        metrics = MetricsAccumulator()
+        totals = {}
+
+        for e, data_generator in enumerate(epoch_generators):
+            for sample in data_generator:
+                loss, stats = self.minibatch_loss(agent_id, sample, turn_on)
 
-                if self.use_clipped_value_loss:
-                    if self.use_huber_loss:
-                        if self.use_popart:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            error_clipped = self.value_normalizer(return_batch) - value_pred_clipped
-                            value_losses_clipped = huber_loss(error_clipped, self.huber_delta)
-                            error = self.value_normalizer(return_batch) - values
-                            value_losses = huber_loss(error,self.huber_delta)
-                            value_loss = (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum()
-                        else:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            error_clipped = (return_batch) - value_pred_clipped
-                            value_losses_clipped = huber_loss(error_clipped, self.huber_delta)
-                            error = (return_batch) - values
-                            value_losses = huber_loss(error,self.huber_delta)
-                            value_loss = (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum()
-                    else:
-                        if self.use_popart:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            value_losses = (values - self.value_normalizer(return_batch)).pow(2)
-                            value_losses_clipped = (value_pred_clipped - self.value_normalizer(return_batch)).pow(2)
-                            value_loss = 0.5 * ( (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum() )
-                        else:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            value_losses = (values - (return_batch)).pow(2)
-                            value_losses_clipped = (value_pred_clipped - return_batch).pow(2)
-                            value_loss = 0.5 * ( (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum() )
-                    
-                else:
-                    if self.use_huber_loss:
-                        if self.use_popart:
-                            error = self.value_normalizer(return_batch) - values
-                        else:
-                            error = return_batch - values
-                        value_loss = (huber_loss(error, self.huber_delta) * high_masks_batch).sum() / high_masks_batch.sum()
-                    else:
-                        if self.use_popart:
-                            value_loss = 0.5 * (((self.value_normalizer(return_batch) - values).pow(2) * high_masks_batch).sum() / high_masks_batch.sum())
-                        else:
-                            value_loss = 0.5 * (((return_batch - values).pow(2) * high_masks_batch).sum() / high_masks_batch.sum())
-                
                 self.optimizer.zero_grad()
-                
-                if self.use_common_layer:
-                    (value_loss * self.value_loss_coef + action_loss - dist_entropy * self.entropy_coef).backward()
-                else:              
-                    (value_loss * self.value_loss_coef).backward()
-                    if turn_on == True:
-                        (action_loss - dist_entropy * self.entropy_coef).backward()
-                
-                grad_norm = get_gard_norm(self.actor_critic.parameters())
-                       
-                if self.use_max_grad_norm:
-                    nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
-                    
+                loss.backward()
+                grad_norm = self.clip_gradients()
                 self.optimizer.step()
-                
-                if self.logger is not None:
-                    self.logger.add_scalars('agent%i/value_loss' % agent_id,
-                        {'value_loss': value_loss},
-                        self.step)
-                    self.logger.add_scalars('agent%i/action_loss' % agent_id,
-                        {'action_loss': action_loss},
-                        self.step)
-                    self.logger.add_scalars('agent%i/dist_entropy' % agent_id,
-                        {'dist_entropy': dist_entropy},
-                        self.step)
-                    self.logger.add_scalars('agent%i/KL_divloss' % agent_id,
-                        {'KL_divloss': KL_divloss},
-                        self.step)
-                    self.logger.add_scalars('agent%i/grad_norm' % agent_id,
-                        {'grad_norm': grad_norm},
-                        self.step)
-                    self.step += 1
-
-                value_loss_epoch += value_loss.item()
-                action_loss_epoch += action_loss.item()
-                dist_entropy_epoch += dist_entropy.item()                
-                
-        num_updates = self.ppo_epoch * self.num_mini_batch
 
-        value_loss_epoch /= num_updates
-        action_loss_epoch /= num_updates
-        dist_entropy_epoch /= num_updates
+                metrics.add(grad_norm=grad_norm, **stats)
 
-        return value_loss_epoch, action_loss_epoch, dist_entropy_epoch
+            if self.metrics_interval != 'update' or e == self.ppo_epoch - 1:
+                self.flush_metrics(metrics, totals, 'agent%i/' % agent_id)
+
+        return self.epoch_losses(totals)
+
+    def update_single(self, agent_id, rollouts, turn_on=True):
+        return self.update_epochs(agent_id, self.epoch_generators(agent_id, rollouts, single=True), turn_on)
+
+    def update(self, agent_id, rollouts, turn_on=True):
+        return self.update_epochs(agent_id, self.epoch_generators(agent_id, rollouts), turn_on)
 
     def update_share(self, num_agents, rollouts, turn_on=True):
-        advantages = []
-        for agent_id in range(num_agents):
-            if self.use_popart:
-                advantage = rollouts.returns[:-1,:,agent_id] - self.value_normalizer.denormalize(torch.tensor(rollouts.value_preds[:-1,:,agent_id])).cpu().numpy()
-            else:
-                advantage = rollouts.returns[:-1,:,agent_id] - rollouts.value_preds[:-1,:,agent_id]           
-            advantages.append(advantage)
-        #agent ,step, parallel,1
-        advantages = np.array(advantages).transpose(1,2,0,3)
-        advantages = (advantages - advantages.mean()) / (
-                advantages.std() + 1e-5)      
+        #step, parallel, agent, 1
+        advantages = compute_advantages(rollouts.returns, rollouts.value_preds, self.use_popart, self.value_normalizer)
+        # evaluate_actions is handed the last agent id, as it was when advantages were built per agent
+        agent_id = num_agents - 1
+
+        metrics = MetricsAccumulator()
+        totals = {}
 
-        value_loss_epoch = 0
-        action_loss_epoch = 0
-        dist_entropy_epoch = 0
+        if self.actor_critic.is_recurrent:
+            chunks = rollouts.recurrent_chunks_share(advantages, self.data_chunk_length)
+            staging = PinnedStaging(chunks, self.num_mini_batch) if self.use_pin_memory else False
 
         for e in range(self.ppo_epoch):
             
             if self.actor_critic.is_recurrent:
                 data_generator = rollouts.recurrent_generator_share(
-                    advantages, self.num_mini_batch, self.data_chunk_length)
+                    advantages, self.num_mini_batch, self.data_chunk_length, chunks, staging, self.device)
             elif self.actor_critic.is_naive_recurrent:
                 data_generator = rollouts.naive_recurrent_generator_share(
                     advantages, self.num_mini_batch)
@@ -451,67 +336,7 @@ class PPO():
                 surr2 = torch.clamp(ratio, 1.0 - self.clip_param, 1.0 + self.clip_param) * adv_targ
                 action_loss = (-torch.min(surr1, surr2)* high_masks_batch).sum() / high_masks_batch.sum()
 
-                if self.use_clipped_value_loss:
-                    if self.use_huber_loss:
-                        if self.use_popart:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            error_clipped = self.value_normalizer(return_batch) - value_pred_clipped
-                            value_losses_clipped = huber_loss(error_clipped, self.huber_delta)
-                            error = self.value_normalizer(return_batch) - values
-                            value_losses = huber_loss(error,self.huber_delta)
-                            if self.use_value_high_masks:
-                                value_loss = (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum()
-                            else:
-                                value_loss = (torch.max(value_losses, value_losses_clipped)).mean()
-                        else:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            error_clipped = (return_batch) - value_pred_clipped
-                            value_losses_clipped = huber_loss(error_clipped, self.huber_delta)
-                            error = (return_batch) - values
-                            value_losses = huber_loss(error,self.huber_delta)
-                            if self.use_value_high_masks:
-                                value_loss = (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum()
-                            else:
-                                value_loss = (torch.max(value_losses, value_losses_clipped)).mean()
-                    else:
-                        if self.use_popart:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            value_losses = (values - self.value_normalizer(return_batch)).pow(2)
-                            value_losses_clipped = (value_pred_clipped - self.value_normalizer(return_batch)).pow(2)
-                            if self.use_value_high_masks:
-                                value_loss = 0.5 * ( (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum() )
-                            else:
-                                value_loss = 0.5 * (torch.max(value_losses, value_losses_clipped)).mean() 
-                        else:
-                            value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-self.clip_param, self.clip_param)
-                            value_losses = (values - (return_batch)).pow(2)
-                            value_losses_clipped = (value_pred_clipped - return_batch).pow(2)
-                            if self.use_value_high_masks:
-                                value_loss = 0.5 * ( (torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum() )
-                            else:
-                                value_loss = 0.5 * (torch.max(value_losses, value_losses_clipped)).mean()
-                    
-                else:
-                    if self.use_huber_loss:
-                        if self.use_popart:
-                            error = self.value_normalizer(return_batch) - values
-                        else:
-                            error = return_batch - values
-                        if self.use_value_high_masks:
-                            value_loss = (huber_loss(error, self.huber_delta) * high_masks_batch).sum() / high_masks_batch.sum()
-                        else:
-                            value_loss = (huber_loss(error, self.huber_delta)).mean()
-                    else:
-                        if self.use_popart:
-                            if self.use_value_high_masks:
-                                value_loss = 0.5 * (((self.value_normalizer(return_batch) - values).pow(2) * high_masks_batch).sum() / high_masks_batch.sum())
-                            else:
-                                value_loss = 0.5 * (self.value_normalizer(return_batch) - values).pow(2).mean()
-                        else:
-                            if self.use_value_high_masks:
-                                value_loss = 0.5 * (((return_batch - values).pow(2) * high_masks_batch).sum() / high_masks_batch.sum())
-                            else:
-                                value_loss = 0.5 * (return_batch - values).pow(2).mean() 
+                value_loss = self.value_loss(values, value_preds_batch, return_batch, high_masks_batch, self.use_value_high_masks)
                 self.optimizer.zero_grad()                 
  
                 if self.use_common_layer:
@@ -521,45 +346,85 @@ class PPO():
                     if turn_on == True:
                         (action_loss - dist_entropy * self.entropy_coef).backward()
                
-                grad_norm = get_gard_norm(self.actor_critic.parameters())
-                       
                 if self.use_max_grad_norm:
-                    nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
+                    # the norm before clipping, same as get_gard_norm
+                    grad_norm = nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
+                else:
+                    grad_norm = get_gard_norm(self.actor_critic.parameters())
                  
                 self.optimizer.step()
                 
-                if self.logger is not None:
-                    self.logger.add_scalars('ratio',
-                        {'ratio': ratio.mean()},
-                        self.step)
-                    self.logger.add_scalars('adv',
-                        {'adv': adv_targ.mean()},
-                        self.step)
-                    self.logger.add_scalars('value_loss',
-                        {'value_loss': value_loss},
-                        self.step)
-                    self.logger.add_scalars('action_loss',
-                        {'action_loss': action_loss},
-                        self.step)
-                    self.logger.add_scalars('dist_entropy',
-                        {'dist_entropy': dist_entropy},
-                        self.step)
-                    self.logger.add_scalars('KL_divloss',
-                        {'KL_divloss': KL_divloss},
-                        self.step)
-                    self.logger.add_scalars('grad_norm',
-                        {'grad_norm': grad_norm},
-                        self.step)
-                    self.step += 1
-                
-                value_loss_epoch += value_loss.item()
-                action_loss_epoch += action_loss.item()
-                dist_entropy_epoch += dist_entropy.item()  
-       
+                metrics.add(ratio=ratio.mean(), adv=adv_targ.mean(), value_loss=value_loss, action_loss=action_loss,
+                            dist_entropy=dist_entropy, KL_divloss=KL_divloss, grad_norm=grad_norm)
+
+            if self.metrics_interval != 'update' or e == self.ppo_epoch - 1:
+                self.flush_metrics(metrics, totals)
+
         num_updates = self.ppo_epoch * self.num_mini_batch
 
-        value_loss_epoch /= num_updates
-        action_loss_epoch /= num_updates
-        dist_entropy_epoch /= num_updates
+        value_loss_epoch = totals['value_loss'] / num_updates
+        action_loss_epoch = totals['action_loss'] / num_updates
+        dist_entropy_epoch = totals['dist_entropy'] / num_updates
 
         return value_loss_epoch, action_loss_epoch, dist_entropy_epoch
+
+def update_group(agents, rollouts, single=False, turn_on=True):
+    """
+    PPO.update (or update_single, rollouts being the list of every agent's SingleRolloutStorage)
+    of all the per-agent PPOs in agents as one batched network: their Policies are stacked into a
+    StackedPolicies for the update, and every step takes the next minibatch of every agent and runs
+    one forward and backward pass for all of them. Each agent then clips its gradients and steps
+    its own optimizer, and keeps its own PopArt statistics and logging; the Policies are unstacked
+    at the end, so the agent%i_model.pt checkpoints are unchanged. The agents need the same
+    hyperparameters. Policies StackedPolicies does not support are updated one after the other.
+    Returns the per-agent (value_loss, action_loss, dist_entropy) lists.
+    """
+    policies = [agent.actor_critic for agent in agents]
+    if not StackedPolicies.supports(policies):
+        if single:
+            losses = [agent.update_single(agent_id, rollouts[agent_id], turn_on) for agent_id, agent in enumerate(agents)]
+        else:
+            losses = [agent.update(agent_id, rollouts, turn_on) for agent_id, agent in enumerate(agents)]
+        return tuple(map(list, zip(*losses)))
+
+    epochs = [agent.epoch_generators(agent_id, rollouts[agent_id] if single else rollouts, single)
+              for agent_id, agent in enumerate(agents)]
+    metrics = [MetricsAccumulator() for _ in agents]
+    totals = [{} for _ in agents]
+
+    stacked = StackedPolicies(policies)
+    for e, data_generators in enumerate(zip(*epochs)):
+        for samples in zip(*data_generators):
+            share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, \
+               value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, \
+                    adv_targ = zip(*samples)
+
+            values, action_log_probs, dist_entropy = stacked.evaluate_actions(*[torch.stack(field) for field in (
+                share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch,
+                actions_batch, masks_batch, high_masks_batch)])
+
+            losses = []
+            stats = []
+            for agent_id, agent in enumerate(agents):
+                loss, agent_stats = agent.ppo_loss(values[agent_id], action_log_probs[agent_id], dist_entropy[agent_id],
+                                                   value_preds_batch[agent_id], return_batch[agent_id], high_masks_batch[agent_id],
+                                                   old_action_log_probs_batch[agent_id], adv_targ[agent_id], turn_on)
+                losses.append(loss)
+                stats.append(agent_stats)
+
+            # the agents' rows of the stacked parameters only get the gradients of their own loss
+            stacked.zero_grad()
+            torch.stack(losses).sum().backward()
+            stacked.scatter_grads()
+
+            for agent, agent_metrics, agent_stats in zip(agents, metrics, stats):
+                grad_norm = agent.clip_gradients()
+                agent.optimizer.step()
+                agent_metrics.add(grad_norm=grad_norm, **agent_stats)
+
+        for agent_id, agent in enumerate(agents):
+            if agent.metrics_interval != 'update' or e == agent.ppo_epoch - 1:
+                agent.flush_metrics(metrics[agent_id], totals[agent_id], 'agent%i/' % agent_id)
+    stacked.unstack()
+
+    return tuple(map(list, zip(*[agent.epoch_losses(agent_totals) for agent, agent_totals in zip(agents, totals)])))
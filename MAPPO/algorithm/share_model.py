@@ -23,6 +23,18 @@ def split_obs(obs, split_shape):
         start_idx += split_shape[i][0]*split_shape[i][1]
     return split_obs
     
+# [threads, agents, ...] --> [threads*agents, ...]
+def _flatten_agents(x):
+    x = torch.as_tensor(x)
+    return x.reshape(-1, *x.shape[2:])
+
+# [threads*agents, ...] --> [threads, agents, ...], numpy unless the inputs were tensors
+def _unflatten_agents(n_rollout_threads, num_agents, x, to_numpy=True):
+    x = x.detach().reshape(n_rollout_threads, num_agents, *x.shape[1:])
+    if to_numpy:
+        return x.cpu().numpy()
+    return x
+
 class Flatten(nn.Module):
     def forward(self, x):
         return x.view(x.size(0), -1)
@@ -164,6 +176,47 @@ class Policy(nn.Module):
         
         return value, rnn_hxs_actor, rnn_hxs_critic
 
+    def act_all(self, share_inputs, inputs, rnn_hxs_actor, rnn_hxs_critic, masks, available_actions=None, deterministic=False):
+        """
+        act() for every agent of every rollout thread in a single forward pass.
+        Inputs are [threads, agents, ...] slices of RolloutStorage, outputs are
+        [threads, agents, ...] arrays that can go straight into RolloutStorage.insert,
+        numpy arrays for numpy inputs and tensors on the policy device for tensor inputs.
+        """
+        n_rollout_threads, num_agents = inputs.shape[0:2]
+        to_numpy = not torch.is_tensor(inputs)
+        if available_actions is not None:
+            available_actions = _flatten_agents(available_actions)
+
+        value, action, action_log_prob, rnn_hxs_actor, rnn_hxs_critic = self.act(_flatten_agents(share_inputs),
+            _flatten_agents(inputs),
+            _flatten_agents(rnn_hxs_actor),
+            _flatten_agents(rnn_hxs_critic),
+            _flatten_agents(masks),
+            available_actions,
+            deterministic)
+
+        return _unflatten_agents(n_rollout_threads, num_agents, value, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, action, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, action_log_prob, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, rnn_hxs_actor, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, rnn_hxs_critic, to_numpy)
+
+    def get_value_all(self, share_inputs, inputs, rnn_hxs_actor, rnn_hxs_critic, masks):
+        """get_value() counterpart of act_all, returns [threads, agents, ...] arrays."""
+        n_rollout_threads, num_agents = inputs.shape[0:2]
+        to_numpy = not torch.is_tensor(inputs)
+
+        value, rnn_hxs_actor, rnn_hxs_critic = self.get_value(_flatten_agents(share_inputs),
+            _flatten_agents(inputs),
+            _flatten_agents(rnn_hxs_actor),
+            _flatten_agents(rnn_hxs_critic),
+            _flatten_agents(masks))
+
+        return _unflatten_agents(n_rollout_threads, num_agents, value, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, rnn_hxs_actor, to_numpy), \
+               _unflatten_agents(n_rollout_threads, num_agents, rnn_hxs_critic, to_numpy)
+
     def evaluate_actions(self, agent_id, share_inputs, inputs, rnn_hxs_actor, rnn_hxs_critic, action, masks, high_masks=None):
     
         share_inputs = share_inputs.to(self.device)
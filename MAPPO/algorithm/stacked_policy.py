@@ -0,0 +1,158 @@
+import torch
+import torch.nn.functional as F
+
+from utils.distributions import FixedCategorical, FixedNormal
+
+class StackedPolicies(object):
+    """
+    The Policies of several agents run as one batched network: every parameter is stacked along a
+    leading agent axis [G, ...] and the layers are evaluated with batched matmuls, so one forward and
+    backward pass serves the minibatches of all the agents.
+
+    While stacked, each agent's parameters are views of their row of the stacked tensors: after
+    backward() the rows of the stacked gradients are handed to the agents' parameters, and the agents'
+    own optimizers update the stacked tensors in place. unstack() gives every parameter its own
+    storage again, so the Policies are saved and used exactly as before.
+
+    Only the MLPBase network without attention, common layer or feature PopArt, with at most one GRU
+    layer and a Categorical or DiagGaussian head is supported, see supports().
+    """
+    def __init__(self, policies):
+        self.policies = policies
+        self.device = policies[0].device
+        self.base = policies[0].base
+        self.dist = policies[0].dist
+        self.params = {}
+        self.agent_params = [dict(policy.named_parameters()) for policy in policies]
+        for name in self.agent_params[0]:
+            stacked = torch.stack([params[name].data for params in self.agent_params]).requires_grad_()
+            for g, params in enumerate(self.agent_params):
+                params[name].data = stacked.data[g]
+            self.params[name] = stacked
+
+    @staticmethod
+    def supports(policies):
+        """ Whether the Policies are all the same network of the kind StackedPolicies can batch """
+        for policy in policies:
+            base = policy.base
+            if base.__class__.__name__ != 'MLPBase' or base.is_attn or base._attn_only_critic \
+                    or base._use_common_layer or base._use_feature_popart:
+                return False
+            if policy.mixed_action or policy.multi_discrete or policy.dist.__class__.__name__ not in ('Categorical', 'DiagGaussian'):
+                return False
+            if (base.is_recurrent or base.is_naive_recurrent) and base.gru.num_layers != 1:
+                return False
+            if not all(param.requires_grad for param in policy.parameters()):
+                return False
+        shapes = [[(name, param.shape, param.device) for name, param in policy.named_parameters()] for policy in policies]
+        return all(agent_shapes == shapes[0] for agent_shapes in shapes)
+
+    def zero_grad(self):
+        for stacked in self.params.values():
+            stacked.grad = None
+
+    def scatter_grads(self):
+        """ Hand every agent's parameters their rows of the stacked gradients """
+        for name, stacked in self.params.items():
+            for g, params in enumerate(self.agent_params):
+                params[name].grad = None if stacked.grad is None else stacked.grad[g]
+
+    def unstack(self):
+        """ Give the agents' parameters their own storage (and drop the gradient views) """
+        for params in self.agent_params:
+            for param in params.values():
+                param.data = param.data.clone()
+                param.grad = None
+        self.params = {}
+
+    def _linear(self, name, x):
+        # x [G, B, in] --> [G, B, out]
+        return torch.baddbmm(self.params[name + '.bias'].unsqueeze(1), x, self.params[name + '.weight'].transpose(1, 2))
+
+    def _layer_norm(self, name, module, x):
+        x = F.layer_norm(x, module.normalized_shape, eps=module.eps)
+        return torch.addcmul(self.params[name + '.bias'].unsqueeze(1), x, self.params[name + '.weight'].unsqueeze(1))
+
+    def _mlp(self, name, module, x):
+        # MLPLayer: fc1 and the layer_N fc2 blocks, each Linear, activation, LayerNorm
+        blocks = [('fc1', module.fc1)] + [('fc2.%i' % i, block) for i, block in enumerate(module.fc2)]
+        for block_name, block in blocks:
+            prefix = '%s.%s' % (name, block_name)
+            x = block[1](self._linear(prefix + '.0', x))
+            x = self._layer_norm(prefix + '.2', block[2], x)
+        return x
+
+    def _gru(self, name, x, hxs, masks):
+        """
+        NNBase._forward_gru of every agent: x [G, N*T, H] (N sequences of T steps, a single step when
+        T == 1), hxs [G, N, H]. The hidden state is multiplied by the mask of each step before it,
+        which is what resetting it at the steps where some mask is zero amounts to.
+        """
+        G, N = hxs.shape[:2]
+        T = x.size(1) // N
+        w_ih, w_hh = self.params[name + '.weight_ih_l0'], self.params[name + '.weight_hh_l0']
+        b_ih, b_hh = self.params[name + '.bias_ih_l0'], self.params[name + '.bias_hh_l0']
+
+        # the input projections of all steps at once, [G, T, N, 3H]
+        x = x.view(G, N, T, -1).transpose(1, 2)
+        gates_x = torch.baddbmm(b_ih.unsqueeze(1), x.reshape(G, T * N, -1), w_ih.transpose(1, 2)).view(G, T, N, -1)
+        # read as [T, N] like NNBase._forward_gru does
+        masks = masks.view(G, T, N, 1)
+
+        h = hxs
+        outputs = []
+        for t in range(T):
+            h = h * masks[:, t]
+            gates_h = torch.baddbmm(b_hh.unsqueeze(1), h, w_hh.transpose(1, 2))
+            x_r, x_z, x_n = gates_x[:, t].chunk(3, -1)
+            h_r, h_z, h_n = gates_h.chunk(3, -1)
+            r = torch.sigmoid(x_r + h_r)
+            z = torch.sigmoid(x_z + h_z)
+            n = torch.tanh(x_n + r * h_n)
+            h = n + z * (h - n)
+            outputs.append(h)
+        return torch.stack(outputs, 2).reshape(G, N * T, -1)
+
+    def evaluate_actions(self, share_inputs, inputs, rnn_hxs_actor, rnn_hxs_critic, action, masks, high_masks=None):
+        """
+        Policy.evaluate_actions of every agent, all inputs stacked [G, ...]. Returns the stacked values and
+        the per-agent lists of action log probs and entropies.
+        """
+        base = self.base
+        share_x = share_inputs.to(self.device)
+        x = inputs.to(self.device)
+        masks = masks.to(self.device)
+        action = action.to(self.device)
+        if high_masks is not None:
+            high_masks = high_masks.to(self.device)
+
+        if base._use_feature_normlization:
+            x = self._layer_norm('base.actor_norm', base.actor_norm, x)
+            share_x = self._layer_norm('base.critic_norm', base.critic_norm, share_x)
+
+        hidden_actor = self._mlp('base.actor', base.actor, x)
+        hidden_critic = self._mlp('base.critic', base.critic, share_x)
+        if base.is_recurrent or base.is_naive_recurrent:
+            hidden_actor = self._gru('base.gru', hidden_actor, rnn_hxs_actor.to(self.device), masks)
+            hidden_critic = self._gru('base.gru_critic', hidden_critic, rnn_hxs_critic.to(self.device), masks)
+            hidden_actor = self._layer_norm('base.actor_rnn_norm', base.actor_rnn_norm, hidden_actor)
+            hidden_critic = self._layer_norm('base.critic_rnn_norm', base.critic_rnn_norm, hidden_critic)
+        values = self._linear('base.critic_linear', hidden_critic)
+
+        if self.dist.__class__.__name__ == 'Categorical':
+            logits = self._linear('dist.linear', hidden_actor)
+            dists = [FixedCategorical(logits=agent_logits) for agent_logits in logits]
+        else:
+            action_mean = self._linear('dist.fc_mean', hidden_actor)
+            action_std = (torch.zeros_like(action_mean) + self.params['dist.logstd._bias'].transpose(1, 2)).exp()
+            dists = [FixedNormal(agent_mean, agent_std) for agent_mean, agent_std in zip(action_mean, action_std)]
+
+        action_log_probs = []
+        dist_entropy = []
+        for g, dist in enumerate(dists):
+            action_log_probs.append(dist.log_probs(action[g]))
+            if high_masks is not None:
+                dist_entropy.append((dist.entropy() * high_masks[g].squeeze(-1)).sum() / high_masks[g].sum())
+            else:
+                dist_entropy.append(dist.entropy().mean())
+        return values, action_log_probs, dist_entropy
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Times the PPO update of non-shared MLP/GRU policies, one agent after the other with update_single
+against all agents as one batched network with update_group, on random MPE-sized rollouts. Also
+prints how far the parameters of the two end up apart after one update from the same state
+(expect float rounding only with --ppo_epoch 1, later epochs sample other minibatches).
+
+    python benchmark_grouped_update.py --num_agents 8 --recurrent_policy
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from gym import spaces
+
+from algorithm.model import Policy
+from algorithm.ppo import PPO, update_group
+from utils.single_storage import SingleRolloutStorage
+
+def timeit(fn, repeats, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeats
+
+def make_agents(args, all_obs_space, action_space, device):
+    agents = []
+    for agent_id in range(args.num_agents):
+        actor_critic = Policy(all_obs_space, action_space, num_agents=agent_id,
+                              base_kwargs={'naive_recurrent': False,
+                                           'recurrent': args.recurrent_policy,
+                                           'hidden_size': args.hidden_size,
+                                           'use_feature_normlization': True,
+                                           'use_feature_popart': False,
+                                           'layer_N': args.layer_N},
+                              device=device)
+        actor_critic.to(device)
+        agents.append(PPO(actor_critic, clip_param=0.2, ppo_epoch=args.ppo_epoch, num_mini_batch=args.num_mini_batch,
+                          data_chunk_length=args.data_chunk_length, value_loss_coef=1, entropy_coef=0.01, lr=7e-4,
+                          eps=1e-5, weight_decay=0, max_grad_norm=10.0, use_popart=True, device=device))
+    return agents
+
+def copy_agents(agents, args, all_obs_space, action_space, device):
+    copies = make_agents(args, all_obs_space, action_space, device)
+    for agent, agent_copy in zip(agents, copies):
+        agent_copy.actor_critic.load_state_dict(agent.actor_critic.state_dict())
+        agent_copy.optimizer.load_state_dict(agent.optimizer.state_dict())
+        agent_copy.value_normalizer.load_state_dict(agent.value_normalizer.state_dict())
+    return copies
+
+def main():
+    parser = argparse.ArgumentParser(description='Grouped PPO update micro-benchmark.')
+    parser.add_argument("--episode_length", type=int, default=25)
+    parser.add_argument("--n_rollout_threads", type=int, default=32)
+    parser.add_argument("--num_agents", type=int, default=8)
+    parser.add_argument("--obs_dim", type=int, default=18)
+    parser.add_argument("--num_actions", type=int, default=5)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--layer_N", type=int, default=1)
+    parser.add_argument("--recurrent_policy", action='store_true', default=False)
+    parser.add_argument("--data_chunk_length", type=int, default=10)
+    parser.add_argument("--num_mini_batch", type=int, default=1)
+    parser.add_argument("--ppo_epoch", type=int, default=15)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--cuda", action='store_true', default=False)
+    args = parser.parse_args()
+    device = torch.device("cuda:0" if args.cuda and torch.cuda.is_available() else "cpu")
+
+    all_obs_space = [spaces.Box(low=-np.inf, high=np.inf, shape=(args.obs_dim,), dtype=np.float32)] * args.num_agents
+    action_space = spaces.Discrete(args.num_actions)
+
+    rollouts = []
+    for agent_id in range(args.num_agents):
+        ro = SingleRolloutStorage(agent_id, args.episode_length, args.n_rollout_threads, all_obs_space,
+                                  [action_space] * args.num_agents, args.hidden_size)
+        for name in ('share_obs', 'obs', 'recurrent_hidden_states', 'recurrent_hidden_states_critic',
+                     'value_preds', 'returns', 'action_log_probs'):
+            setattr(ro, name, np.random.randn(*getattr(ro, name).shape).astype(np.float32))
+        ro.action_log_probs = -np.abs(ro.action_log_probs)
+        ro.actions = np.random.randint(args.num_actions, size=ro.actions.shape).astype(np.float32)
+        ro.masks = (np.random.rand(*ro.masks.shape) > 0.05).astype(np.float32)
+        rollouts.append(ro)
+
+    torch.manual_seed(1)
+    serial = make_agents(args, all_obs_space, action_space, device)
+    grouped = copy_agents(serial, args, all_obs_space, action_space, device)
+
+    # one update from the same state, the agents draw their minibatches in the same order only with --ppo_epoch 1
+    torch.manual_seed(2)
+    for agent_id, agent in enumerate(serial):
+        agent.update_single(agent_id, rollouts[agent_id])
+    torch.manual_seed(2)
+    update_group(grouped, rollouts, single=True)
+    diff = max((p - q).abs().max().item() for agent, agent_copy in zip(serial, grouped)
+               for p, q in zip(agent.actor_critic.parameters(), agent_copy.actor_critic.parameters()))
+    print("largest parameter difference after one update: %.2e" % diff)
+
+    def update_serial():
+        for agent_id, agent in enumerate(serial):
+            agent.update_single(agent_id, rollouts[agent_id])
+
+    before = timeit(update_serial, args.repeats, device)
+    after = timeit(lambda: update_group(grouped, rollouts, single=True), args.repeats, device)
+    print("%d agents, %s policy, %d minibatches per update: %.1f ms -> %.1f ms (%.1fx)"
+          % (args.num_agents, 'gru' if args.recurrent_policy else 'mlp', args.ppo_epoch * args.num_mini_batch,
+             before * 1e3, after * 1e3, before / after))
+
+if __name__ == "__main__":
+    main()
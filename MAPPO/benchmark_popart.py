@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Times the PopArt parts of a PPO update on a SMAC-sized buffer, the way they were done before
+(returns normalized, and the statistics updated, at every use in the value loss; whole buffers
+denormalized through a float copy on the PopArt device) against the current path.
+
+    python benchmark_popart.py --episode_length 400 --n_rollout_threads 8 --num_agents 27
+"""
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+from algorithm.ppo import PPO, PopArt
+from utils.returns import denormalize_values
+
+def legacy_value_loss(ppo, values, value_preds_batch, return_batch, high_masks_batch):
+    # the clipped squared value loss with popart as PPO.update used to compute it
+    value_pred_clipped = value_preds_batch + (values - value_preds_batch).clamp(-ppo.clip_param, ppo.clip_param)
+    value_losses = (values - ppo.value_normalizer(return_batch)).pow(2)
+    value_losses_clipped = (value_pred_clipped - ppo.value_normalizer(return_batch)).pow(2)
+    return 0.5 * ((torch.max(value_losses, value_losses_clipped) * high_masks_batch).sum() / high_masks_batch.sum())
+
+def legacy_denormalize_values(value_preds, value_normalizer):
+    return np.stack([value_normalizer[agent_id].denormalize(torch.from_numpy(value_preds[..., agent_id, :])).cpu().numpy()
+                     for agent_id in range(len(value_normalizer))], -2)
+
+def timeit(fn, repeats, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeats
+
+def main():
+    parser = argparse.ArgumentParser(description='PopArt micro-benchmark.')
+    parser.add_argument("--episode_length", type=int, default=400)
+    parser.add_argument("--n_rollout_threads", type=int, default=8)
+    parser.add_argument("--num_agents", type=int, default=27)
+    parser.add_argument("--num_mini_batch", type=int, default=1)
+    parser.add_argument("--ppo_epoch", type=int, default=15)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--cuda", action='store_true', default=False)
+    args = parser.parse_args()
+    device = torch.device("cuda:0" if args.cuda and torch.cuda.is_available() else "cpu")
+
+    ppo = PPO(nn.Linear(1, 1), clip_param=0.2, ppo_epoch=args.ppo_epoch, num_mini_batch=args.num_mini_batch,
+              data_chunk_length=10, value_loss_coef=1, entropy_coef=0.01, lr=5e-4, eps=1e-5, weight_decay=0,
+              use_popart=True, device=device)
+    batch_size = args.episode_length * args.n_rollout_threads * args.num_agents // args.num_mini_batch
+    values = torch.randn(batch_size, 1, device=device, requires_grad=True)
+    value_preds_batch = torch.randn(batch_size, 1, device=device)
+    return_batch = torch.randn(batch_size, 1, device=device)
+    high_masks_batch = torch.ones(batch_size, 1, device=device)
+
+    def update(value_loss):
+        # one update's worth of value losses and backward passes
+        for _ in range(args.ppo_epoch * args.num_mini_batch):
+            value_loss(ppo, values, value_preds_batch, return_batch, high_masks_batch).backward()
+
+    before = timeit(lambda: update(legacy_value_loss), args.repeats, device)
+    after = timeit(lambda: update(PPO.value_loss), args.repeats, device)
+    print("value loss, %d minibatches of %d: %.2f ms -> %.2f ms (%.1fx)"
+          % (args.ppo_epoch * args.num_mini_batch, batch_size, before * 1e3, after * 1e3, before / after))
+
+    value_preds = np.random.randn(args.episode_length + 1, args.n_rollout_threads, args.num_agents, 1).astype(np.float32)
+    value_normalizer = [PopArt(1, device=device) for _ in range(args.num_agents)]
+    for normalizer in value_normalizer:
+        normalizer(torch.randn(batch_size, 1))
+    out = np.empty_like(value_preds)
+    before = timeit(lambda: legacy_denormalize_values(value_preds, value_normalizer), args.repeats, device)
+    after = timeit(lambda: denormalize_values(value_preds, value_normalizer, out=out), args.repeats, device)
+    print("denormalize, %s buffer: %.2f ms -> %.2f ms (%.1fx)"
+          % (list(value_preds.shape), before * 1e3, after * 1e3, before / after))
+
+if __name__ == "__main__":
+    main()
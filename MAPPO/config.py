@@ -11,6 +11,9 @@ def get_config():
     parser.add_argument("--cuda_deterministic", action='store_false', default=True)
     parser.add_argument("--n_training_threads", type=int, default=12)
     parser.add_argument("--n_rollout_threads", type=int, default=32)
+    parser.add_argument("--use_shmem_env", action='store_true', default=False, help='pass env outputs through shared memory instead of pipes')
+    parser.add_argument("--use_batched_env", action='store_true', default=False, help='step all MPE envs together as stacked arrays in-process')
+    parser.add_argument("--num_env_shards", type=int, default=1, help='number of processes the batched MPE envs are split across')
     parser.add_argument("--num_env_steps", type=int, default=10e6, help='number of environment steps to train (default: 10e6)') 
     
     # env
@@ -52,12 +55,17 @@ def get_config():
     parser.add_argument("--use_feature_normlization", action='store_false', default=True)   
     parser.add_argument("--use_orthogonal", action='store_false', default=True) 
     parser.add_argument("--use_same_dim", action='store_true', default=False)  
+    parser.add_argument("--use_dedup_share_obs", action='store_true', default=False, help='store the centralized share_obs once per thread instead of once per agent')
     
     # lstm
     parser.add_argument("--naive_recurrent_policy", action='store_true', default=False, help='use a naive recurrent policy')
     parser.add_argument("--recurrent_policy", action='store_false', default=True, help='use a recurrent policy')
     parser.add_argument("--recurrent_N", type=int, default=1) #TODO now only 1 is support
     parser.add_argument("--data_chunk_length", type=int, default=10)
+    parser.add_argument("--use_device_storage", action='store_true', default=False, help='keep the rollout buffer as torch tensors on the training device')
+    parser.add_argument("--use_grouped_update", action='store_true', default=False, help='without share_policy, update the MLP/GRU policies of all agents as one batched network with stacked parameters')
+    parser.add_argument("--metrics_interval", type=str, default='minibatch', choices=['minibatch', 'epoch', 'update'], help='log the ppo stats of every minibatch, or their mean per ppo epoch / per update')
+    parser.add_argument("--use_pin_memory", action='store_true', default=False, help='pin recurrent minibatches and copy them to the gpu asynchronously')
     
     # attn
     parser.add_argument("--attn", action='store_true', default=False)  
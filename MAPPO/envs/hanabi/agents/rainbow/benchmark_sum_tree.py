@@ -0,0 +1,144 @@
+# coding=utf-8
+"""Times the flat-array SumTree against the level-list one it replaced.
+
+Run from this directory:
+
+  python benchmark_sum_tree.py --capacities 100000 1000000 --batch_sizes 32 512
+
+For each capacity, fills the tree, then times batched priority updates (as
+done by set_priority after each training step), i.i.d. and stratified
+sampling for each batch size, and checks that both trees sample with the same
+distribution.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import math
+import random
+import time
+
+import numpy as np
+
+from third_party.dopamine import sum_tree
+
+
+class LegacySumTree(object):
+  """The previous SumTree: one array per level, one element per call."""
+
+  def __init__(self, capacity):
+    self.nodes = []
+    tree_depth = int(math.ceil(np.log2(capacity)))
+    level_size = 1
+    for _ in range(tree_depth + 1):
+      self.nodes.append(np.zeros(level_size))
+      level_size *= 2
+    self.max_recorded_priority = 1.0
+
+  def _total_priority(self):
+    return self.nodes[0][0]
+
+  def sample(self, query_value=None):
+    query_value = random.random() if query_value is None else query_value
+    query_value *= self._total_priority()
+    node_index = 0
+    for nodes_at_this_depth in self.nodes[1:]:
+      left_child = node_index * 2
+      left_sum = nodes_at_this_depth[left_child]
+      if query_value < left_sum:
+        node_index = left_child
+      else:
+        node_index = left_child + 1
+        query_value -= left_sum
+    return node_index
+
+  def stratified_sample(self, batch_size):
+    bounds = np.linspace(0., 1., batch_size + 1)
+    segments = [(bounds[i], bounds[i + 1]) for i in range(batch_size)]
+    query_values = [random.uniform(x[0], x[1]) for x in segments]
+    return [self.sample(query_value=x) for x in query_values]
+
+  def get(self, node_index):
+    return self.nodes[-1][node_index]
+
+  def set(self, node_index, value):
+    self.max_recorded_priority = max(value, self.max_recorded_priority)
+    delta_value = value - self.nodes[-1][node_index]
+    for nodes_at_this_depth in reversed(self.nodes):
+      nodes_at_this_depth[node_index] += delta_value
+      node_index //= 2
+
+
+def timeit(fn, repeats):
+  fn()
+  start = time.time()
+  for _ in range(repeats):
+    fn()
+  return (time.time() - start) / repeats
+
+
+def total_variation(samples_a, samples_b, capacity):
+  """Total variation distance between the empirical distributions of samples."""
+  counts_a = np.bincount(samples_a, minlength=capacity) / len(samples_a)
+  counts_b = np.bincount(samples_b, minlength=capacity) / len(samples_b)
+  return 0.5 * np.abs(counts_a - counts_b).sum()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='SumTree micro-benchmark.')
+  parser.add_argument('--capacities', type=int, nargs='+',
+                      default=[100000, 1000000])
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 512])
+  parser.add_argument('--repeats', type=int, default=20)
+  parser.add_argument('--num_check_samples', type=int, default=200000)
+  args = parser.parse_args()
+
+  for capacity in args.capacities:
+    legacy, tree = LegacySumTree(capacity), sum_tree.SumTree(capacity)
+    priorities = np.random.uniform(0.1, 10., capacity)
+    for i, priority in enumerate(priorities):
+      legacy.set(i, priority)
+    tree.set(np.arange(capacity), priorities)
+    assert np.isclose(legacy._total_priority(), tree._total_priority())
+
+    for batch_size in args.batch_sizes:
+      indices = np.random.randint(capacity, size=batch_size).astype(np.int32)
+      new_priorities = np.random.uniform(0.1, 10., batch_size)
+
+      def legacy_set():
+        for i, memory_index in enumerate(indices):
+          legacy.set(memory_index, new_priorities[i])
+
+      print('capacity %d, batch %d:' % (capacity, batch_size))
+      for name, before, after in [
+          ('set', legacy_set, lambda: tree.set(indices, new_priorities)),
+          ('sample', lambda: [legacy.sample() for _ in range(batch_size)],
+           lambda: tree.sample_batch(batch_size)),
+          ('stratified_sample',
+           lambda: legacy.stratified_sample(batch_size),
+           lambda: tree.stratified_sample(batch_size))]:
+        before = timeit(before, args.repeats)
+        after = timeit(after, args.repeats)
+        print('  %-18s %8.1f us -> %8.1f us (%.1fx)'
+              % (name, before * 1e6, after * 1e6, before / after))
+
+    # Few distinct priorities so the empirical distributions converge quickly.
+    levels = np.random.choice([0., 1., 4.], capacity // 1000)
+    small_legacy = LegacySumTree(len(levels))
+    small_tree = sum_tree.SumTree(len(levels))
+    for i, priority in enumerate(levels):
+      small_legacy.set(i, priority)
+    small_tree.set(np.arange(len(levels)), levels)
+    legacy_samples = [small_legacy.sample()
+                      for _ in range(args.num_check_samples)]
+    samples = small_tree.sample_batch(args.num_check_samples)
+    print('  total variation between samples of %d leaves: %.4f, '
+          'zero priority leaves sampled: %d'
+          % (len(levels), total_variation(legacy_samples, samples, len(levels)),
+             (levels[samples] == 0).sum()))
+
+
+if __name__ == '__main__':
+  main()
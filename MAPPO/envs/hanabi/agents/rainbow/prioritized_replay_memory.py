@@ -118,12 +118,15 @@ class OutOfGraphPrioritizedReplayMemory(replay_memory.OutOfGraphReplayMemory):
     allowed_attempts = replay_memory.MAX_SAMPLE_ATTEMPTS
 
     while len(indices) < batch_size and allowed_attempts > 0:
-      index = self.sum_tree.sample()
-
-      if self.is_valid_transition(index):
-        indices.append(index)
-      else:
-        allowed_attempts -= 1
+      # Draw all the missing indices in one pass through the sum tree, then
+      # keep the valid ones in order, as if they had been drawn one at a time.
+      for index in self.sum_tree.sample_batch(batch_size - len(indices)):
+        if self.is_valid_transition(index):
+          indices.append(int(index))
+        else:
+          allowed_attempts -= 1
+          if allowed_attempts == 0:
+            break
 
     if len(indices) != batch_size:
       raise Exception('Could only sample {} valid transitions'.format(
@@ -140,8 +143,7 @@ class OutOfGraphPrioritizedReplayMemory(replay_memory.OutOfGraphReplayMemory):
     """
     assert indices.dtype == np.int32, ('Indices must be integers, '
                                        'given: {}'.format(indices.dtype))
-    for i, memory_index in enumerate(indices):
-      self.sum_tree.set(memory_index, priorities[i])
+    self.sum_tree.set(indices, np.asarray(priorities)[:len(indices)])
 
   def get_priority(self, indices, batch_size=None):
     """Fetches the priorities correspond to a batch of memory indices.
@@ -163,8 +165,7 @@ class OutOfGraphPrioritizedReplayMemory(replay_memory.OutOfGraphReplayMemory):
 
     assert indices.dtype == np.int32, ('Indices must be integers, '
                                        'given: {}'.format(indices.dtype))
-    for i, memory_index in enumerate(indices):
-      priority_batch[i] = self.sum_tree.get(memory_index)
+    priority_batch[:len(indices)] = self.sum_tree.get(indices)
 
     return priority_batch
 
@@ -22,7 +22,6 @@ from __future__ import division
 from __future__ import print_function
 
 import math
-import random
 
 import numpy as np
 
@@ -52,14 +51,15 @@ class SumTree(object):
   |0.5|     |1.0|  |0.5|     |0.5|
   +---+     +---+  +---+     +---+
 
-  This is stored in a list of numpy arrays:
-  self.nodes = [ [2.5], [1.5, 1], [0.5, 1, 0.5, 0.5] ]
+  This is stored in a single flat numpy array, level by level:
+  self.nodes = [2.5, 1.5, 1, 0.5, 1, 0.5, 0.5]
 
-  For conciseness, we allocate arrays as powers of two, and pad the excess
-  elements with zero values.
+  so node i has children 2i + 1 and 2i + 2, and the leaves are the last
+  elements. The number of leaves is rounded up to a power of two, and the
+  excess leaves are padded with zero values.
 
-  This is similar to the usual array-based representation of a complete binary
-  tree, but is a little more user-friendly.
+  Sampling and updates accept batches of indices: all of them walk down (or up)
+  the tree together, with one vectorized numpy step per level of the tree.
   """
 
   def __init__(self, capacity):
@@ -77,14 +77,10 @@ class SumTree(object):
       raise ValueError('Sum tree capacity should be positive. Got: {}'.
                        format(capacity))
 
-    self.nodes = []
-    tree_depth = int(math.ceil(np.log2(capacity)))
-    level_size = 1
-    for _ in range(tree_depth + 1):
-      nodes_at_this_depth = np.zeros(level_size)
-      self.nodes.append(nodes_at_this_depth)
-
-      level_size *= 2
+    self.depth = int(math.ceil(np.log2(capacity)))
+    # Index of the first leaf in self.nodes.
+    self.leaf_offset = 2 ** self.depth - 1
+    self.nodes = np.zeros(2 * self.leaf_offset + 1)
 
     self.max_recorded_priority = 1.0
 
@@ -94,7 +90,41 @@ class SumTree(object):
     Returns:
       float, sum of priorities stored in this sum tree.
     """
-    return self.nodes[0][0]
+    return self.nodes[0]
+
+  def _find(self, query_values):
+    """Returns the leaves whose prefix sum range holds each query value.
+
+    Args:
+      query_values: `np.array` of floats in [0, R), where R is the value stored
+        at the root.
+
+    Returns:
+      `np.array` of ints, the element index for each query value.
+    """
+    query_values = np.array(query_values, dtype=np.float64)
+    node_indices = self._descend(query_values.copy(), check_right=False)
+    # Each subtree describes a range [0, a), where a is its value. Rounding can
+    # leave a query at the end of the range and so step into an empty subtree,
+    # descend again for those queries, never stepping into one.
+    empty = self.nodes[node_indices] == 0
+    if empty.any():
+      node_indices[empty] = self._descend(query_values[empty], check_right=True)
+    return node_indices - self.leaf_offset
+
+  def _descend(self, query_values, check_right):
+    """Walks query_values down to the leaves, modifying them in place."""
+    node_indices = np.zeros(query_values.shape, dtype=np.int64)
+    for _ in range(self.depth):
+      left_children = 2 * node_indices + 1
+      left_sums = self.nodes[left_children]
+      go_right = query_values >= left_sums
+      if check_right:
+        go_right &= self.nodes[left_children + 1] > 0
+      # Adjust queries to be relative to the right subtree.
+      query_values -= left_sums * go_right
+      node_indices = left_children + go_right
+    return node_indices
 
   def sample(self, query_value=None):
     """Samples an element from the sum tree.
@@ -120,25 +150,27 @@ class SumTree(object):
       raise ValueError('query_value must be in [0, 1].')
 
     # Sample a value in range [0, R), where R is the value stored at the root.
-    query_value = random.random() if query_value is None else query_value
-    query_value *= self._total_priority()
-
-    # Now traverse the sum tree.
-    node_index = 0
-    for nodes_at_this_depth in self.nodes[1:]:
-      # Compute children of previous depth's node.
-      left_child = node_index * 2
-
-      left_sum = nodes_at_this_depth[left_child]
-      # Each subtree describes a range [0, a), where a is its value.
-      if query_value < left_sum:  # Recurse into left subtree.
-        node_index = left_child
-      else:  # Recurse into right subtree.
-        node_index = left_child + 1
-        # Adjust query to be relative to right subtree.
-        query_value -= left_sum
-
-    return node_index
+    query_value = np.random.random() if query_value is None else query_value
+    return int(self._find([query_value * self._total_priority()])[0])
+
+  def sample_batch(self, batch_size):
+    """Samples batch_size independent elements from the sum tree.
+
+    Same distribution as batch_size calls to sample().
+
+    Args:
+      batch_size: int, the number of elements to sample.
+    Returns:
+      `np.array` of batch_size elements sampled from the sum tree.
+
+    Raises:
+      Exception: If the sum tree is empty (i.e. its node values sum to 0).
+    """
+    if self._total_priority() == 0.0:
+      raise Exception('Cannot sample from an empty sum tree.')
+
+    query_values = np.random.random(batch_size)
+    return self._find(query_values * self._total_priority())
 
   def stratified_sample(self, batch_size):
     """Performs stratified sampling using the sum tree.
@@ -151,7 +183,7 @@ class SumTree(object):
     Args:
       batch_size: int, the number of strata to use.
     Returns:
-      list of batch_size elements sampled from the sum tree.
+      `np.array` of batch_size elements sampled from the sum tree.
 
     Raises:
       Exception: If the sum tree is empty (i.e. its node values sum to 0).
@@ -161,45 +193,57 @@ class SumTree(object):
 
     bounds = np.linspace(0., 1., batch_size + 1)
     assert len(bounds) == batch_size + 1
-    segments = [(bounds[i], bounds[i+1]) for i in range(batch_size)]
-    query_values = [random.uniform(x[0], x[1]) for x in segments]
-    return [self.sample(query_value=x) for x in query_values]
+    query_values = np.random.uniform(bounds[:-1], bounds[1:])
+    return self._find(query_values * self._total_priority())
 
   def get(self, node_index):
     """Returns the value of the leaf node corresponding to the index.
 
     Args:
-      node_index: The index of the leaf node.
+      node_index: The index of the leaf node, or an `np.array` of them.
     Returns:
-      The value of the leaf node.
+      The value of the leaf node, or an `np.array` of them.
     """
-    return self.nodes[-1][node_index]
+    return self.nodes[self.leaf_offset + node_index]
 
   def set(self, node_index, value):
-    """Sets the value of a leaf node and updates internal nodes accordingly.
+    """Sets the value of leaf nodes and updates internal nodes accordingly.
+
+    This operation takes O(log(capacity)) vectorized steps. If an index is given
+    more than once, the last of its values is kept, as with one call per index.
 
-    This operation takes O(log(capacity)).
     Args:
-      node_index: int, the index of the leaf node to be updated.
-      value: float, the value which we assign to the node. This value must be
-        nonnegative. Setting value = 0 will cause the element to never be
-        sampled.
+      node_index: int or `np.array` of ints, the indices of the leaf nodes to be
+        updated.
+      value: float or `np.array` of floats, the values which we assign to the
+        nodes. They must be nonnegative. Setting value = 0 will cause the
+        element to never be sampled.
 
     Raises:
-      ValueError: If the given value is negative.
+      ValueError: If a given value is negative.
     """
-    if value < 0.0:
+    node_index = np.asarray(node_index).reshape(-1)
+    value = np.broadcast_to(np.asarray(value, dtype=np.float64),
+                            node_index.shape)
+    if (value < 0.0).any():
       raise ValueError('Sum tree values should be nonnegative. Got {}'.
-                       format(value))
-    self.max_recorded_priority = max(value, self.max_recorded_priority)
-
-    delta_value = value - self.nodes[-1][node_index]
-
-    # Now traverse back the tree, adjusting all sums along the way.
-    for nodes_at_this_depth in reversed(self.nodes):
-      # Note: Adding a delta leads to some tolerable numerical inaccuracies.
-      nodes_at_this_depth[node_index] += delta_value
-      node_index //= 2
-
-    assert node_index == 0, ('Sum tree traversal failed, final node index '
-                             'is not 0.')
+                       format(value.min()))
+    if value.size == 0:
+      return
+    self.max_recorded_priority = max(value.max(), self.max_recorded_priority)
+
+    # np.unique keeps the first occurrence of an index, so look from the end.
+    node_index, last = np.unique(node_index[::-1], return_index=True)
+    node_index = node_index + self.leaf_offset
+    self.nodes[node_index] = value[::-1][last]
+
+    # Now traverse back the tree, recomputing the sums along the way. Indices
+    # that meet at a parent recompute the same sum, so they need no dedupe.
+    for _ in range(self.depth):
+      node_index = (node_index - 1) >> 1
+      left_children = 2 * node_index + 1
+      self.nodes[node_index] = (self.nodes[left_children] +
+                                self.nodes[left_children + 1])
+
+    assert (node_index == 0).all(), (
+        'Sum tree traversal failed, final node index is not 0.')
@@ -14,12 +14,14 @@
 
 #include "pyhanabi.h"
 
+#include <algorithm>
 #include <cstdlib>
 #include <cstring>
 #include <iostream>
 #include <memory>
 #include <string>
 #include <unordered_map>
+#include <vector>
 
 #include "hanabi_lib/canonical_encoders.h"
 #include "hanabi_lib/hanabi_card.h"
@@ -31,6 +33,48 @@
 #include "hanabi_lib/observation_encoder.h"
 #include "hanabi_lib/util.h"
 
+namespace {
+
+/* What a pyhanabi_state_batch_t points to. */
+struct StateBatch {
+  const hanabi_learning_env::HanabiGame* game;
+  std::vector<std::unique_ptr<hanabi_learning_env::HanabiState>> states;
+};
+
+StateBatch* GetStateBatch(pyhanabi_state_batch_t* batch) {
+  REQUIRE(batch != nullptr);
+  REQUIRE(batch->batch != nullptr);
+  return reinterpret_cast<StateBatch*>(batch->batch);
+}
+
+/* Deals cards until a player is to act, as rl_env does after every move. */
+void DealChanceCards(hanabi_learning_env::HanabiState* state) {
+  while (state->CurPlayer() == hanabi_learning_env::kChancePlayerId) {
+    state->ApplyRandomChance();
+  }
+}
+
+/* Writes the canonical encoding (own hand encoding if own_hand) of an
+ * observation into out, one element per bit. */
+template <typename T>
+void EncodeInto(pyhanabi_observation_encoder_t* encoder,
+                pyhanabi_observation_t* observation, bool own_hand, T* out) {
+  REQUIRE(encoder != nullptr);
+  REQUIRE(encoder->encoder != nullptr);
+  REQUIRE(observation != nullptr);
+  REQUIRE(observation->observation != nullptr);
+  REQUIRE(out != nullptr);
+  auto obs_enc = reinterpret_cast<hanabi_learning_env::ObservationEncoder*>(
+      encoder->encoder);
+  auto obs = reinterpret_cast<hanabi_learning_env::HanabiObservation*>(
+      observation->observation);
+  std::vector<int> encoding =
+      own_hand ? obs_enc->EncodeOwnHand(*obs) : obs_enc->Encode(*obs);
+  std::copy(encoding.begin(), encoding.end(), out);
+}
+
+}  // namespace
+
 extern "C" {
 
 /* Helpers. */
@@ -894,4 +938,141 @@ char* EncodeOwnHandObservation(pyhanabi_observation_encoder_t* encoder,
   return strdup(obs_str.c_str());
 }
 
+void EncodeObservationFloat(pyhanabi_observation_encoder_t* encoder,
+                            pyhanabi_observation_t* observation, float* out) {
+  EncodeInto(encoder, observation, false, out);
+}
+
+void EncodeObservationBytes(pyhanabi_observation_encoder_t* encoder,
+                            pyhanabi_observation_t* observation,
+                            unsigned char* out) {
+  EncodeInto(encoder, observation, false, out);
+}
+
+void EncodeOwnHandObservationFloat(pyhanabi_observation_encoder_t* encoder,
+                                   pyhanabi_observation_t* observation,
+                                   float* out) {
+  EncodeInto(encoder, observation, true, out);
+}
+
+void EncodeOwnHandObservationBytes(pyhanabi_observation_encoder_t* encoder,
+                                   pyhanabi_observation_t* observation,
+                                   unsigned char* out) {
+  EncodeInto(encoder, observation, true, out);
+}
+
+/* Wrapper definitions for a batch of HanabiStates. */
+void NewStateBatch(pyhanabi_game_t* game, int num_states,
+                   pyhanabi_state_batch_t* batch) {
+  REQUIRE(batch != nullptr);
+  REQUIRE(game != nullptr);
+  REQUIRE(game->game != nullptr);
+  REQUIRE(num_states > 0);
+  auto state_batch = new StateBatch();
+  state_batch->game =
+      static_cast<const hanabi_learning_env::HanabiGame*>(game->game);
+  state_batch->states.resize(num_states);
+  batch->batch = state_batch;
+  batch->num_states = num_states;
+  StateBatchReset(batch, nullptr);
+}
+
+void DeleteStateBatch(pyhanabi_state_batch_t* batch) {
+  delete GetStateBatch(batch);
+  batch->batch = nullptr;
+  batch->num_states = 0;
+}
+
+void StateBatchReset(pyhanabi_state_batch_t* batch, const unsigned char* mask) {
+  auto state_batch = GetStateBatch(batch);
+  for (int i = 0; i < batch->num_states; i++) {
+    if (mask != nullptr && !mask[i]) {
+      continue;
+    }
+    state_batch->states[i].reset(
+        new hanabi_learning_env::HanabiState(state_batch->game));
+    DealChanceCards(state_batch->states[i].get());
+  }
+}
+
+void StateBatchApplyMoves(pyhanabi_state_batch_t* batch, const int* move_uids,
+                          const unsigned char* mask, int* rewards,
+                          unsigned char* dones) {
+  auto state_batch = GetStateBatch(batch);
+  REQUIRE(move_uids != nullptr);
+  for (int i = 0; i < batch->num_states; i++) {
+    if (mask != nullptr && !mask[i]) {
+      continue;
+    }
+    auto state = state_batch->states[i].get();
+    auto move = state_batch->game->GetMove(move_uids[i]);
+    REQUIRE(state->MoveIsLegal(move));
+    int last_score = state->Score();
+    state->ApplyMove(move);
+    DealChanceCards(state);
+    if (rewards != nullptr) {
+      rewards[i] = state->Score() - last_score;
+    }
+    if (dones != nullptr) {
+      dones[i] = state->IsTerminal();
+    }
+  }
+}
+
+void StateBatchCurPlayers(pyhanabi_state_batch_t* batch, int* cur_players) {
+  auto state_batch = GetStateBatch(batch);
+  REQUIRE(cur_players != nullptr);
+  for (int i = 0; i < batch->num_states; i++) {
+    cur_players[i] = state_batch->states[i]->CurPlayer();
+  }
+}
+
+void StateBatchScores(pyhanabi_state_batch_t* batch, int* scores) {
+  auto state_batch = GetStateBatch(batch);
+  REQUIRE(scores != nullptr);
+  for (int i = 0; i < batch->num_states; i++) {
+    scores[i] = state_batch->states[i]->Score();
+  }
+}
+
+void StateBatchEncode(pyhanabi_state_batch_t* batch,
+                      pyhanabi_observation_encoder_t* encoder,
+                      const unsigned char* mask, float* observations,
+                      float* own_hands, float* legal_moves) {
+  auto state_batch = GetStateBatch(batch);
+  REQUIRE(encoder != nullptr);
+  REQUIRE(encoder->encoder != nullptr);
+  auto obs_enc = reinterpret_cast<hanabi_learning_env::ObservationEncoder*>(
+      encoder->encoder);
+  int num_players = state_batch->game->NumPlayers();
+  int max_moves = state_batch->game->MaxMoves();
+  for (int i = 0; i < batch->num_states; i++) {
+    if (mask != nullptr && !mask[i]) {
+      continue;
+    }
+    for (int player = 0; player < num_players; player++) {
+      int row = i * num_players + player;
+      hanabi_learning_env::HanabiObservation obs(*state_batch->states[i],
+                                                 player);
+      if (observations != nullptr) {
+        std::vector<int> encoding = obs_enc->Encode(obs);
+        std::copy(encoding.begin(), encoding.end(),
+                  observations + row * encoding.size());
+      }
+      if (own_hands != nullptr) {
+        std::vector<int> encoding = obs_enc->EncodeOwnHand(obs);
+        std::copy(encoding.begin(), encoding.end(),
+                  own_hands + row * encoding.size());
+      }
+      if (legal_moves != nullptr) {
+        float* legal = legal_moves + row * max_moves;
+        std::fill(legal, legal + max_moves, 0.0f);
+        for (const auto& move : obs.LegalMoves()) {
+          legal[state_batch->game->GetMoveUid(move)] = 1.0f;
+        }
+      }
+    }
+  }
+}
+
 } /* extern "C" */
@@ -63,6 +63,12 @@ typedef struct PyHanabiObservationEncoder {
   void* encoder;
 } pyhanabi_observation_encoder_t;
 
+typedef struct PyHanabiStateBatch {
+  /* Points to the game states of a batch, see pyhanabi.cc. */
+  void* batch;
+  int num_states;
+} pyhanabi_state_batch_t;
+
 /* Utility Functions. */
 void DeleteString(char* str);
 
@@ -191,6 +197,35 @@ char* EncodeObservation(pyhanabi_observation_encoder_t* encoder,
                         pyhanabi_observation_t* observation);
 char* EncodeOwnHandObservation(pyhanabi_observation_encoder_t* encoder,
                         pyhanabi_observation_t* observation);
+/* Write the encoding into out, one element per bit, instead of a string. */
+void EncodeObservationFloat(pyhanabi_observation_encoder_t* encoder,
+                            pyhanabi_observation_t* observation, float* out);
+void EncodeObservationBytes(pyhanabi_observation_encoder_t* encoder,
+                            pyhanabi_observation_t* observation,
+                            unsigned char* out);
+void EncodeOwnHandObservationFloat(pyhanabi_observation_encoder_t* encoder,
+                                   pyhanabi_observation_t* observation,
+                                   float* out);
+void EncodeOwnHandObservationBytes(pyhanabi_observation_encoder_t* encoder,
+                                   pyhanabi_observation_t* observation,
+                                   unsigned char* out);
+
+/* StateBatch functions, one call for all the states of a batch.
+ * Arrays have one entry per state (or per state and player, state major);
+ * mask entries of 0 leave the state untouched. */
+void NewStateBatch(pyhanabi_game_t* game, int num_states,
+                   pyhanabi_state_batch_t* batch);
+void DeleteStateBatch(pyhanabi_state_batch_t* batch);
+void StateBatchReset(pyhanabi_state_batch_t* batch, const unsigned char* mask);
+void StateBatchApplyMoves(pyhanabi_state_batch_t* batch, const int* move_uids,
+                          const unsigned char* mask, int* rewards,
+                          unsigned char* dones);
+void StateBatchCurPlayers(pyhanabi_state_batch_t* batch, int* cur_players);
+void StateBatchScores(pyhanabi_state_batch_t* batch, int* scores);
+void StateBatchEncode(pyhanabi_state_batch_t* batch,
+                      pyhanabi_observation_encoder_t* encoder,
+                      const unsigned char* mask, float* observations,
+                      float* own_hands, float* legal_moves);
 
 } /* extern "C" */
 
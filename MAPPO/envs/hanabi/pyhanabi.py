@@ -18,6 +18,7 @@ import re
 import cffi
 import enum
 import sys
+import numpy as np
 
 DEFAULT_CDEF_PREFIXES = (None, ".", os.path.dirname(__file__), "/include")
 DEFAULT_LIB_PREFIXES = (None, ".", os.path.dirname(__file__), "/lib")
@@ -945,6 +946,9 @@ class ObservationEncoder(object):
     self._game = game.c_game
     self._encoder = ffi.new("pyhanabi_observation_encoder_t*")
     lib.NewObservationEncoder(self._encoder, self._game, enc_type)
+    # Lengths of the encodings, to check the buffers given to encode_into.
+    self._size = int(np.prod(ObservationEncoder.shape(self)))
+    self._ownhand_size = int(np.prod(ObservationEncoder.ownhandshape(self)))
 
   def __del__(self):
     if self._encoder is not None:
@@ -969,25 +973,174 @@ class ObservationEncoder(object):
 
   def encode(self, observation):
     """Encode the observation as a sequence of bits."""
-    c_encoding_str = lib.EncodeObservation(self._encoder,
-                                           observation.observation())
-    encoding_string = encode_ffi_string(c_encoding_str)
-    lib.DeleteString(c_encoding_str)
-    # Canonical observations are bit strings, so it is ok to encode using a
-    # string. For float or double observations, make a custom object
-    encoding = [int(x) for x in encoding_string.split(",")]
-    return encoding
+    encoding = np.empty(self._size, dtype=np.uint8)
+    return self.encode_into(observation, encoding).tolist()
 
   def encodeownhand(self, observation):
     """Encode the observation as a sequence of bits."""
-    c_encoding_str = lib.EncodeOwnHandObservation(self._encoder,
-                                           observation.observation())
-    encoding_string = encode_ffi_string(c_encoding_str)
-    lib.DeleteString(c_encoding_str)
-    # Canonical observations are bit strings, so it is ok to encode using a
-    # string. For float or double observations, make a custom object
-    encoding = [int(x) for x in encoding_string.split(",")]
-    return encoding
+    encoding = np.empty(self._ownhand_size, dtype=np.uint8)
+    return self.encodeownhand_into(observation, encoding).tolist()
+
+  def encode_into(self, observation, out):
+    """Encode the observation into out, one element per bit, and return it.
+
+    out is a C-contiguous np.float32 or np.uint8 array with one element per
+    bit, which the C++ encoder writes directly.
+    """
+    self._encode_into(lib.EncodeObservationFloat, lib.EncodeObservationBytes,
+                      self._size, observation, out)
+    return out
+
+  def encodeownhand_into(self, observation, out):
+    """Encode the own hand observation into out, see encode_into."""
+    self._encode_into(lib.EncodeOwnHandObservationFloat,
+                      lib.EncodeOwnHandObservationBytes, self._ownhand_size,
+                      observation, out)
+    return out
+
+  def _encode_into(self, encode_float, encode_bytes, size, observation, out):
+    if out.dtype == np.float32:
+      encode, c_type = encode_float, "float[]"
+    elif out.dtype == np.uint8:
+      encode, c_type = encode_bytes, "unsigned char[]"
+    else:
+      raise ValueError("Expected a float32 or uint8 array, got {}".format(
+          out.dtype.name))
+    if out.size != size or not out.flags.c_contiguous:
+      raise ValueError("Expected a C-contiguous array of {} elements, got "
+                       "shape {}".format(size, out.shape))
+    encode(self._encoder, observation.observation(),
+           ffi.from_buffer(c_type, out))
+
+
+class HanabiStateBatch(object):
+  """A batch of game states of the same game, stepped together.
+
+  Every method makes a single call into C++ for all the states and reads or
+  writes NumPy arrays with one entry per state (or per state and player)
+  instead of HanabiMove and HanabiObservation objects, so one process can
+  host many games. Chance events are resolved in C++: after reset and
+  apply_moves every state is at a player's turn or over.
+
+  Mask arguments select the states a call touches, None selects all of them.
+  Output arrays are created when not given; given ones must be C-contiguous
+  with the documented dtype and shape and are written in place.
+  """
+
+  def __init__(self, game, num_states):
+    """Returns num_states new games, with their cards dealt.
+
+    Args:
+      game: HanabiGame describing the parameters of all the games.
+      num_states: int, the number of games.
+    """
+    self._game = game.c_game
+    self.num_states = num_states
+    self.num_players = game.num_players()
+    self.max_moves = game.max_moves()
+    self._batch = ffi.new("pyhanabi_state_batch_t*")
+    lib.NewStateBatch(self._game, num_states, self._batch)
+
+  def __del__(self):
+    if self._batch is not None:
+      lib.DeleteStateBatch(self._batch)
+      self._batch = None
+      self._game = None
+    del self
+
+  def reset(self, mask=None):
+    """Starts new games in the masked states."""
+    mask = self._mask(mask)
+    lib.StateBatchReset(self._batch, _c_pointer("unsigned char *", mask))
+
+  def apply_moves(self, move_uids, mask=None, rewards=None, dones=None):
+    """Applies one move uid per state for its acting player.
+
+    Args:
+      move_uids: [num_states] ints, ignored for states outside the mask.
+      mask: optional [num_states] bools, the states to step.
+      rewards: optional [num_states] np.intc output, score differentials.
+      dones: optional [num_states] np.uint8 output, whether the game is over.
+
+    Returns:
+      rewards, dones. Entries outside the mask are left as they were.
+    """
+    move_uids = np.ascontiguousarray(move_uids, dtype=np.intc)
+    mask = self._mask(mask)
+    rewards = self._out(rewards, np.intc, (self.num_states,))
+    dones = self._out(dones, np.uint8, (self.num_states,))
+    lib.StateBatchApplyMoves(self._batch, _c_pointer("int *", move_uids),
+                             _c_pointer("unsigned char *", mask),
+                             _c_pointer("int *", rewards),
+                             _c_pointer("unsigned char *", dones))
+    return rewards, dones
+
+  def cur_players(self, out=None):
+    """Returns the [num_states] players to act (np.intc)."""
+    out = self._out(out, np.intc, (self.num_states,))
+    lib.StateBatchCurPlayers(self._batch, _c_pointer("int *", out))
+    return out
+
+  def scores(self, out=None):
+    """Returns the [num_states] current scores (np.intc)."""
+    out = self._out(out, np.intc, (self.num_states,))
+    lib.StateBatchScores(self._batch, _c_pointer("int *", out))
+    return out
+
+  def encode(self, encoder, observations, own_hands=None, legal_moves=None,
+             mask=None):
+    """Writes every player's view of the masked states.
+
+    Args:
+      encoder: ObservationEncoder of the game.
+      observations: [num_states, num_players, encoder.shape()[0]] np.float32
+        output, the encoded observations, or None to skip them.
+      own_hands: optional [num_states, num_players, encoder.ownhandshape()[0]]
+        np.float32 output, the encoded own hands.
+      legal_moves: optional [num_states, num_players, max_moves] np.float32
+        output, 1 at the uids of the legal moves (only the acting player has
+        any).
+      mask: optional [num_states] bools, the states to encode.
+    """
+    leading = (self.num_states, self.num_players)
+    if observations is not None:
+      self._out(observations, np.float32, leading + tuple(encoder.shape()))
+    if own_hands is not None:
+      self._out(own_hands, np.float32, leading + tuple(encoder.ownhandshape()))
+    if legal_moves is not None:
+      self._out(legal_moves, np.float32, leading + (self.max_moves,))
+    mask = self._mask(mask)
+    lib.StateBatchEncode(self._batch, encoder._encoder,
+                         _c_pointer("unsigned char *", mask),
+                         _c_pointer("float *", observations),
+                         _c_pointer("float *", own_hands),
+                         _c_pointer("float *", legal_moves))
+
+  def _mask(self, mask):
+    if mask is None:
+      return None
+    mask = np.ascontiguousarray(mask, dtype=np.uint8)
+    if mask.shape != (self.num_states,):
+      raise ValueError("Expected a mask of shape {}, got {}".format(
+          (self.num_states,), mask.shape))
+    return mask
+
+  def _out(self, out, dtype, shape):
+    if out is None:
+      return np.zeros(shape, dtype=dtype)
+    if (out.dtype != dtype or out.shape != shape or
+        not out.flags.c_contiguous):
+      raise ValueError("Expected a C-contiguous {} array of shape {}, got {} "
+                       "of shape {}".format(np.dtype(dtype).name, shape,
+                                            out.dtype.name, out.shape))
+    return out
+
+
+def _c_pointer(c_type, array):
+  """C pointer to the data of a contiguous numpy array, NULL for None."""
+  if array is None:
+    return ffi.NULL
+  return ffi.cast(c_type, array.ctypes.data)
 
 
 try_cdef()
@@ -161,6 +161,12 @@ class HanabiEnv(Environment):
         self.action_space.append(Discrete(self.num_moves()))
         self.observation_space.append([self.vectorized_observation_shape()[0]+self.players])
         self.share_observation_space.append([self.vectorized_share_observation_shape()[0]+self.players]) 
+
+    # step() and reset() fill these in place straight from the encoders and return copies, the dict view of the
+    # observations (_make_observation_all_players) is only built when asked for
+    self._obs = np.zeros((self.players, self.vectorized_observation_shape()[0] + self.players), dtype=np.float32)
+    self._share_obs = np.zeros((self.players, self.vectorized_share_observation_shape()[0] + self.players), dtype=np.float32)
+    self._available_actions = np.zeros((self.players, self.num_moves()), dtype=np.float32)
   def reset(self, choose=True):
     """Resets the environment for a new game.
 
@@ -267,18 +273,7 @@ class HanabiEnv(Environment):
         while self.state.cur_player() == pyhanabi.CHANCE_PLAYER_ID:
           self.state.deal_random_card()
     
-        observation = self._make_observation_all_players()
-        observation["current_player"] = self.state.cur_player()
-        agent_turn=np.zeros(self.players).astype(np.int).tolist()
-        agent_turn[self.state.cur_player()]=1
-       
-        obs=[]
-        share_obs=[]
-        available_actions = np.zeros((self.players,self.num_moves())) 
-        for i in range(self.players): 
-          obs.append(observation['player_observations'][i]['vectorized']+agent_turn)
-          share_obs.append(observation['player_observations'][i]['vectorized_ownhand']+observation['player_observations'][i]['vectorized']+agent_turn)
-          available_actions[i][observation['player_observations'][i]['legal_moves_as_int']]=1.0
+        obs, share_obs, available_actions = self._copy_observations()
     else:
         obs = np.zeros((self.players,self.vectorized_observation_shape()[0]+self.players))
         share_obs = np.zeros((self.players, self.vectorized_share_observation_shape()[0]+self.players))
@@ -444,17 +439,8 @@ class HanabiEnv(Environment):
     while self.state.cur_player() == pyhanabi.CHANCE_PLAYER_ID:
       self.state.deal_random_card()
 
-    observation = self._make_observation_all_players()
-    obs = []
-    share_obs = []
-    available_actions = np.zeros((self.players,self.num_moves()))
-    agent_turn=np.zeros(self.players).astype(np.int).tolist()
-    agent_turn[self.state.cur_player()]=1
-    for i in range(self.players):
-      obs.append(observation['player_observations'][i]['vectorized'] + agent_turn)
-      share_obs.append(observation['player_observations'][i]['vectorized_ownhand']+observation['player_observations'][i]['vectorized']+agent_turn)
-      available_actions[i][observation['player_observations'][i]['legal_moves_as_int']]=1.0
-      
+    obs, share_obs, available_actions = self._copy_observations()
+
     done = self.state.is_terminal()
     # Reward is score differential. May be large and negative at game end.
     reward = self.state.score() - last_score
@@ -463,6 +449,40 @@ class HanabiEnv(Environment):
     
     return obs, share_obs, rewards, done, infos, available_actions
 
+  def _fill_observations(self):
+    """Fill the obs, share_obs and available_actions buffers of all players in place.
+
+    Same values as building them from _make_observation_all_players: obs is the
+    vectorized observation, share_obs the own hand then the vectorized observation,
+    both followed by the one-hot current player. The buffers are reused by the
+    next call, step() and reset() hand out copies of them (_copy_observations).
+    """
+    obs_dim = self._obs.shape[1] - self.players
+    ownhand_dim = self._share_obs.shape[1] - obs_dim - self.players
+    agent_turn = np.zeros(self.players, dtype=np.float32)
+    agent_turn[self.state.cur_player()] = 1.0
+    self._available_actions.fill(0.0)
+    for i in range(self.players):
+      observation = self.state.observation(i)
+      self.observation_encoder.encode_into(observation, self._obs[i, :obs_dim])
+      self.observation_encoder.encodeownhand_into(observation, self._share_obs[i, :ownhand_dim])
+      # only the current player has legal moves
+      for move in observation.legal_moves():
+        self._available_actions[i, self.game.get_move_uid(move)] = 1.0
+    self._share_obs[:, ownhand_dim:ownhand_dim + obs_dim] = self._obs[:, :obs_dim]
+    self._obs[:, obs_dim:] = agent_turn
+    self._share_obs[:, ownhand_dim + obs_dim:] = agent_turn
+    return self._obs, self._share_obs, self._available_actions
+
+  def _copy_observations(self):
+    """_fill_observations, returning copies that the next step() or reset() leaves alone.
+
+    A caller may keep what step() returned across a reset(), e.g. the terminal
+    observation of a game that an env worker resets before sending it.
+    """
+    obs, share_obs, available_actions = self._fill_observations()
+    return obs.copy(), share_obs.copy(), available_actions.copy()
+
   def _make_observation_all_players(self):
     """Make observation for all players.
 
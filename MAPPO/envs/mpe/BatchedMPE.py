@@ -0,0 +1,197 @@
+import numpy as np
+import multiprocessing as mp
+from baselines.common.vec_env import VecEnv, CloudpickleWrapper
+from .core import WorldBatch
+from .multi_discrete import MultiDiscrete
+
+class BatchedMPEEnv(VecEnv):
+    """
+    Vec env stepping the worlds of len(env_fns) MPE envs (MPEEnv, same scenario) together in this
+    process, as one WorldBatch. reset() and step() return the same arrays as SubprocVecEnv
+    (obs, rewards, dones, infos, available_actions) and done envs are reset automatically.
+    Scenarios with vectorized_worlds compute the rewards and observations of all worlds at once,
+    the others world by world from the batched distances.
+    """
+    def __init__(self, env_fns):
+        self.envs = [fn() for fn in env_fns]
+        env = self.envs[0]
+        VecEnv.__init__(self, len(env_fns), env.observation_space, env.action_space)
+        if not env.discrete_action_space or env.discrete_action_input:
+            raise NotImplementedError("BatchedMPEEnv only supports one-hot discrete actions.")
+        self.world = WorldBatch([env.world for env in self.envs])
+        self.scenario_vectorized = env.observations_callback is not None and \
+            getattr(env.observations_callback.__self__, 'vectorized_worlds', False)
+        self.num_agents = len(self.world.agents)
+        self.world_length = env.world_length
+        self.shared_reward = env.shared_reward
+        self.ts = np.zeros(self.num_envs, dtype='int')
+        self.actions = None
+
+        # where the physical (u) and communication (c) parts of every agent's one-hot action start
+        self.u_offsets = []
+        self.c_offsets = []
+        for agent, action_space in zip(self.world.agents, self.action_space):
+            self.u_offsets.append(0 if agent.movable else None)
+            if agent.silent:
+                self.c_offsets.append(None)
+            elif isinstance(action_space, MultiDiscrete):
+                self.c_offsets.append(int(action_space.high[0] - action_space.low[0] + 1))
+            else:
+                # a single Discrete space holds the 5 movement entries first (MultiAgentEnv._set_action)
+                self.c_offsets.append(5 if agent.movable else 0)
+        self.sensitivity = np.array([5.0 if agent.accel is None else agent.accel for agent in self.world.agents])
+
+    # one-hot env actions, [K, agents, dim] or [K][agents] nested lists --> forces and utterances
+    def _decode_actions(self, actions):
+        u = np.zeros((self.num_envs, self.num_agents, self.world.dim_p))
+        c = np.zeros((self.num_envs, self.num_agents, self.world.dim_c))
+        for i in range(self.num_agents):
+            if isinstance(actions, np.ndarray):
+                action = actions[:, i]
+            else:
+                action = np.stack([env_actions[i] for env_actions in actions])
+            if self.u_offsets[i] is not None:
+                o = self.u_offsets[i]
+                u[:, i, 0] = action[:, o + 1] - action[:, o + 2]
+                u[:, i, 1] = action[:, o + 3] - action[:, o + 4]
+            if self.c_offsets[i] is not None:
+                o = self.c_offsets[i]
+                c[:, i] = action[:, o:o + self.world.dim_c]
+        u *= self.sensitivity[None, :, None]
+        return u, c
+
+    def _rewards(self):
+        if self.scenario_vectorized:
+            return self.envs[0].rewards_callback(self.world)
+        rewards = np.zeros((self.num_envs, self.num_agents))
+        for k, env in enumerate(self.envs):
+            self.world.sync_world(k)
+            rewards[k] = env._get_reward_all()
+        return rewards
+
+    def _obs(self):
+        if self.scenario_vectorized:
+            return self.envs[0].observations_callback(self.world)
+        obs = []
+        for k, env in enumerate(self.envs):
+            self.world.sync_world(k)
+            obs.append(env._get_obs_all())
+        if len(set(np.shape(o) for o in obs[0])) == 1:
+            return np.stack(obs)
+        # agents with different observation sizes
+        obs_n = np.empty((self.num_envs, self.num_agents), dtype=object)
+        for k, o in enumerate(obs):
+            obs_n[k] = list(o)
+        return obs_n
+
+    def _available_actions(self):
+        return np.full((self.num_envs, self.num_agents, 1), None, dtype=object)
+
+    def _reset_worlds(self, indices):
+        for k in indices:
+            env = self.envs[k]
+            env.current_step = 0
+            env.reset_callback(env.world)
+            self.world.reset_world(k)
+            self.ts[k] = 0
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        u, c = self._decode_actions(self.actions)
+        self.actions = None
+        self.world.step(u, c)
+        self.world.calculate_distances()
+        rewards = self._rewards()
+        self.ts += 1
+
+        infos = [[{'individual_reward': r} for r in env_rewards] for env_rewards in rewards]
+        if self.shared_reward:
+            rewards = np.broadcast_to(np.sum(rewards, axis=1, keepdims=True), rewards.shape)
+        dones = np.broadcast_to((self.ts >= self.world_length)[:, None], (self.num_envs, self.num_agents)).copy()
+
+        done_envs = np.flatnonzero(dones[:, 0])
+        if len(done_envs) > 0:
+            self._reset_worlds(done_envs)
+            self.world.calculate_distances()
+        return self._obs(), rewards[..., None].copy(), dones, infos, self._available_actions()
+
+    def reset(self):
+        self._reset_worlds(range(self.num_envs))
+        self.world.calculate_distances()
+        return self._obs(), self._available_actions()
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+def batchedworker(remote, parent_remote, env_fns_wrapper):
+    parent_remote.close()
+    env = BatchedMPEEnv(env_fns_wrapper.x)
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            remote.send(env.step(data))
+        elif cmd == 'reset':
+            remote.send(env.reset())
+        elif cmd == 'close':
+            env.close()
+            remote.close()
+            break
+        elif cmd == 'get_spaces':
+            remote.send((env.observation_space, env.action_space))
+        else:
+            raise NotImplementedError
+
+class ShardedBatchedMPEEnv(VecEnv):
+    """
+    BatchedMPEEnv split into num_shards contiguous groups of envs, each group stepped by its own
+    process. Outputs are concatenated in env order, the same as a single BatchedMPEEnv.
+    """
+    def __init__(self, env_fns, num_shards, context='fork'):
+        self.waiting = False
+        self.closed = False
+        ctx = mp.get_context(context)
+        self.shards = [shard for shard in np.array_split(np.arange(len(env_fns)), num_shards) if len(shard) > 0]
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(len(self.shards))])
+        self.ps = [ctx.Process(target=batchedworker, args=(work_remote, remote, CloudpickleWrapper([env_fns[i] for i in shard])))
+            for (work_remote, remote, shard) in zip(self.work_remotes, self.remotes, self.shards)]
+        for p in self.ps:
+            p.daemon = True # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, action_space = self.remotes[0].recv()
+        VecEnv.__init__(self, len(env_fns), observation_space, action_space)
+
+    def step_async(self, actions):
+        for remote, shard in zip(self.remotes, self.shards):
+            remote.send(('step', actions[shard[0]:shard[-1] + 1]))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, rews, dones, infos, available_actions = zip(*results)
+        return np.concatenate(obs), np.concatenate(rews), np.concatenate(dones), sum(infos, []), np.concatenate(available_actions)
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        results = [remote.recv() for remote in self.remotes]
+        obs, available_actions = zip(*results)
+        return np.concatenate(obs), np.concatenate(available_actions)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
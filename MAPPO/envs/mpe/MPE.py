@@ -25,6 +25,8 @@ def MPEEnv(args):
     # create world
     world = scenario.make_world(args)
     # create multiagent environment 
-    env = MultiAgentEnv(world, scenario.reset_world, scenario.reward, scenario.observation)
+    env = MultiAgentEnv(world, scenario.reset_world, scenario.reward, scenario.observation,
+                        rewards_callback=getattr(scenario, 'rewards_all', None),
+                        observations_callback=getattr(scenario, 'observations_all', None))
 
     return env
@@ -2,13 +2,44 @@ import numpy as np
 import seaborn as sns
 
 # physical/external base state of all entites
+# once the entity has been through World.step, p_pos and p_vel are views of its rows in
+# the world's [E, dim_p] state arrays and assigning to them writes into those rows
 class EntityState(object):
     def __init__(self):
+        self._bound = False
         # physical position
         self.p_pos = None
         # physical velocity
         self.p_vel = None
 
+    @property
+    def p_pos(self):
+        return self._p_pos
+
+    @p_pos.setter
+    def p_pos(self, value):
+        if self._bound and value is not None:
+            self._p_pos[...] = value
+        else:
+            self._p_pos = value
+
+    @property
+    def p_vel(self):
+        return self._p_vel
+
+    @p_vel.setter
+    def p_vel(self, value):
+        if self._bound and value is not None:
+            self._p_vel[...] = value
+        else:
+            self._p_vel = value
+
+    def bind(self, p_pos, p_vel):
+        # p_pos/p_vel: rows of the world state arrays, already holding this entity's state
+        self._p_pos = p_pos
+        self._p_vel = p_vel
+        self._bound = True
+
 # state of agents (including communication and internal/mental state)
 class AgentState(EntityState):
     def __init__(self):
@@ -133,6 +164,10 @@ class World(object):
         self.cache_dists = False
         self.cached_dist_vect = None
         self.cached_dist_mag = None
+        # [E, dim_p] state of all entities, entity.state.p_pos/p_vel are views of their rows
+        self.p_pos = None
+        self.p_vel = None
+        self._state_entities = []
         # zoe 20200420
         self.world_length = 25
         self.world_step = 0
@@ -157,27 +192,14 @@ class World(object):
 
     # 新增函数 计算world中所有entity（包括agent and landmarks）的距离并判断是否collide?    
     def calculate_distances(self):
+        self.bind_state()
         if self.cached_dist_vect is None:
-            # initialize distance data structure
-            self.cached_dist_vect = np.zeros((len(self.entities),
-                                              len(self.entities),
-                                              self.dim_p))
             # calculate minimum distance for a collision between all entities （size相加�?           
-            self.min_dists = np.zeros((len(self.entities), len(self.entities)))
-            for ia, entity_a in enumerate(self.entities):
-                for ib in range(ia + 1, len(self.entities)):
-                    entity_b = self.entities[ib]
-                    min_dist = entity_a.size + entity_b.size
-                    self.min_dists[ia, ib] = min_dist
-                    self.min_dists[ib, ia] = min_dist
+            self.min_dists = self.sizes[:, None] + self.sizes[None, :]
+            np.fill_diagonal(self.min_dists, 0.0)
 
         # cached_dist_vect 保存了两�?entity 之间的每一维坐标差，还未计算距�?        
-        for ia, entity_a in enumerate(self.entities):
-            for ib in range(ia + 1, len(self.entities)):
-                entity_b = self.entities[ib]
-                delta_pos = entity_a.state.p_pos - entity_b.state.p_pos
-                self.cached_dist_vect[ia, ib, :] = delta_pos
-                self.cached_dist_vect[ib, ia, :] = -delta_pos
+        self.cached_dist_vect = self.p_pos[:, None, :] - self.p_pos[None, :, :]
 
         # cached_dist_mag �?cached_dist_vect 中的两两距离求平方开根，得到2维距离矩�?        
         self.cached_dist_mag = np.linalg.norm(self.cached_dist_vect, axis=2)
@@ -185,6 +207,46 @@ class World(object):
         # cached_collisions 是一个二�?/1矩阵�?表示两个 entity 相撞
         self.cached_collisions = (self.cached_dist_mag <= self.min_dists)
 
+    # gather the state of all entities into [E, dim_p] arrays (entities keep views of their rows)
+    # and their physical properties into [E] arrays
+    def bind_state(self):
+        entities = self.entities
+        if len(entities) != len(self._state_entities) or \
+           any(a is not b for a, b in zip(entities, self._state_entities)):
+            p_pos = np.zeros((len(entities), self.dim_p))
+            p_vel = np.zeros((len(entities), self.dim_p))
+            for i, entity in enumerate(entities):
+                if entity.state.p_pos is not None:
+                    p_pos[i] = entity.state.p_pos
+                if entity.state.p_vel is not None:
+                    p_vel[i] = entity.state.p_vel
+            for i, entity in enumerate(entities):
+                entity.state.bind(p_pos[i], p_vel[i])
+            self.p_pos = p_pos
+            self.p_vel = p_vel
+            self._state_entities = entities
+        # properties can be changed by the scenarios at any time
+        self.sizes = np.array([entity.size for entity in entities], dtype=np.float64)
+        self.masses = np.array([entity.mass for entity in entities], dtype=np.float64)
+        self.movable = np.array([entity.movable for entity in entities], dtype=bool)
+        self.collide = np.array([entity.collide for entity in entities], dtype=bool)
+        self.ghost = np.array([entity.ghost for entity in entities], dtype=bool)
+        self.max_speeds = np.array([np.nan if entity.max_speed is None else entity.max_speed for entity in entities], dtype=np.float64)
+
+    # make the [E, dim_p] arrays (e.g. rows of a WorldBatch) this world's state, keeping the current state
+    def use_state(self, p_pos, p_vel):
+        self.bind_state()
+        p_pos[...] = self.p_pos
+        p_vel[...] = self.p_vel
+        for i, entity in enumerate(self._state_entities):
+            entity.state.bind(p_pos[i], p_vel[i])
+        self.p_pos = p_pos
+        self.p_vel = p_vel
+
+    # [agents, dim_c] communication state of all agents
+    def comm_state(self):
+        return np.stack([agent.state.c for agent in self.agents])
+
     # 新增函数
     def assign_agent_colors(self):
         n_dummies = 0
@@ -214,8 +276,9 @@ class World(object):
         # set actions for scripted agents 
         for agent in self.scripted_agents:
             agent.action = agent.action_callback(agent, self)
+        self.bind_state()
         # gather forces applied to entities
-        p_force = [None] * len(self.entities)
+        p_force = np.zeros((len(self.entities), self.dim_p))
         # apply agent physical controls
         p_force = self.apply_action_force(p_force)
         # apply environment forces
@@ -242,42 +305,63 @@ class World(object):
 
     # gather physical forces acting on entities
     # 考虑了两个entity，一个entity和wall相撞的反弹力和外界力
+    # all colliding pairs at once, the forces on every entity are summed in the same order as
+    # the per-pair loop (other entities by index, then walls) so the trajectories do not change
     def apply_environment_force(self, p_force):
-        # simple (but inefficient) collision response
-        for a,entity_a in enumerate(self.entities):
-            for b,entity_b in enumerate(self.entities):
-                if(b <= a): continue
-                [f_a, f_b] = self.get_entity_collision_force(a, b)
-                if(f_a is not None):
-                    if(p_force[a] is None): p_force[a] = 0.0
-                    p_force[a] = f_a + p_force[a] 
-                if(f_b is not None):
-                    if(p_force[b] is None): p_force[b] = 0.0
-                    p_force[b] = f_b + p_force[b]
-            if entity_a.movable:
-                for wall in self.walls:
-                    wf = self.get_wall_collision_force(entity_a, wall)
-                    if wf is not None:
-                        if p_force[a] is None:
-                            p_force[a] = 0.0
-                        p_force[a] = p_force[a] + wf
-        return p_force
+        num_entities = len(self.entities)
+        ia, ib = np.triu_indices(num_entities, 1)
+        # pairs of colliders where at least one entity moves
+        pairs = self.collide[ia] & self.collide[ib] & (self.movable[ia] | self.movable[ib])
+        ia = ia[pairs]
+        ib = ib[pairs]
+        if self.cache_dists:
+            delta_pos = self.cached_dist_vect[ia, ib]
+            dist = self.cached_dist_mag[ia, ib]
+            dist_min = self.min_dists[ia, ib]
+        else:
+            # compute actual distance between entities
+            delta_pos = self.p_pos[ia] - self.p_pos[ib]
+            dist = np.sqrt(np.sum(np.square(delta_pos), axis=1))
+            # minimum allowable distance
+            dist_min = self.sizes[ia] + self.sizes[ib]
+        # softmax penetration
+        k = self.contact_margin
+        penetration = np.logaddexp(0, -(dist - dist_min)/k)*k
+        force = self.contact_force * delta_pos / dist[:, None] * penetration[:, None]
+        # consider mass in collisions when both entities move
+        force_ratio = np.where(self.movable[ia] & self.movable[ib], self.masses[ib] / self.masses[ia], 1.0)
+        force_a = force_ratio[:, None] * force
+        force_b = -(1 / force_ratio)[:, None] * force
+        force_a[~self.movable[ia]] = 0.0
+        force_b[~self.movable[ib]] = 0.0
+
+        # [source, entity, dim_p]: the action force, then the force from every other entity, then every wall
+        forces = np.zeros((1 + num_entities + len(self.walls), num_entities, self.dim_p))
+        forces[0] = p_force
+        forces[1 + ib, ia] = force_a
+        forces[1 + ia, ib] = force_b
+        for w, wall in enumerate(self.walls):
+            wall_force = self.get_wall_collision_forces(wall)
+            wall_force[~self.movable] = 0.0
+            forces[1 + num_entities + w] = wall_force
+        # summed source by source
+        return np.add.reduce(forces, axis=0)
 
     # integrate physical state (对所有entitiy: agent & landmark)
     # 根据 force �?已有速度 p_vel 计算下一次的速度 = p_vel * (1-damping) + (force / m) * dt
     # 根据 p_vel 计算下一次的位置 p_pos = p_vel * dt
     def integrate_state(self, p_force):
-        for i,entity in enumerate(self.entities):
-            if not entity.movable: continue
-            entity.state.p_vel = entity.state.p_vel * (1 - self.damping)
-            if (p_force[i] is not None):
-                entity.state.p_vel += (p_force[i] / entity.mass) * self.dt
-            if entity.max_speed is not None:
-                speed = np.sqrt(np.square(entity.state.p_vel[0]) + np.square(entity.state.p_vel[1]))
-                if speed > entity.max_speed:
-                    entity.state.p_vel = entity.state.p_vel / np.sqrt(np.square(entity.state.p_vel[0]) +
-                                                                  np.square(entity.state.p_vel[1])) * entity.max_speed
-            entity.state.p_pos += entity.state.p_vel * self.dt
+        movable = self.movable
+        p_vel = self.p_vel[movable] * (1 - self.damping)
+        p_vel += (p_force[movable] / self.masses[movable][:, None]) * self.dt
+        max_speed = self.max_speeds[movable]
+        speed = np.sqrt(np.square(p_vel[:, 0]) + np.square(p_vel[:, 1]))
+        # entities without max_speed have nan, which never compares greater
+        clip = speed > max_speed
+        p_vel[clip] = p_vel[clip] / np.sqrt(np.square(p_vel[clip, 0]) +
+                                            np.square(p_vel[clip, 1]))[:, None] * max_speed[clip][:, None]
+        self.p_vel[movable] = p_vel
+        self.p_pos[movable] += p_vel * self.dt
 
     def update_agent_state(self, agent):
         # set communication state (directly for now)
@@ -360,4 +444,165 @@ class World(object):
         force = np.zeros(2)
         force[perp_dim] = np.cos(theta) * force_mag
         force[prll_dim] = np.sin(theta) * np.abs(force_mag)
-        return force
\ No newline at end of file
+        return force
+
+    # get_wall_collision_force for all entities against one wall at once, [E, dim_p] forces
+    # that are zero where the entity does not touch the wall
+    def get_wall_collision_forces(self, wall):
+        if wall.orient == 'H':
+            prll_dim = 0
+            perp_dim = 1
+        else:
+            prll_dim = 1
+            perp_dim = 0
+        ent_pos = self.p_pos
+        size = self.sizes
+        # entity is beyond endpoints of wall, or a ghost passing through a soft wall
+        beyond = (ent_pos[:, prll_dim] < wall.endpoints[0] - size) | (ent_pos[:, prll_dim] > wall.endpoints[1] + size)
+        if not wall.hard:
+            beyond = beyond | self.ghost
+        # part of entity is beyond wall
+        partial = ~beyond & ((ent_pos[:, prll_dim] < wall.endpoints[0]) | (ent_pos[:, prll_dim] > wall.endpoints[1]))
+        dist_past_end = np.where(ent_pos[:, prll_dim] < wall.endpoints[0],
+                                 ent_pos[:, prll_dim] - wall.endpoints[0],
+                                 ent_pos[:, prll_dim] - wall.endpoints[1])
+        with np.errstate(invalid='ignore'):
+            theta = np.where(partial, np.arcsin(dist_past_end / size), 0.0)
+        dist_min = np.where(partial, np.cos(theta) * size + 0.5 * wall.width, size + 0.5 * wall.width)
+
+        # only need to calculate distance in relevant dim
+        delta_pos = ent_pos[:, perp_dim] - wall.axis_pos
+        dist = np.abs(delta_pos)
+        # softmax penetration
+        k = self.contact_margin
+        penetration = np.logaddexp(0, -(dist - dist_min)/k)*k
+        with np.errstate(divide='ignore', invalid='ignore'):
+            force_mag = self.contact_force * delta_pos / dist * penetration
+        force = np.zeros((len(size), 2))
+        force[:, perp_dim] = np.cos(theta) * force_mag
+        force[:, prll_dim] = np.sin(theta) * np.abs(force_mag)
+        force[beyond] = 0.0
+        return force
+
+# K worlds of the same scenario stepped together, the state of their entities stacked as [K, E, dim_p]
+# arrays. Every world keeps views of its rows, so the scenario callbacks still work on single worlds.
+# Only the physics of the worlds is batched: no walls and no scripted agents.
+class WorldBatch(object):
+    def __init__(self, worlds):
+        self.worlds = worlds
+        world = worlds[0]
+        if world.walls or world.scripted_agents:
+            raise NotImplementedError("WorldBatch does not support walls or scripted agents.")
+        # entities and properties are the same in every world, take them from the first one
+        self.agents = world.agents
+        self.landmarks = world.landmarks
+        self.dim_c = world.dim_c
+        self.dim_p = world.dim_p
+        self.dim_color = world.dim_color
+        self.dt = world.dt
+        self.damping = world.damping
+        self.contact_force = world.contact_force
+        self.contact_margin = world.contact_margin
+        world.bind_state()
+        self.sizes = world.sizes
+        self.masses = world.masses
+        self.movable = world.movable
+        self.collide = world.collide
+        self.max_speeds = world.max_speeds
+
+        num_entities = len(world.entities)
+        self.p_pos = np.zeros((len(worlds), num_entities, self.dim_p))
+        self.p_vel = np.zeros((len(worlds), num_entities, self.dim_p))
+        for k, w in enumerate(worlds):
+            w.use_state(self.p_pos[k], self.p_vel[k])
+        self.c = np.stack([w.comm_state() for w in worlds])
+        self.cached_dist_vect = None
+        self.cached_dist_mag = None
+
+        # pairs of colliders where at least one entity moves
+        ia, ib = np.triu_indices(num_entities, 1)
+        pairs = self.collide[ia] & self.collide[ib] & (self.movable[ia] | self.movable[ib])
+        self.ia = ia[pairs]
+        self.ib = ib[pairs]
+
+    @property
+    def entities(self):
+        return self.agents + self.landmarks
+
+    # [K, agents, dim_c] communication state of all agents
+    def comm_state(self):
+        return self.c
+
+    # u is [K, agents, dim_p] (agent.action.u), c is [K, agents, dim_c] (agent.action.c)
+    def step(self, u, c):
+        num_agents = len(self.agents)
+        # gather agent action forces
+        p_force = np.zeros(self.p_pos.shape)
+        for i, agent in enumerate(self.agents):
+            if agent.movable:
+                noise = np.random.randn(len(self.worlds), self.dim_p) * agent.u_noise if agent.u_noise else 0.0
+                p_force[:, i] = (agent.mass * agent.accel if agent.accel is not None else agent.mass) * u[:, i] + noise
+        p_force = self.apply_environment_force(p_force)
+        self.integrate_state(p_force)
+        # set communication state
+        for i, agent in enumerate(self.agents):
+            if agent.silent:
+                self.c[:, i] = 0.0
+            else:
+                noise = np.random.randn(len(self.worlds), self.dim_c) * agent.c_noise if agent.c_noise else 0.0
+                self.c[:, i] = c[:, i] + noise
+        for w in self.worlds:
+            w.world_step += 1
+
+    # same as World.apply_environment_force, for every world at once
+    def apply_environment_force(self, p_force):
+        ia, ib = self.ia, self.ib
+        delta_pos = self.p_pos[:, ia] - self.p_pos[:, ib]
+        dist = np.sqrt(np.sum(np.square(delta_pos), axis=2))
+        dist_min = self.sizes[ia] + self.sizes[ib]
+        k = self.contact_margin
+        penetration = np.logaddexp(0, -(dist - dist_min)/k)*k
+        force = self.contact_force * delta_pos / dist[..., None] * penetration[..., None]
+        force_ratio = np.where(self.movable[ia] & self.movable[ib], self.masses[ib] / self.masses[ia], 1.0)
+        force_a = force_ratio[:, None] * force
+        force_b = -(1 / force_ratio)[:, None] * force
+        force_a[:, ~self.movable[ia]] = 0.0
+        force_b[:, ~self.movable[ib]] = 0.0
+
+        num_entities = self.p_pos.shape[1]
+        # [K, source, entity, dim_p]: the action force, then the force from every other entity
+        forces = np.zeros((len(self.worlds), 1 + num_entities, num_entities, self.dim_p))
+        forces[:, 0] = p_force
+        forces[:, 1 + ib, ia] = force_a
+        forces[:, 1 + ia, ib] = force_b
+        return np.add.reduce(forces, axis=1)
+
+    # same as World.integrate_state, for every world at once
+    def integrate_state(self, p_force):
+        movable = self.movable
+        p_vel = self.p_vel[:, movable] * (1 - self.damping)
+        p_vel += (p_force[:, movable] / self.masses[movable][:, None]) * self.dt
+        max_speed = np.broadcast_to(self.max_speeds[movable], p_vel.shape[:2])
+        speed = np.sqrt(np.square(p_vel[..., 0]) + np.square(p_vel[..., 1]))
+        clip = speed > max_speed
+        p_vel[clip] = p_vel[clip] / np.sqrt(np.square(p_vel[clip][:, 0]) +
+                                            np.square(p_vel[clip][:, 1]))[:, None] * max_speed[clip][:, None]
+        self.p_vel[:, movable] = p_vel
+        self.p_pos[:, movable] += p_vel * self.dt
+
+    # [K, E, E, dim_p] and [K, E, E] distances between all entities of every world
+    def calculate_distances(self):
+        self.cached_dist_vect = self.p_pos[:, :, None, :] - self.p_pos[:, None, :, :]
+        self.cached_dist_mag = np.linalg.norm(self.cached_dist_vect, axis=3)
+
+    # write the batched communication state and distances back into world k, for its scenario callbacks
+    def sync_world(self, k):
+        world = self.worlds[k]
+        for i, agent in enumerate(world.agents):
+            agent.state.c = self.c[k, i]
+        world.cached_dist_vect = self.cached_dist_vect[k]
+        world.cached_dist_mag = self.cached_dist_mag[k]
+
+    # after world k was reset by its scenario: its positions are already in place, pick up its comm state
+    def reset_world(self, k):
+        self.c[k] = self.worlds[k].comm_state()
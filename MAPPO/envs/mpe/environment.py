@@ -17,7 +17,8 @@ class MultiAgentEnv(gym.Env):
     def __init__(self, world, reset_callback=None, reward_callback=None,
                  observation_callback=None, info_callback=None,
                  done_callback=None, post_step_callback=None,
-                 shared_viewer=True, discrete_action=True):
+                 shared_viewer=True, discrete_action=True,
+                 rewards_callback=None, observations_callback=None):
 
         self.world = world
         self.world_length = self.world.world_length
@@ -31,6 +32,10 @@ class MultiAgentEnv(gym.Env):
         self.observation_callback = observation_callback
         self.info_callback = info_callback
         self.done_callback = done_callback
+        # optional batched callbacks (scenario.rewards_all/observations_all), one call for all agents
+        # from the world's distance matrix, preferred over the per-agent ones when given
+        self.rewards_callback = rewards_callback
+        self.observations_callback = observations_callback
                
         self.post_step_callback = post_step_callback
 
@@ -114,11 +119,13 @@ class MultiAgentEnv(gym.Env):
         # advance world state
         self.world.step() # core.step()  
         # record observation for each agent
+        self._update_distances()
+        obs_n = self._get_obs_all()
+        rewards = self._get_reward_all()
         for i,agent in enumerate(self.agents):
-            obs_n.append(self._get_obs(agent))
-            reward_n.append([self._get_reward(agent)])
+            reward_n.append([rewards[i]])
             done_n.append(self._get_done(agent))
-            info = {'individual_reward':self._get_reward(agent)}            
+            info = {'individual_reward':rewards[i]}            
             info_n.append(info)
 
         # all agents get total reward in cooperative case, if shared reward, all agents have the same reward, and reward is sum         
@@ -140,11 +147,9 @@ class MultiAgentEnv(gym.Env):
         # reset renderer
         self._reset_render()
         # record observations for each agent
-        obs_n = []
         self.agents = self.world.policy_agents
-        
-        for agent in self.agents:
-            obs_n.append(self._get_obs(agent))
+        self._update_distances()
+        obs_n = self._get_obs_all()
         
         available_action = [[None]] * self.n
         
@@ -162,6 +167,27 @@ class MultiAgentEnv(gym.Env):
             return np.zeros(0)
         return self.observation_callback(agent, self.world)
 
+    # the batched callbacks read world.cached_dist_vect/cached_dist_mag, computed once per step
+    def _update_distances(self):
+        if self.rewards_callback is None and self.observations_callback is None:
+            return
+        # world.step() already did it
+        if self.world.cache_dists and self.current_step > 0:
+            return
+        self.world.calculate_distances()
+
+    # get observations for all agents
+    def _get_obs_all(self):
+        if self.observations_callback is not None:
+            return self.observations_callback(self.world)
+        return [self._get_obs(agent) for agent in self.agents]
+
+    # get rewards for all agents
+    def _get_reward_all(self):
+        if self.rewards_callback is not None:
+            return self.rewards_callback(self.world)
+        return [self._get_reward(agent) for agent in self.agents]
+
     # get dones for a particular agent
     # unused right now -- agents are allowed to go beyond the viewing screen
     def _get_done(self, agent):
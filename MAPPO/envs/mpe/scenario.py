@@ -8,3 +8,33 @@ class BaseScenario(object):
     # create initial conditions of the world
     def reset_world(self, world):
         raise NotImplementedError()
+
+    # a scenario can also define rewards_all(world) / observations_all(world), returning the rewards
+    # and observations of all policy agents at once. MultiAgentEnv refreshes the world's distance
+    # matrix (world.calculate_distances) right before calling them, the helpers below read from it.
+    # With vectorized_worlds = True they must also accept a WorldBatch, whose arrays have a leading
+    # [K] axis, and return [K, agents] rewards and [K, agents, obs_dim] observations.
+    vectorized_worlds = False
+
+    # rows of the entities in the world state arrays and distance matrix
+    def entity_rows(self, world, entities):
+        return np.array([world.entities.index(entity) for entity in entities], dtype=np.int64)
+
+    # [..., agents, len(rows), dim_p] positions of the entities in every agent's reference frame
+    def relative_positions(self, world, rows):
+        return np.swapaxes(world.cached_dist_vect[..., rows, :len(world.agents), :], -3, -2)
+
+    # [..., len(rows), len(cols)] True where the entities overlap (is_collision)
+    def overlaps(self, world, rows, cols):
+        return world.cached_dist_mag[..., rows[:, None], cols[None, :]] < world.sizes[rows][:, None] + world.sizes[cols][None, :]
+
+    # [..., agents, agents, dim] --> [..., agents, agents - 1, dim] without every agent's own entry
+    def others(self, x):
+        n = x.shape[-2]
+        return x[..., ~np.eye(n, dtype=bool), :].reshape(*x.shape[:-3], n, n - 1, x.shape[-1])
+
+    # penalty for leaving the screen on each coordinate (simple_tag, simple_world_comm)
+    def bound_penalty(self, x):
+        x = np.abs(x)
+        # exp(3) is already past the cap of 10
+        return np.where(x < 0.9, 0.0, np.where(x < 1.0, (x - 0.9) * 10, np.minimum(np.exp(2 * np.minimum(x, 2.5) - 2), 10)))
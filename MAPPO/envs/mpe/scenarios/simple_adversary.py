@@ -135,3 +135,24 @@ class Scenario(BaseScenario):
             return np.concatenate([agent.goal_a.state.p_pos - agent.state.p_pos] + entity_pos + other_pos)
         else:
             return np.concatenate(entity_pos + other_pos)
+
+    def rewards_all(self, world):
+        # shaped (distance-based) rewards, as in agent_reward/adversary_reward
+        n = len(world.agents)
+        adversary = np.array([agent.adversary for agent in world.agents])
+        goal_rows = self.entity_rows(world, [agent.goal_a for agent in world.agents])
+        goal_dists = world.cached_dist_mag[np.arange(n), goal_rows]
+        adv_rew = np.sum(goal_dists[adversary])
+        pos_rew = -np.min(goal_dists[~adversary]) if np.any(~adversary) else 0.0
+        goal_dist2 = np.sum(np.square(world.cached_dist_vect[np.arange(n), goal_rows]), axis=1)
+        return np.where(adversary, -goal_dist2, pos_rew + adv_rew)
+
+    def observations_all(self, world):
+        n = len(world.agents)
+        entity_pos = self.relative_positions(world, self.entity_rows(world, world.landmarks)).reshape(n, -1)
+        other_pos = self.others(self.relative_positions(world, np.arange(n))).reshape(n, -1)
+        goal_rows = self.entity_rows(world, [agent.goal_a for agent in world.agents])
+        goal_pos = world.cached_dist_vect[goal_rows, np.arange(n)]
+        return [np.concatenate([entity_pos[i], other_pos[i]]) if agent.adversary
+                else np.concatenate([goal_pos[i], entity_pos[i], other_pos[i]])
+                for i, agent in enumerate(world.agents)]
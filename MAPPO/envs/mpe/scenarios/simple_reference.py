@@ -91,4 +91,21 @@ class Scenario(BaseScenario):
             if other is agent: continue
             comm.append(other.state.c)
         return np.concatenate([agent.state.p_vel] + entity_pos + [goal_color[1]] + comm)
-            
+
+    def rewards_all(self, world):
+        rew = np.zeros(len(world.agents))
+        for i, agent in enumerate(world.agents):
+            if agent.goal_a is None or agent.goal_b is None:
+                continue
+            rows = self.entity_rows(world, [agent.goal_a, agent.goal_b])
+            rew[i] = -np.sum(np.square(world.cached_dist_vect[rows[0], rows[1]]))
+        return rew
+
+    def observations_all(self, world):
+        n = len(world.agents)
+        entity_pos = self.relative_positions(world, self.entity_rows(world, world.landmarks)).reshape(n, -1)
+        goal_color = np.stack([np.zeros(world.dim_color) if agent.goal_b is None else agent.goal_b.color
+                               for agent in world.agents])
+        c = np.stack([agent.state.c for agent in world.agents])
+        comm = self.others(np.broadcast_to(c[None], (n,) + c.shape)).reshape(n, -1)
+        return list(np.concatenate([world.p_vel[:n], entity_pos, goal_color, comm], axis=1))
@@ -92,4 +92,25 @@ class Scenario(BaseScenario):
         # listener
         if agent.silent:
             return np.concatenate([agent.state.p_vel] + entity_pos + comm)
-            
+
+    def rewards_all(self, world):
+        # squared distance from listener to landmark, shared by both agents
+        a = world.agents[0]
+        rows = self.entity_rows(world, [a.goal_a, a.goal_b])
+        return np.full(len(world.agents), -np.sum(np.square(world.cached_dist_vect[rows[0], rows[1]])))
+
+    def observations_all(self, world):
+        n = len(world.agents)
+        entity_pos = self.relative_positions(world, self.entity_rows(world, world.landmarks)).reshape(n, -1)
+        obs_n = []
+        for i, agent in enumerate(world.agents):
+            # speaker
+            if not agent.movable:
+                obs_n.append(np.concatenate([np.zeros(world.dim_color) if agent.goal_b is None else agent.goal_b.color]))
+            # listener
+            elif agent.silent:
+                comm = [other.state.c for other in world.agents if other is not agent and other.state.c is not None]
+                obs_n.append(np.concatenate([agent.state.p_vel, entity_pos[i]] + comm))
+            else:
+                obs_n.append(None)
+        return obs_n
@@ -3,6 +3,8 @@ from envs.mpe.core import World, Agent, Landmark
 from envs.mpe.scenario import BaseScenario
 
 class Scenario(BaseScenario):
+    vectorized_worlds = True
+
     def make_world(self, args):
         world = World()
         world.world_length = args.episode_length
@@ -98,3 +100,24 @@ class Scenario(BaseScenario):
             comm.append(other.state.c)
             other_pos.append(other.state.p_pos - agent.state.p_pos)
         return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + comm)
+
+    def rewards_all(self, world):
+        n = len(world.agents)
+        agents = np.arange(n)
+        rew = np.zeros(world.cached_dist_mag.shape[:-2])
+        if len(world.landmarks) > 0:
+            # distance from every landmark to its closest agent
+            rew -= np.sum(np.min(world.cached_dist_mag[..., n:, :n], axis=-1), axis=-1)
+        collide = np.array([agent.collide for agent in world.agents])
+        collisions = np.sum(self.overlaps(world, agents, agents), axis=-1)
+        return rew[..., None] - np.where(collide, collisions, 0)
+
+    def observations_all(self, world):
+        n = len(world.agents)
+        lead = world.cached_dist_mag.shape[:-2]
+        entity_pos = self.relative_positions(world, self.entity_rows(world, world.landmarks))
+        other_pos = self.others(self.relative_positions(world, np.arange(n)))
+        c = world.comm_state()
+        comm = self.others(np.broadcast_to(c[..., None, :, :], lead + (n,) + c.shape[-2:]))
+        return np.concatenate([world.p_vel[..., :n, :], world.p_pos[..., :n, :], entity_pos.reshape(*lead, n, -1),
+                               other_pos.reshape(*lead, n, -1), comm.reshape(*lead, n, -1)], axis=-1)
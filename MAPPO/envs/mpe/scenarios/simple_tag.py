@@ -142,3 +142,32 @@ class Scenario(BaseScenario):
             if not other.adversary:
                 other_vel.append(other.state.p_vel)
         return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + other_vel)
+
+    def rewards_all(self, world):
+        n = len(world.agents)
+        adversary = np.array([agent.adversary for agent in world.agents])
+        collide = np.array([agent.collide for agent in world.agents])
+        good_rows = np.flatnonzero(~adversary)
+        adv_rows = np.flatnonzero(adversary)
+        # [good, adversaries]
+        caught = self.overlaps(world, good_rows, adv_rows)
+
+        rew = np.zeros(n)
+        # agents are negatively rewarded if caught by adversaries, and penalized for exiting the screen
+        rew[good_rows] -= np.where(collide[good_rows], 10 * np.sum(caught, axis=1), 0)
+        rew[good_rows] -= np.sum(self.bound_penalty(world.p_pos[good_rows]), axis=1)
+        # adversaries are rewarded for collisions with agents
+        rew[adv_rows] += np.where(collide[adv_rows], 10 * np.sum(caught), 0)
+        return rew
+
+    def observations_all(self, world):
+        n = len(world.agents)
+        landmarks = [entity for entity in world.landmarks if not entity.boundary]
+        entity_pos = self.relative_positions(world, self.entity_rows(world, landmarks)).reshape(n, -1)
+        other_pos = self.others(self.relative_positions(world, np.arange(n))).reshape(n, -1)
+        good = np.array([not agent.adversary for agent in world.agents])
+        # [agent, other] velocities of the other good agents
+        other_vel = good[None, :] & ~np.eye(n, dtype=bool)
+        vel = world.p_vel[:n]
+        return [np.concatenate([vel[i], world.p_pos[i], entity_pos[i], other_pos[i], vel[other_vel[i]].ravel()])
+                for i in range(n)]
@@ -286,3 +286,55 @@ class Scenario(BaseScenario):
                 [agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + other_vel + in_forest + comm)
         else:
             return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + in_forest + other_vel)
+
+    def rewards_all(self, world):
+        n = len(world.agents)
+        adversary = np.array([agent.adversary for agent in world.agents])
+        collide = np.array([agent.collide for agent in world.agents])
+        good_rows = np.flatnonzero(~adversary)
+        adv_rows = np.flatnonzero(adversary)
+        food_rows = self.entity_rows(world, world.food)
+        # [good, adversaries]
+        caught = self.overlaps(world, good_rows, adv_rows)
+
+        rew = np.zeros(n)
+        # agents: penalized when caught and for exiting the screen, rewarded for (being close to) food
+        rew[good_rows] -= np.where(collide[good_rows], 5 * np.sum(caught, axis=1), 0)
+        rew[good_rows] -= 2 * np.sum(self.bound_penalty(world.p_pos[good_rows]), axis=1)
+        rew[good_rows] += 2 * np.sum(self.overlaps(world, good_rows, food_rows), axis=1)
+        rew[good_rows] += 0.05 * np.min(world.cached_dist_mag[np.ix_(food_rows, good_rows)], axis=0)
+        # adversaries: shaped by the distance to the closest agent, rewarded for collisions with agents
+        rew[adv_rows] -= 0.1 * np.min(world.cached_dist_mag[np.ix_(good_rows, adv_rows)], axis=0)
+        rew[adv_rows] += np.where(collide[adv_rows], 5 * np.sum(caught), 0)
+        return rew
+
+    def observations_all(self, world):
+        n = len(world.agents)
+        landmarks = [entity for entity in world.landmarks if not entity.boundary]
+        entity_pos = self.relative_positions(world, self.entity_rows(world, landmarks)).reshape(n, -1)
+        # [agents, 2] whether every agent is in each of the two forests
+        in_forest = self.overlaps(world, np.arange(n), self.entity_rows(world, world.forests[:2]))
+        outside = ~np.any(in_forest, axis=1)
+        leader = np.array([agent.leader for agent in world.agents])
+        # [agent, other] whether the other agent is visible to the agent
+        visible = (in_forest[:, None, 0] & in_forest[None, :, 0]) | (in_forest[:, None, 1] & in_forest[None, :, 1]) | \
+                  (outside[:, None] & outside[None, :]) | leader[:, None]
+        visible = self.others(visible[..., None])[..., 0]
+        other_pos = self.others(self.relative_positions(world, np.arange(n)))
+        other_pos = np.where(visible[..., None], other_pos, 0.0).reshape(n, -1)
+        good = ~np.array([agent.adversary for agent in world.agents])
+        other_vel = self.others(np.broadcast_to(world.p_vel[None, :n], (n, n, world.dim_p)))
+        other_vel = np.where(visible[..., None], other_vel, 0.0)
+        other_good = self.others(np.broadcast_to(good[None, :, None], (n, n, 1)))[..., 0]
+        in_forest = np.where(in_forest, 1.0, -1.0)
+        comm = world.agents[0].state.c
+
+        obs_n = []
+        for i, agent in enumerate(world.agents):
+            own = [agent.state.p_vel, agent.state.p_pos, entity_pos[i], other_pos[i]]
+            vel = other_vel[i][other_good[i]].ravel()
+            if agent.adversary:
+                obs_n.append(np.concatenate(own + [vel, in_forest[i], comm]))
+            else:
+                obs_n.append(np.concatenate(own + [in_forest[i], vel]))
+        return obs_n
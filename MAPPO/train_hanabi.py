@@ -17,9 +17,12 @@ from algorithm.ppo import PPO
 from algorithm.share_model import Policy
 
 from config import get_config
-from utils.env_wrappers import ChooseSubprocVecEnv
+from utils.env_wrappers import ChooseSubprocVecEnv, TurnSubprocVecEnv
+from utils.metrics import AsyncSummaryWriter
 from utils.util import update_linear_schedule
 from utils.share_storage import RolloutStorage
+from utils.torch_storage import TorchRolloutStorage
+from utils.encoding import zero_where_done
 import shutil
 import numpy as np
 
@@ -35,9 +38,9 @@ def make_parallel_env(args):
             return env
         return init_env
     if args.n_rollout_threads == 1:
-        return ChooseSubprocVecEnv([get_env_fn(0)])
+        return TurnSubprocVecEnv([get_env_fn(0)])
     else:
-        return ChooseSubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
+        return TurnSubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
         
 def make_eval_env(args):
     def get_env_fn(rank):
@@ -87,7 +90,7 @@ def main():
     save_dir = run_dir / 'models'
     os.makedirs(str(log_dir))
     os.makedirs(str(save_dir))
-    logger = SummaryWriter(str(log_dir)) 
+    logger = AsyncSummaryWriter(SummaryWriter(str(log_dir)))
 
     # env
     envs = make_parallel_env(args)
@@ -144,6 +147,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                    
         #replay buffer
@@ -204,6 +209,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                                
             actor_critic.append(ac)
@@ -217,6 +224,8 @@ def main():
                     envs.share_observation_space[0], 
                     envs.action_space[0],
                     args.hidden_size)
+    if args.use_device_storage:
+        rollouts = TorchRolloutStorage(rollouts, device)
     
     # reset env 
     reset_choose = np.ones(args.n_rollout_threads)==1.0 
@@ -235,7 +244,6 @@ def main():
     turn_available_actions = np.zeros((args.n_rollout_threads, num_agents, *rollouts.available_actions.shape[3:])).astype(np.float32)
     turn_values =  np.zeros((args.n_rollout_threads, num_agents, 1)).astype(np.float32)
     turn_actions = np.zeros((args.n_rollout_threads, num_agents, 1)).astype(np.float32)
-    env_actions = np.ones((args.n_rollout_threads, num_agents, 1)).astype(np.float32)*(-1.0)
     turn_action_log_probs = np.zeros((args.n_rollout_threads, num_agents, 1)).astype(np.float32)
     turn_recurrent_hidden_states = np.zeros((args.n_rollout_threads, num_agents, *rollouts.recurrent_hidden_states.shape[3:])).astype(np.float32)
     turn_recurrent_hidden_states_critic = np.zeros((args.n_rollout_threads, num_agents, *rollouts.recurrent_hidden_states_critic.shape[3:])).astype(np.float32)
@@ -255,77 +263,77 @@ def main():
         scores = []          
         for step in range(args.episode_length):
             # Sample actions
-            reset_choose = np.zeros(args.n_rollout_threads)==1.0          
-            with torch.no_grad():                  
-                for current_agent_id in range(num_agents):
-                    env_actions[:,current_agent_id] = np.ones((args.n_rollout_threads, 1)).astype(np.float32)*(-1.0)                                                               
-                    choose = np.any(use_available_actions[:,current_agent_id]==1,axis=1) 
+            reset_choose = np.zeros(args.n_rollout_threads)==1.0
+            # the seats that already acted in this round of every env
+            acted = np.zeros((args.n_rollout_threads, num_agents), dtype=bool)
+            with torch.no_grad():
+                for turn in range(num_agents):
+                    threads = np.arange(args.n_rollout_threads)
+                    seats = envs.current_players.copy()
+                    choose = np.any(use_available_actions[threads, seats]==1, axis=1)
                     if ~np.any(choose):
                         reset_choose = np.ones(args.n_rollout_threads)==1.0
-                        break                 
+                        break
+                    # one forward for every env that plays this turn, whichever seat is acting
+                    threads = threads[choose]
+                    seats = seats[choose]
                     if args.share_policy:
-                        actor_critic.eval()
-                        value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic.act(torch.FloatTensor(use_share_obs[choose,current_agent_id]), 
-                            torch.FloatTensor(use_obs[choose,current_agent_id]), 
-                            torch.FloatTensor(turn_recurrent_hidden_states[choose,current_agent_id]), 
-                            torch.FloatTensor(turn_recurrent_hidden_states_critic[choose,current_agent_id]),
-                            torch.FloatTensor(turn_masks[choose,current_agent_id]),
-                            torch.FloatTensor(use_available_actions[choose,current_agent_id]))
+                        policies = [(actor_critic, np.ones(len(threads), dtype=bool))]
                     else:
-                        actor_critic[current_agent_id].eval()
-                        value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic[current_agent_id].act(torch.FloatTensor(use_share_obs[choose,current_agent_id]), 
-                            torch.FloatTensor(use_obs[choose,current_agent_id]), 
-                            torch.FloatTensor(turn_recurrent_hidden_states[choose,current_agent_id]), 
-                            torch.FloatTensor(turn_recurrent_hidden_states_critic[choose,current_agent_id]),
-                            torch.FloatTensor(turn_masks[choose,current_agent_id]),
-                            torch.FloatTensor(use_available_actions[choose,current_agent_id]))
-                    
-                    turn_obs[choose,current_agent_id] = use_obs[choose,current_agent_id].copy()
-                    turn_share_obs[choose,current_agent_id] = use_share_obs[choose,current_agent_id].copy()
-                    turn_available_actions[choose,current_agent_id] = use_available_actions[choose,current_agent_id].copy()
-                    turn_values[choose,current_agent_id] = value.detach().cpu().numpy()
-                    turn_actions[choose,current_agent_id] = action.detach().cpu().numpy()
-                    env_actions[choose,current_agent_id] = action.detach().cpu().numpy()
-                    turn_action_log_probs[choose,current_agent_id] = action_log_prob.detach().cpu().numpy()
-                    turn_recurrent_hidden_states[choose,current_agent_id] = recurrent_hidden_states.detach().cpu().numpy()
-                    turn_recurrent_hidden_states_critic[choose,current_agent_id] = recurrent_hidden_states_critic.detach().cpu().numpy()
-                    
-                    obs, share_obs, reward, done, infos, available_actions = envs.step(env_actions) 
-                    
-                    use_obs = obs.copy()
-                    use_share_obs = share_obs.copy()
-                    use_available_actions = available_actions.copy()
-                    
-                    turn_rewards_since_last_action[choose] += reward[choose]                    
-                    turn_rewards[choose, current_agent_id] = turn_rewards_since_last_action[choose, current_agent_id].copy()
-                    turn_rewards_since_last_action[choose, current_agent_id] = 0.0
-                    
-                    for n_rollout_thread in range(args.n_rollout_threads):
-                        if done[n_rollout_thread]:
-                            use_available_actions[n_rollout_thread] = np.zeros((num_agents, *rollouts.available_actions.shape[3:]))
-                            reset_choose[n_rollout_thread]=True
-                            turn_high_masks[n_rollout_thread, current_agent_id] = 1.0                              
-                            for left_agent_id in range(current_agent_id + 1, num_agents):
-                                turn_high_masks[n_rollout_thread, left_agent_id] = 0.0
-                                turn_rewards[n_rollout_thread, left_agent_id] = turn_rewards_since_last_action[n_rollout_thread, left_agent_id]
-                                turn_rewards_since_last_action[n_rollout_thread, left_agent_id] = 0.0
-                                # other variables use what at last time, action will be useless.
-                                
-                                turn_values[n_rollout_thread,left_agent_id] = 0.0
-                                turn_obs[n_rollout_thread,left_agent_id] = use_obs[n_rollout_thread,left_agent_id]                                      
-                                turn_share_obs[n_rollout_thread,left_agent_id] = use_share_obs[n_rollout_thread,left_agent_id]                             
-                            turn_masks[n_rollout_thread] = np.zeros((num_agents, 1)).astype(np.float32)
-                            turn_recurrent_hidden_states[n_rollout_thread] = np.zeros((num_agents, *rollouts.recurrent_hidden_states.shape[3:])).astype(np.float32)
-                            turn_recurrent_hidden_states_critic[n_rollout_thread] = np.zeros((num_agents, *rollouts.recurrent_hidden_states_critic.shape[3:])).astype(np.float32)                            
-                            
-                            if 'score' in infos[n_rollout_thread].keys():
-                                scores.append(infos[n_rollout_thread]['score'])
-                        elif done[n_rollout_thread] == None:
-                            pass
-                        else:
-                            turn_masks[n_rollout_thread,current_agent_id]=1.0
-                            turn_high_masks[n_rollout_thread,current_agent_id] = 1.0
-            
+                        policies = [(actor_critic[agent_id], seats == agent_id) for agent_id in np.unique(seats)]
+                    for policy, group in policies:
+                        rows, cols = threads[group], seats[group]
+                        policy.eval()
+                        value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = policy.act(torch.FloatTensor(use_share_obs[rows, cols]),
+                            torch.FloatTensor(use_obs[rows, cols]),
+                            torch.FloatTensor(turn_recurrent_hidden_states[rows, cols]),
+                            torch.FloatTensor(turn_recurrent_hidden_states_critic[rows, cols]),
+                            torch.FloatTensor(turn_masks[rows, cols]),
+                            torch.FloatTensor(use_available_actions[rows, cols]))
+
+                        turn_values[rows, cols] = value.detach().cpu().numpy()
+                        turn_actions[rows, cols] = action.detach().cpu().numpy()
+                        turn_action_log_probs[rows, cols] = action_log_prob.detach().cpu().numpy()
+                        turn_recurrent_hidden_states[rows, cols] = recurrent_hidden_states.detach().cpu().numpy()
+                        turn_recurrent_hidden_states_critic[rows, cols] = recurrent_hidden_states_critic.detach().cpu().numpy()
+                    turn_obs[threads, seats] = use_obs[threads, seats]
+                    turn_share_obs[threads, seats] = use_share_obs[threads, seats]
+                    turn_available_actions[threads, seats] = use_available_actions[threads, seats]
+                    acted[threads, seats] = True
+
+                    # one action per playing env, for its current player
+                    obs, share_obs, reward, done, infos, available_actions, _ = envs.step(turn_actions[np.arange(args.n_rollout_threads), envs.current_players], choose)
+
+                    use_obs[choose] = obs[choose]
+                    use_share_obs[choose] = share_obs[choose]
+                    use_available_actions[choose] = available_actions[choose]
+
+                    turn_rewards_since_last_action[choose] += reward[choose]
+                    turn_rewards[threads, seats] = turn_rewards_since_last_action[threads, seats]
+                    turn_rewards_since_last_action[threads, seats] = 0.0
+
+                    # done is False for the envs that were not stepped
+                    finished = done
+                    left_agents = finished[:, None] & ~acted
+                    use_available_actions[finished] = 0.0
+                    reset_choose[finished] = True
+                    turn_high_masks[threads[finished[threads]], seats[finished[threads]]] = 1.0
+                    turn_high_masks[left_agents] = 0.0
+                    turn_rewards[left_agents] = turn_rewards_since_last_action[left_agents]
+                    turn_rewards_since_last_action[left_agents] = 0.0
+                    # other variables use what at last time, action will be useless.
+                    turn_values[left_agents] = 0.0
+                    turn_obs[left_agents] = use_obs[left_agents]
+                    turn_share_obs[left_agents] = use_share_obs[left_agents]
+                    zero_where_done(finished, turn_masks, turn_recurrent_hidden_states, turn_recurrent_hidden_states_critic)
+                    for n_rollout_thread in np.nonzero(finished)[0]:
+                        if 'score' in infos[n_rollout_thread].keys():
+                            scores.append(infos[n_rollout_thread]['score'])
+
+                    playing = ~finished[threads]
+                    turn_masks[threads[playing], seats[playing]] = 1.0
+                    turn_high_masks[threads[playing], seats[playing]] = 1.0
+
             # insert turn data into buffer
             rollouts.chooseinsert(turn_share_obs, 
                                   turn_obs, 
@@ -347,44 +355,38 @@ def main():
             use_share_obs[reset_choose] = share_obs[reset_choose]
             use_available_actions[reset_choose] = available_actions[reset_choose]
                       
-        rollouts.share_obs[-1] = use_share_obs.copy()
-        rollouts.obs[-1] = use_obs.copy()
-        rollouts.available_actions[-1] = use_available_actions.copy()
+        rollouts.insert_last(use_share_obs, use_obs, use_available_actions)
         
         with torch.no_grad(): 
-            for i in range(num_agents):         
-                if args.share_policy:
-                    actor_critic.eval()                 
-                    next_value,_,_ = actor_critic.get_value(torch.tensor(rollouts.share_obs[-1,:,i]), 
-                                                   torch.tensor(rollouts.obs[-1,:,i]), 
-                                                   torch.tensor(rollouts.recurrent_hidden_states[-1,:,i]),
-                                                   torch.tensor(rollouts.recurrent_hidden_states_critic[-1,:,i]),
-                                                   torch.tensor(rollouts.masks[-1,:,i]))
-                    next_value = next_value.detach().cpu().numpy()
-                    rollouts.compute_returns(i,
-                                    next_value, 
-                                    args.use_gae, 
-                                    args.gamma,
-                                    args.gae_lambda, 
-                                    args.use_proper_time_limits,
-                                    args.use_popart,
-                                    agents.value_normalizer)
-                else:
+            if args.share_policy:
+                actor_critic.eval()
+                next_values,_,_ = actor_critic.get_value_all(rollouts.share_obs[-1], 
+                                               rollouts.obs[-1], 
+                                               rollouts.recurrent_hidden_states[-1],
+                                               rollouts.recurrent_hidden_states_critic[-1],
+                                               rollouts.masks[-1])
+            else:
+                next_values = []
+                for i in range(num_agents):
                     actor_critic[i].eval()
-                    next_value,_,_ = actor_critic[i].get_value(torch.tensor(rollouts.share_obs[-1,:,i]), 
-                                                   torch.tensor(rollouts.obs[-1,:,i]), 
-                                                   torch.tensor(rollouts.recurrent_hidden_states[-1,:,i]),
-                                                   torch.tensor(rollouts.recurrent_hidden_states_critic[-1,:,i]),
-                                                   torch.tensor(rollouts.masks[-1,:,i]))
-                    next_value = next_value.detach().cpu().numpy()
-                    rollouts.compute_returns(i,
-                                    next_value, 
+                    next_value,_,_ = actor_critic[i].get_value(torch.as_tensor(rollouts.share_obs[-1,:,i]), 
+                                                   torch.as_tensor(rollouts.obs[-1,:,i]), 
+                                                   torch.as_tensor(rollouts.recurrent_hidden_states[-1,:,i]),
+                                                   torch.as_tensor(rollouts.recurrent_hidden_states_critic[-1,:,i]),
+                                                   torch.as_tensor(rollouts.masks[-1,:,i]))
+                    next_values.append(next_value.detach().cpu().numpy())
+                next_values = np.array(next_values).transpose(1,0,2)
+            if args.share_policy:
+                value_normalizer = agents.value_normalizer
+            else:
+                value_normalizer = [agents[i].value_normalizer for i in range(num_agents)]
+            rollouts.compute_returns_all(next_values,
                                     args.use_gae, 
                                     args.gamma,
                                     args.gae_lambda, 
                                     args.use_proper_time_limits,
                                     args.use_popart,
-                                    agents[i].value_normalizer)
+                                    value_normalizer)
         
         # remove useless data in buffer
         # update the network
@@ -393,7 +395,7 @@ def main():
             value_loss, action_loss, dist_entropy = agents.update_share(num_agents, rollouts)
                            
             logger.add_scalars('reward',
-                {'reward': np.mean(rollouts.rewards)},
+                {'reward': float(rollouts.rewards.mean())},
                 (episode + 1) * args.episode_length * args.n_rollout_threads)
             # reward mask
         else:
@@ -409,7 +411,7 @@ def main():
                 dist_entropies.append(dist_entropy)
                 
                 logger.add_scalars('agent%i/reward' % agent_id,
-                    {'reward': np.mean(rollouts.rewards[:,:,agent_id])},
+                    {'reward': float(rollouts.rewards[:,:,agent_id].mean())},
                     (episode + 1) * args.episode_length * args.n_rollout_threads)
                                                                      
         # clean the buffer and reset
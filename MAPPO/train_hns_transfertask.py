@@ -13,13 +13,15 @@ import torch.nn.functional as F
 from tensorboardX import SummaryWriter
 
 from envs import BlueprintConstructionEnv, BoxLockingEnv, ShelterConstructionEnv
-from algorithm.ppo import PPO
+from algorithm.ppo import PPO, update_group
 from algorithm.model import Policy
 
 from config import get_config
 from utils.env_wrappers import SimplifySubprocVecEnv, DummyVecEnv
+from utils.metrics import AsyncSummaryWriter
 from utils.util import update_linear_schedule
 from utils.storage import RolloutStorage
+from utils.encoding import done_masks, zero_where_done
 import shutil
 import numpy as np
 from utils.multi_discrete import MultiDiscrete
@@ -94,7 +96,7 @@ def main():
     save_dir = run_dir / 'models'
     os.makedirs(str(log_dir))
     os.makedirs(str(save_dir))
-    logger = SummaryWriter(str(log_dir)) 
+    logger = AsyncSummaryWriter(SummaryWriter(str(log_dir)))
 
     # env
     envs = make_parallel_env(args)
@@ -185,6 +187,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                    
         #replay buffer
@@ -244,6 +248,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                                
             actor_critic.append(ac)
@@ -292,6 +298,8 @@ def main():
     rollouts.recurrent_hidden_states = np.zeros(rollouts.recurrent_hidden_states.shape).astype(np.float32)
     rollouts.recurrent_hidden_states_critic = np.zeros(rollouts.recurrent_hidden_states_critic.shape).astype(np.float32)
     
+    masks = np.ones((args.n_rollout_threads, num_agents, 1)).astype(np.float32)
+    
     # run
     start = time.time()
     episodes = int(args.num_env_steps) // args.episode_length // args.n_rollout_threads
@@ -342,20 +350,16 @@ def main():
                     recurrent_hidden_statess_critic.append(recurrent_hidden_states_critic.detach().cpu().numpy())
             
             # rearrange action          
+            # [agents, threads, dim], the envs take one dict of per-agent arrays each
+            env_actions = np.array(actions)
+            movement_dim = action_movement_dim[0]
             actions_env = []
             for n_rollout_thread in range(args.n_rollout_threads):
-                action_movement = []
+                action_movement = env_actions[:, n_rollout_thread, :movement_dim]
+                action_glueall = env_actions[:, n_rollout_thread, movement_dim].astype(int)
                 action_pull = []
-                action_glueall = []
-                for agent_id in range(num_agents):
-                    action_movement.append(actions[agent_id][n_rollout_thread][:action_movement_dim[agent_id]])
-                    action_glueall.append(int(actions[agent_id][n_rollout_thread][action_movement_dim[agent_id]]))
-                    if 'action_pull' in envs.action_space.spaces.keys():
-                        action_pull.append(int(actions[agent_id][n_rollout_thread][-1]))
-                action_movement = np.stack(action_movement, axis = 0)
-                action_glueall = np.stack(action_glueall, axis = 0)
                 if 'action_pull' in envs.action_space.spaces.keys():
-                    action_pull = np.stack(action_pull, axis = 0)                             
+                    action_pull = env_actions[:, n_rollout_thread, -1].astype(int)
                 one_env_action = {'action_movement': action_movement, 'action_pull': action_pull, 'action_glueall': action_glueall}
                 actions_env.append(one_env_action)
                        
@@ -366,28 +370,19 @@ def main():
 
             # If done then clean the history of observations.
             # insert data in buffer
-            masks = []
-            for i, done in enumerate(dones): 
-                if done:
-                    if "discard_episode" in infos[i].keys():
-                        if infos[i]['discard_episode']:
-                            discard_episode += 1
-                        else:
-                            trials += 1
+            for i in np.nonzero(dones)[0]:
+                if "discard_episode" in infos[i].keys():
+                    if infos[i]['discard_episode']:
+                        discard_episode += 1
                     else:
                         trials += 1
-                    if "success" in infos[i].keys():
-                        if infos[i]['success']:
-                            success += 1
-                mask = []               
-                for agent_id in range(num_agents): 
-                    if done:    
-                        recurrent_hidden_statess[agent_id][i] = np.zeros(args.hidden_size).astype(np.float32)
-                        recurrent_hidden_statess_critic[agent_id][i] = np.zeros(args.hidden_size).astype(np.float32)    
-                        mask.append([0.0])                        
-                    else:
-                        mask.append([1.0])
-                masks.append(mask)                            
+                else:
+                    trials += 1
+                if "success" in infos[i].keys():
+                    if infos[i]['success']:
+                        success += 1
+            done_masks(dones, num_agents, masks)
+            zero_where_done(dones, *recurrent_hidden_statess, *recurrent_hidden_statess_critic)
 
             obs = []
             share_obs = []   
@@ -478,11 +473,16 @@ def main():
             
             for agent_id in range(num_agents):
                 actor_critic[agent_id].train()
-                value_loss, action_loss, dist_entropy = agents[agent_id].update(agent_id, rollouts)
-                value_losses.append(value_loss)
-                action_losses.append(action_loss)
-                dist_entropies.append(dist_entropy)
-                
+            if args.use_grouped_update:
+                value_losses, action_losses, dist_entropies = update_group(agents, rollouts)
+            else:
+                for agent_id in range(num_agents):
+                    value_loss, action_loss, dist_entropy = agents[agent_id].update(agent_id, rollouts)
+                    value_losses.append(value_loss)
+                    action_losses.append(action_loss)
+                    dist_entropies.append(dist_entropy)
+
+            for agent_id in range(num_agents):
                 logger.add_scalars('agent%i/reward' % agent_id,
                     {'reward': np.mean(rollouts.rewards[:,:,agent_id])},
                     (episode + 1) * args.episode_length * args.n_rollout_threads)
@@ -13,14 +13,18 @@ import torch.nn.functional as F
 from tensorboardX import SummaryWriter
 
 from envs import MPEEnv
-from algorithm.ppo import PPO
+from envs.mpe.BatchedMPE import BatchedMPEEnv, ShardedBatchedMPEEnv
+from algorithm.ppo import PPO, update_group
 from algorithm.model import Policy
 
 from config import get_config
-from utils.env_wrappers import SubprocVecEnv, DummyVecEnv
+from utils.env_wrappers import SubprocVecEnv, DummyVecEnv, ShmemSubprocVecEnv
+from utils.metrics import AsyncSummaryWriter
 from utils.util import update_linear_schedule
 from utils.storage import RolloutStorage
+from utils.torch_storage import TorchRolloutStorage
 from utils.single_storage import SingleRolloutStorage
+from utils.encoding import ActionEncoder, done_masks, zero_where_done
 import shutil
 import numpy as np
 import itertools
@@ -37,10 +41,20 @@ def make_parallel_env(args):
             # np.random.seed(args.seed + rank * 1000)
             return env
         return init_env
-    if args.n_rollout_threads == 1:
+    if args.use_batched_env:
+        if args.num_env_shards > 1:
+            return ShardedBatchedMPEEnv([get_env_fn(i) for i in range(args.n_rollout_threads)], args.num_env_shards)
+        return BatchedMPEEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
+    elif args.n_rollout_threads == 1:
         return DummyVecEnv([get_env_fn(0)])
-    else:
-        return SubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
+    elif args.use_shmem_env:
+        # MPE envs return [[None]] in place of action masks
+        try:
+            return ShmemSubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)], available_actions=False)
+        except ValueError as e:
+            # scenarios whose agents see different obs shapes (simple_adversary, simple_tag, ...)
+            print("Can not use the shared memory env: " + str(e) + " Using SubprocVecEnv instead.")
+    return SubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
 
 def main():
     args = get_config()
@@ -78,11 +92,12 @@ def main():
     save_dir = run_dir / 'models'
     os.makedirs(str(log_dir))
     os.makedirs(str(save_dir))
-    logger = SummaryWriter(str(log_dir)) 
+    logger = AsyncSummaryWriter(SummaryWriter(str(log_dir)))
 
     # env
     envs = make_parallel_env(args)
     num_agents = args.num_agents
+    agent_ids = torch.arange(num_agents)
     
     #Policy network
     if args.share_policy:
@@ -131,6 +146,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                    
         #replay buffer
@@ -139,7 +156,8 @@ def main():
                     args.n_rollout_threads,
                     envs.observation_space[0], 
                     envs.action_space[0],
-                    args.hidden_size)        
+                    args.hidden_size,
+                    dedup_share_obs=args.use_dedup_share_obs)        
     else:
         actor_critic = []
         agents = []
@@ -190,6 +208,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                                
             actor_critic.append(ac)
@@ -210,11 +230,14 @@ def main():
     # replay buffer 
     if args.share_policy: 
         share_obs = obs.reshape(args.n_rollout_threads, -1)        
-        share_obs = np.expand_dims(share_obs,1).repeat(num_agents,axis=1)    
+        # [threads, 1, dim], broadcast over the agents unless the storage keeps it de-duplicated
+        share_obs = np.expand_dims(share_obs,1)
         rollouts.share_obs[0] = share_obs.copy() 
         rollouts.obs[0] = obs.copy()               
         rollouts.recurrent_hidden_states = np.zeros(rollouts.recurrent_hidden_states.shape).astype(np.float32)
         rollouts.recurrent_hidden_states_critic = np.zeros(rollouts.recurrent_hidden_states_critic.shape).astype(np.float32)
+        if args.use_device_storage:
+            rollouts = TorchRolloutStorage(rollouts, device)
     else:
         
         share_obs = []
@@ -227,6 +250,9 @@ def main():
             rollouts[agent_id].recurrent_hidden_states = np.zeros(rollouts[agent_id].recurrent_hidden_states.shape).astype(np.float32)
             rollouts[agent_id].recurrent_hidden_states_critic = np.zeros(rollouts[agent_id].recurrent_hidden_states_critic.shape).astype(np.float32)
     
+    action_encoder = ActionEncoder(envs.action_space, args.n_rollout_threads)
+    masks = np.ones((args.n_rollout_threads, num_agents, 1)).astype(np.float32)
+    
     # run
     start = time.time()
     episodes = int(args.num_env_steps) // args.episode_length // args.n_rollout_threads
@@ -242,23 +268,24 @@ def main():
 
         for step in range(args.episode_length):
             # Sample actions
-            values = []
-            actions= []
-            action_log_probs = []
-            recurrent_hidden_statess = []
-            recurrent_hidden_statess_critic = []
-            
-            with torch.no_grad():                
-                for agent_id in range(num_agents):
-                    if args.share_policy:
-                        actor_critic.eval()
-                        value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic.act(agent_id,
-                            torch.FloatTensor(rollouts.share_obs[step,:,agent_id]), 
-                            torch.FloatTensor(rollouts.obs[step,:,agent_id]), 
-                            torch.FloatTensor(rollouts.recurrent_hidden_states[step,:,agent_id]), 
-                            torch.FloatTensor(rollouts.recurrent_hidden_states_critic[step,:,agent_id]),
-                            torch.FloatTensor(rollouts.masks[step,:,agent_id]))
-                    else:
+            with torch.no_grad():
+                if args.share_policy:
+                    # [threads, agents, dim]
+                    actor_critic.eval()
+                    values, actions, action_log_probs, recurrent_hidden_statess, recurrent_hidden_statess_critic = actor_critic.act_all(agent_ids,
+                        rollouts.get_share_obs(step), 
+                        rollouts.obs[step], 
+                        rollouts.recurrent_hidden_states[step], 
+                        rollouts.recurrent_hidden_states_critic[step],
+                        rollouts.masks[step])
+                else:
+                    # [agents, threads, dim]
+                    values = []
+                    actions= []
+                    action_log_probs = []
+                    recurrent_hidden_statess = []
+                    recurrent_hidden_statess_critic = []
+                    for agent_id in range(num_agents):
                         actor_critic[agent_id].eval()
                         value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic[agent_id].act(agent_id,
                             torch.FloatTensor(rollouts[agent_id].share_obs[step,:]), 
@@ -267,62 +294,43 @@ def main():
                             torch.FloatTensor(rollouts[agent_id].recurrent_hidden_states_critic[step,:]),
                             torch.FloatTensor(rollouts[agent_id].masks[step,:]))
                         
-                    values.append(value.detach().cpu().numpy())
-                    actions.append(action.detach().cpu().numpy())
-                    action_log_probs.append(action_log_prob.detach().cpu().numpy())
-                    recurrent_hidden_statess.append(recurrent_hidden_states.detach().cpu().numpy())
-                    recurrent_hidden_statess_critic.append(recurrent_hidden_states_critic.detach().cpu().numpy())
+                        values.append(value.detach().cpu().numpy())
+                        actions.append(action.detach().cpu().numpy())
+                        action_log_probs.append(action_log_prob.detach().cpu().numpy())
+                        recurrent_hidden_statess.append(recurrent_hidden_states.detach().cpu().numpy())
+                        recurrent_hidden_statess_critic.append(recurrent_hidden_states_critic.detach().cpu().numpy())
             
             # rearrange action
-            actions_env = []
-            for i in range(args.n_rollout_threads):
-                one_hot_action_env = []
-                for agent_id in range(num_agents):
-                    if envs.action_space[agent_id].__class__.__name__ == 'MultiDiscrete':
-                        uc_action = []
-                        for j in range(envs.action_space[agent_id].shape):
-                            uc_one_hot_action = np.zeros(envs.action_space[agent_id].high[j]+1)
-                            uc_one_hot_action[actions[agent_id][i][j]] = 1
-                            uc_action.append(uc_one_hot_action)
-                        uc_action = np.concatenate(uc_action)
-                        one_hot_action_env.append(uc_action)
-                            
-                    elif envs.action_space[agent_id].__class__.__name__ == 'Discrete':    
-                        one_hot_action = np.zeros(envs.action_space[agent_id].n)
-                        one_hot_action[actions[agent_id][i]] = 1
-                        one_hot_action_env.append(one_hot_action)
-                    else:
-                        raise NotImplementedError
-                actions_env.append(one_hot_action_env)
+            # only the actions go back to the host for the envs
+            if torch.is_tensor(actions):
+                host_actions = actions.cpu().numpy()
+            else:
+                host_actions = actions
+            actions_env = action_encoder(host_actions, agent_major=not args.share_policy)
                
             # Obser reward and next obs
             obs, rewards, dones, infos, _ = envs.step(actions_env)
             
             # If done then clean the history of observations.
             # insert data in buffer
-            masks = []
-            for i, done in enumerate(dones): 
-                mask = []               
-                for agent_id in range(num_agents): 
-                    if done[agent_id]:    
-                        recurrent_hidden_statess[agent_id][i] = np.zeros(args.hidden_size).astype(np.float32)
-                        recurrent_hidden_statess_critic[agent_id][i] = np.zeros(args.hidden_size).astype(np.float32)    
-                        mask.append([0.0])
-                    else:
-                        mask.append([1.0])
-                masks.append(mask)
+            done_masks(dones, num_agents, masks)
+            if args.share_policy:
+                zero_where_done(dones, recurrent_hidden_statess, recurrent_hidden_statess_critic)
+            else:
+                for agent_id in range(num_agents):
+                    zero_where_done(dones[:, agent_id], recurrent_hidden_statess[agent_id], recurrent_hidden_statess_critic[agent_id])
                             
             if args.share_policy: 
                 share_obs = obs.reshape(args.n_rollout_threads, -1)        
-                share_obs = np.expand_dims(share_obs,1).repeat(num_agents,axis=1)    
+                share_obs = np.expand_dims(share_obs,1)
                 
                 rollouts.insert(share_obs, 
                             obs, 
-                            np.array(recurrent_hidden_statess).transpose(1,0,2), 
-                            np.array(recurrent_hidden_statess_critic).transpose(1,0,2), 
-                            np.array(actions).transpose(1,0,2),
-                            np.array(action_log_probs).transpose(1,0,2), 
-                            np.array(values).transpose(1,0,2),
+                            recurrent_hidden_statess, 
+                            recurrent_hidden_statess_critic, 
+                            actions,
+                            action_log_probs, 
+                            values,
                             rewards, 
                             masks)
             else:
@@ -342,25 +350,23 @@ def main():
                             np.array(masks)[:,agent_id])
                                             
         with torch.no_grad(): 
-            for agent_id in range(num_agents):         
-                if args.share_policy: 
-                    actor_critic.eval()                
-                    next_value,_,_ = actor_critic.get_value(agent_id,
-                                                   torch.FloatTensor(rollouts.share_obs[-1,:,agent_id]), 
-                                                   torch.FloatTensor(rollouts.obs[-1,:,agent_id]), 
-                                                   torch.FloatTensor(rollouts.recurrent_hidden_states[-1,:,agent_id]),
-                                                   torch.FloatTensor(rollouts.recurrent_hidden_states_critic[-1,:,agent_id]),
-                                                   torch.FloatTensor(rollouts.masks[-1,:,agent_id]))
-                    next_value = next_value.detach().cpu().numpy()
-                    rollouts.compute_returns(agent_id,
-                                    next_value, 
+            if args.share_policy:
+                actor_critic.eval()
+                next_values,_,_ = actor_critic.get_value_all(agent_ids,
+                                               rollouts.get_share_obs(-1), 
+                                               rollouts.obs[-1], 
+                                               rollouts.recurrent_hidden_states[-1],
+                                               rollouts.recurrent_hidden_states_critic[-1],
+                                               rollouts.masks[-1])
+                rollouts.compute_returns_all(next_values,
                                     args.use_gae, 
                                     args.gamma,
                                     args.gae_lambda, 
                                     args.use_proper_time_limits,
                                     args.use_popart,
                                     agents.value_normalizer)
-                else:
+            else:
+                for agent_id in range(num_agents):
                     actor_critic[agent_id].eval()
                     next_value,_,_ = actor_critic[agent_id].get_value(agent_id,
                                                              torch.FloatTensor(rollouts[agent_id].share_obs[-1,:]), 
@@ -385,7 +391,7 @@ def main():
             for agent_id in range(num_agents):
                 rew = []
                 for i in range(rollouts.rewards.shape[1]):
-                    rew.append(np.sum(rollouts.rewards[:,i,agent_id]))
+                    rew.append(float(rollouts.rewards[:,i,agent_id].sum()))
                 logger.add_scalars('agent%i/average_episode_reward' % agent_id,
                     {'average_episode_reward': np.mean(rew)},
                     (episode + 1) * args.episode_length * args.n_rollout_threads)
@@ -398,11 +404,16 @@ def main():
             
             for agent_id in range(num_agents):
                 actor_critic[agent_id].train()
-                value_loss, action_loss, dist_entropy = agents[agent_id].update_single(agent_id, rollouts[agent_id])
-                value_losses.append(value_loss)
-                action_losses.append(action_loss)
-                dist_entropies.append(dist_entropy)
-                    
+            if args.use_grouped_update:
+                value_losses, action_losses, dist_entropies = update_group(agents, rollouts, single=True)
+            else:
+                for agent_id in range(num_agents):
+                    value_loss, action_loss, dist_entropy = agents[agent_id].update_single(agent_id, rollouts[agent_id])
+                    value_losses.append(value_loss)
+                    action_losses.append(action_loss)
+                    dist_entropies.append(dist_entropy)
+
+            for agent_id in range(num_agents):
                 rew = []
                 for i in range(rollouts[agent_id].rewards.shape[1]):
                     rew.append(np.sum(rollouts[agent_id].rewards[:,i]))
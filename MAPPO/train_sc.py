@@ -13,13 +13,16 @@ import torch.nn.functional as F
 from tensorboardX import SummaryWriter
 
 from envs import StarCraft2Env, get_map_params
-from algorithm.ppo import PPO
+from algorithm.ppo import PPO, update_group
 from algorithm.model import Policy
 
 from config import get_config
-from utils.env_wrappers import SubprocVecEnv, DummyVecEnv
+from utils.env_wrappers import SubprocVecEnv, DummyVecEnv, ShmemSubprocVecEnv
+from utils.metrics import AsyncSummaryWriter
 from utils.util import update_linear_schedule
 from utils.storage import RolloutStorage
+from utils.torch_storage import TorchRolloutStorage
+from utils.encoding import ActionEncoder, done_masks, zero_where_done
 import shutil
 import numpy as np
 
@@ -36,6 +39,8 @@ def make_parallel_env(args):
         return init_env
     if args.n_rollout_threads == 1:
         return DummyVecEnv([get_env_fn(0)])
+    elif args.use_shmem_env:
+        return ShmemSubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
     else:
         return SubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
         
@@ -87,13 +92,14 @@ def main():
     save_dir = run_dir / 'models'
     os.makedirs(str(log_dir))
     os.makedirs(str(save_dir))
-    logger = SummaryWriter(str(log_dir)) 
+    logger = AsyncSummaryWriter(SummaryWriter(str(log_dir)))
 
     # env
     envs = make_parallel_env(args)
     if args.eval:
         eval_env = make_eval_env(args)
     num_agents = get_map_params(args.map_name)["n_agents"]
+    agent_ids = torch.arange(num_agents)
     #Policy network
 
     if args.share_policy:
@@ -142,6 +148,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                    
         #replay buffer
@@ -150,7 +158,8 @@ def main():
                     args.n_rollout_threads,
                     envs.observation_space[0], 
                     envs.action_space[0],
-                    args.hidden_size)        
+                    args.hidden_size,
+                    dedup_share_obs=args.use_dedup_share_obs)        
     else:
         actor_critic = []
         agents = []
@@ -200,6 +209,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                                
             actor_critic.append(ac)
@@ -211,7 +222,8 @@ def main():
                     args.n_rollout_threads,
                     envs.observation_space[0], 
                     envs.action_space[0],
-                    args.hidden_size)
+                    args.hidden_size,
+                    dedup_share_obs=args.use_dedup_share_obs)
     
     # reset env 
     obs, available_actions = envs.reset()
@@ -222,12 +234,18 @@ def main():
     else:
         share_obs = obs.reshape(args.n_rollout_threads, -1)
         
-    share_obs = np.expand_dims(share_obs,1).repeat(num_agents,axis=1)    
+    # [threads, 1, dim], broadcast over the agents unless the storage keeps it de-duplicated
+    share_obs = np.expand_dims(share_obs,1)
     rollouts.share_obs[0] = share_obs.copy() 
     rollouts.obs[0] = obs.copy()  
     rollouts.available_actions[0] = available_actions.copy()                
     rollouts.recurrent_hidden_states = np.zeros(rollouts.recurrent_hidden_states.shape).astype(np.float32)
     rollouts.recurrent_hidden_states_critic = np.zeros(rollouts.recurrent_hidden_states_critic.shape).astype(np.float32)
+    if args.use_device_storage:
+        rollouts = TorchRolloutStorage(rollouts, device)
+    
+    action_encoder = ActionEncoder(envs.action_space, args.n_rollout_threads)
+    masks = np.ones((args.n_rollout_threads, num_agents, 1)).astype(np.float32)
     
     # run
     start = time.time()
@@ -246,65 +264,59 @@ def main():
 
         for step in range(args.episode_length):
             # Sample actions
-            values = []
-            actions= []
-            action_log_probs = []
-            recurrent_hidden_statess = []
-            recurrent_hidden_statess_critic = []
-            
-            with torch.no_grad():                
-                for agent_id in range(num_agents):
-                    if args.share_policy:
-                        actor_critic.eval()
-                        value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic.act(agent_id,
-                        torch.tensor(rollouts.share_obs[step,:,agent_id]), 
-                        torch.tensor(rollouts.obs[step,:,agent_id]), 
-                        torch.tensor(rollouts.recurrent_hidden_states[step,:,agent_id]), 
-                        torch.tensor(rollouts.recurrent_hidden_states_critic[step,:,agent_id]),
-                        torch.tensor(rollouts.masks[step,:,agent_id]),
-                        torch.tensor(rollouts.available_actions[step,:,agent_id]))
-                    else:
+            with torch.no_grad():
+                if args.share_policy:
+                    actor_critic.eval()
+                    values, actions, action_log_probs, recurrent_hidden_statess, recurrent_hidden_statess_critic = actor_critic.act_all(agent_ids,
+                        rollouts.get_share_obs(step), 
+                        rollouts.obs[step], 
+                        rollouts.recurrent_hidden_states[step], 
+                        rollouts.recurrent_hidden_states_critic[step],
+                        rollouts.masks[step],
+                        rollouts.available_actions[step])
+                else:
+                    values = []
+                    actions= []
+                    action_log_probs = []
+                    recurrent_hidden_statess = []
+                    recurrent_hidden_statess_critic = []
+                    for agent_id in range(num_agents):
                         actor_critic[agent_id].eval()
                         value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic[agent_id].act(agent_id,
-                        torch.tensor(rollouts.share_obs[step,:,agent_id]), 
-                        torch.tensor(rollouts.obs[step,:,agent_id]), 
-                        torch.tensor(rollouts.recurrent_hidden_states[step,:,agent_id]), 
-                        torch.tensor(rollouts.recurrent_hidden_states_critic[step,:,agent_id]),
-                        torch.tensor(rollouts.masks[step,:,agent_id]),
-                        torch.tensor(rollouts.available_actions[step,:,agent_id]))
+                        torch.as_tensor(rollouts.get_agent_share_obs(step, agent_id)), 
+                        torch.as_tensor(rollouts.obs[step,:,agent_id]), 
+                        torch.as_tensor(rollouts.recurrent_hidden_states[step,:,agent_id]), 
+                        torch.as_tensor(rollouts.recurrent_hidden_states_critic[step,:,agent_id]),
+                        torch.as_tensor(rollouts.masks[step,:,agent_id]),
+                        torch.as_tensor(rollouts.available_actions[step,:,agent_id]))
                         
-                    values.append(value.detach().cpu().numpy())
-                    actions.append(action.detach().cpu().numpy())
-                    action_log_probs.append(action_log_prob.detach().cpu().numpy())
-                    recurrent_hidden_statess.append(recurrent_hidden_states.detach().cpu().numpy())
-                    recurrent_hidden_statess_critic.append(recurrent_hidden_states_critic.detach().cpu().numpy())
+                        values.append(value.detach().cpu().numpy())
+                        actions.append(action.detach().cpu().numpy())
+                        action_log_probs.append(action_log_prob.detach().cpu().numpy())
+                        recurrent_hidden_statess.append(recurrent_hidden_states.detach().cpu().numpy())
+                        recurrent_hidden_statess_critic.append(recurrent_hidden_states_critic.detach().cpu().numpy())
+                    # [agents, threads, dim] --> [threads, agents, dim]
+                    values = np.array(values).transpose(1,0,2)
+                    actions = np.array(actions).transpose(1,0,2)
+                    action_log_probs = np.array(action_log_probs).transpose(1,0,2)
+                    recurrent_hidden_statess = np.array(recurrent_hidden_statess).transpose(1,0,2)
+                    recurrent_hidden_statess_critic = np.array(recurrent_hidden_statess_critic).transpose(1,0,2)
             
             # rearrange action           
-            actions_env = []
-            for i in range(args.n_rollout_threads):
-                one_hot_action_env = []
-                for agent_id in range(num_agents):
-                    one_hot_action = np.zeros(envs.action_space[agent_id].n)
-                    one_hot_action[actions[agent_id][i]] = 1
-                    one_hot_action_env.append(one_hot_action)
-                actions_env.append(one_hot_action_env)
+            # only the actions go back to the host for the envs
+            if torch.is_tensor(actions):
+                host_actions = actions.cpu().numpy()
+            else:
+                host_actions = actions
+            actions_env = action_encoder(host_actions)
                        
             # Obser reward and next obs
             obs, reward, dones, infos, available_actions = envs.step(actions_env)
 
             # If done then clean the history of observations.
             # insert data in buffer
-            masks = []
-            for i, done in enumerate(dones): 
-                mask = []               
-                for agent_id in range(num_agents): 
-                    if done:    
-                        recurrent_hidden_statess[agent_id][i] = np.zeros(args.hidden_size).astype(np.float32)
-                        recurrent_hidden_statess_critic[agent_id][i] = np.zeros(args.hidden_size).astype(np.float32)    
-                        mask.append([0.0])
-                    else:
-                        mask.append([1.0])
-                masks.append(mask)
+            done_masks(dones, num_agents, masks)
+            zero_where_done(dones, recurrent_hidden_statess, recurrent_hidden_statess_critic)
                 
             bad_masks = []
             high_masks = []
@@ -326,15 +338,15 @@ def main():
                             
             if len(envs.observation_space[0]) == 3:
                 share_obs = obs.reshape(args.n_rollout_threads, -1, envs.observation_space[0][1], envs.observation_space[0][2])
-                share_obs = np.expand_dims(share_obs,1).repeat(num_agents,axis=1)
+                share_obs = np.expand_dims(share_obs,1)
                 
                 rollouts.insert(share_obs, 
                                 obs, 
-                                np.array(recurrent_hidden_statess).transpose(1,0,2), 
-                                np.array(recurrent_hidden_statess_critic).transpose(1,0,2), 
-                                np.array(actions).transpose(1,0,2),
-                                np.array(action_log_probs).transpose(1,0,2), 
-                                np.array(values).transpose(1,0,2),
+                                recurrent_hidden_statess, 
+                                recurrent_hidden_statess_critic, 
+                                actions,
+                                action_log_probs, 
+                                values,
                                 reward, 
                                 masks, 
                                 bad_masks,
@@ -342,15 +354,15 @@ def main():
                                 available_actions)
             else:
                 share_obs = obs.reshape(args.n_rollout_threads, -1)
-                share_obs = np.expand_dims(share_obs,1).repeat(num_agents,axis=1)
+                share_obs = np.expand_dims(share_obs,1)
         
                 rollouts.insert(share_obs, 
                                 obs, 
-                                np.array(recurrent_hidden_statess).transpose(1,0,2), 
-                                np.array(recurrent_hidden_statess_critic).transpose(1,0,2), 
-                                np.array(actions).transpose(1,0,2),
-                                np.array(action_log_probs).transpose(1,0,2), 
-                                np.array(values).transpose(1,0,2),
+                                recurrent_hidden_statess, 
+                                recurrent_hidden_statess_critic, 
+                                actions,
+                                action_log_probs, 
+                                values,
                                 reward, 
                                 masks, 
                                 bad_masks,
@@ -358,41 +370,37 @@ def main():
                                 available_actions)
                            
         with torch.no_grad(): 
-            for agent_id in range(num_agents):         
-                if args.share_policy: 
-                    actor_critic.eval()                
-                    next_value,_,_ = actor_critic.get_value(agent_id,
-                                                   torch.tensor(rollouts.share_obs[-1,:,agent_id]), 
-                                                   torch.tensor(rollouts.obs[-1,:,agent_id]), 
-                                                   torch.tensor(rollouts.recurrent_hidden_states[-1,:,agent_id]),
-                                                   torch.tensor(rollouts.recurrent_hidden_states_critic[-1,:,agent_id]),
-                                                   torch.tensor(rollouts.masks[-1,:,agent_id]))
-                    next_value = next_value.detach().cpu().numpy()
-                    rollouts.compute_returns(agent_id,
-                                    next_value, 
-                                    args.use_gae, 
-                                    args.gamma,
-                                    args.gae_lambda, 
-                                    args.use_proper_time_limits,
-                                    args.use_popart,
-                                    agents.value_normalizer)
-                else:
+            if args.share_policy:
+                actor_critic.eval()
+                next_values,_,_ = actor_critic.get_value_all(agent_ids,
+                                               rollouts.get_share_obs(-1), 
+                                               rollouts.obs[-1], 
+                                               rollouts.recurrent_hidden_states[-1],
+                                               rollouts.recurrent_hidden_states_critic[-1],
+                                               rollouts.masks[-1])
+            else:
+                next_values = []
+                for agent_id in range(num_agents):
                     actor_critic[agent_id].eval()
                     next_value,_,_ = actor_critic[agent_id].get_value(agent_id,
-                                                   torch.tensor(rollouts.share_obs[-1,:,agent_id]), 
-                                                   torch.tensor(rollouts.obs[-1,:,agent_id]), 
-                                                   torch.tensor(rollouts.recurrent_hidden_states[-1,:,agent_id]),
-                                                   torch.tensor(rollouts.recurrent_hidden_states_critic[-1,:,agent_id]),
-                                                   torch.tensor(rollouts.masks[-1,:,agent_id]))
-                    next_value = next_value.detach().cpu().numpy()
-                    rollouts.compute_returns(agent_id,
-                                    next_value, 
+                                                   torch.as_tensor(rollouts.get_agent_share_obs(-1, agent_id)), 
+                                                   torch.as_tensor(rollouts.obs[-1,:,agent_id]), 
+                                                   torch.as_tensor(rollouts.recurrent_hidden_states[-1,:,agent_id]),
+                                                   torch.as_tensor(rollouts.recurrent_hidden_states_critic[-1,:,agent_id]),
+                                                   torch.as_tensor(rollouts.masks[-1,:,agent_id]))
+                    next_values.append(next_value.detach().cpu().numpy())
+                next_values = np.array(next_values).transpose(1,0,2)
+            if args.share_policy:
+                value_normalizer = agents.value_normalizer
+            else:
+                value_normalizer = [agents[agent_id].value_normalizer for agent_id in range(num_agents)]
+            rollouts.compute_returns_all(next_values,
                                     args.use_gae, 
                                     args.gamma,
                                     args.gae_lambda, 
                                     args.use_proper_time_limits,
                                     args.use_popart,
-                                    agents[agent_id].value_normalizer)
+                                    value_normalizer)
 
          
         # update the network
@@ -401,7 +409,7 @@ def main():
             value_loss, action_loss, dist_entropy = agents.update_share(num_agents, rollouts)
                            
             logger.add_scalars('reward',
-                {'reward': np.mean(rollouts.rewards)},
+                {'reward': float(rollouts.rewards.mean())},
                 (episode + 1) * args.episode_length * args.n_rollout_threads)
         else:
             value_losses = []
@@ -410,13 +418,18 @@ def main():
             
             for agent_id in range(num_agents):
                 actor_critic[agent_id].train()
-                value_loss, action_loss, dist_entropy = agents[agent_id].update(agent_id, rollouts)
-                value_losses.append(value_loss)
-                action_losses.append(action_loss)
-                dist_entropies.append(dist_entropy)
-                                    
+            if args.use_grouped_update:
+                value_losses, action_losses, dist_entropies = update_group(agents, rollouts)
+            else:
+                for agent_id in range(num_agents):
+                    value_loss, action_loss, dist_entropy = agents[agent_id].update(agent_id, rollouts)
+                    value_losses.append(value_loss)
+                    action_losses.append(action_loss)
+                    dist_entropies.append(dist_entropy)
+
+            for agent_id in range(num_agents):
                 logger.add_scalars('agent%i/reward' % agent_id,
-                    {'reward': np.mean(rollouts.rewards[:,:,agent_id])},
+                    {'reward': float(rollouts.rewards[:,:,agent_id].mean())},
                     (episode + 1) * args.episode_length * args.n_rollout_threads)
                                                                      
         # clean the buffer and reset
@@ -13,13 +13,15 @@ import torch.nn.functional as F
 from tensorboardX import SummaryWriter
 
 from envs import StarCraft2Env, get_map_params
-from algorithm.ppo import PPO
+from algorithm.ppo import PPO, update_group
 from algorithm.share_model import Policy
 
 from config import get_config
-from utils.env_wrappers import ShareSubprocVecEnv
+from utils.env_wrappers import ShareSubprocVecEnv, ShareShmemSubprocVecEnv
+from utils.metrics import AsyncSummaryWriter
 from utils.util import update_linear_schedule
 from utils.share_storage import RolloutStorage
+from utils.encoding import ActionEncoder, done_masks, zero_where_done
 import shutil
 import numpy as np
 
@@ -36,6 +38,8 @@ def make_parallel_env(args):
         return init_env
     if args.n_rollout_threads == 1:
         return ShareSubprocVecEnv([get_env_fn(0)])
+    elif args.use_shmem_env:
+        return ShareShmemSubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
     else:
         return ShareSubprocVecEnv([get_env_fn(i) for i in range(args.n_rollout_threads)])
         
@@ -87,7 +91,7 @@ def main():
     save_dir = run_dir / 'models'
     os.makedirs(str(log_dir))
     os.makedirs(str(save_dir))
-    logger = SummaryWriter(str(log_dir)) 
+    logger = AsyncSummaryWriter(SummaryWriter(str(log_dir)))
 
     # env
     envs = make_parallel_env(args)
@@ -140,6 +144,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                    
         #replay buffer
@@ -149,7 +155,8 @@ def main():
                     envs.observation_space[0], 
                     envs.share_observation_space[0], 
                     envs.action_space[0],
-                    args.hidden_size)        
+                    args.hidden_size,
+                    dedup_share_obs=args.use_dedup_share_obs)        
     else:
         actor_critic = []
         agents = []
@@ -197,6 +204,8 @@ def main():
                    huber_delta=args.huber_delta,
                    use_popart=args.use_popart,
                    use_value_high_masks=args.use_value_high_masks,
+                   use_pin_memory=args.use_pin_memory,
+                   metrics_interval=args.metrics_interval,
                    device=device)
                                
             actor_critic.append(ac)
@@ -209,19 +218,24 @@ def main():
                     envs.observation_space[0],
                     envs.share_observation_space[0],  
                     envs.action_space[0],
-                    args.hidden_size)
+                    args.hidden_size,
+                    dedup_share_obs=args.use_dedup_share_obs)
     
     # reset env 
     obs, share_obs, available_actions = envs.reset()
     
     # replay buffer       
-    share_obs = np.expand_dims(share_obs,1).repeat(num_agents,axis=1)    
+    # [threads, 1, dim], broadcast over the agents unless the storage keeps it de-duplicated
+    share_obs = np.expand_dims(share_obs,1)
     rollouts.share_obs[0] = share_obs.copy() 
     rollouts.obs[0] = obs.copy()  
     rollouts.available_actions[0] = available_actions.copy()                
     rollouts.recurrent_hidden_states = np.zeros(rollouts.recurrent_hidden_states.shape).astype(np.float32)
     rollouts.recurrent_hidden_states_critic = np.zeros(rollouts.recurrent_hidden_states_critic.shape).astype(np.float32)
     
+    action_encoder = ActionEncoder(envs.action_space, args.n_rollout_threads)
+    masks = np.ones((args.n_rollout_threads, num_agents, 1)).astype(np.float32)
+    
     # run
     start = time.time()
     episodes = int(args.num_env_steps) // args.episode_length // args.n_rollout_threads
@@ -239,63 +253,52 @@ def main():
 
         for step in range(args.episode_length):
             # Sample actions
-            values = []
-            actions= []
-            action_log_probs = []
-            recurrent_hidden_statess = []
-            recurrent_hidden_statess_critic = []
-            
-            with torch.no_grad():                
-                for agent_id in range(num_agents):
-                    if args.share_policy:
-                        actor_critic.eval()
-                        value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic.act(torch.tensor(rollouts.share_obs[step,:,agent_id]), 
-                                        torch.tensor(rollouts.obs[step,:,agent_id]), 
-                                        torch.tensor(rollouts.recurrent_hidden_states[step,:,agent_id]), 
-                                        torch.tensor(rollouts.recurrent_hidden_states_critic[step,:,agent_id]),
-                                        torch.tensor(rollouts.masks[step,:,agent_id]),
-                                        torch.tensor(rollouts.available_actions[step,:,agent_id]))
-                    else:
+            with torch.no_grad():
+                if args.share_policy:
+                    actor_critic.eval()
+                    values, actions, action_log_probs, recurrent_hidden_statess, recurrent_hidden_statess_critic = actor_critic.act_all(rollouts.get_share_obs(step), 
+                                    rollouts.obs[step], 
+                                    rollouts.recurrent_hidden_states[step], 
+                                    rollouts.recurrent_hidden_states_critic[step],
+                                    rollouts.masks[step],
+                                    rollouts.available_actions[step])
+                else:
+                    values = []
+                    actions= []
+                    action_log_probs = []
+                    recurrent_hidden_statess = []
+                    recurrent_hidden_statess_critic = []
+                    for agent_id in range(num_agents):
                         actor_critic[agent_id].eval()
-                        value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic[agent_id].act(torch.tensor(rollouts.share_obs[step,:,agent_id]), 
+                        value, action, action_log_prob, recurrent_hidden_states, recurrent_hidden_states_critic = actor_critic[agent_id].act(torch.tensor(rollouts.get_agent_share_obs(step, agent_id)), 
                                         torch.tensor(rollouts.obs[step,:,agent_id]), 
                                         torch.tensor(rollouts.recurrent_hidden_states[step,:,agent_id]), 
                                         torch.tensor(rollouts.recurrent_hidden_states_critic[step,:,agent_id]),
                                         torch.tensor(rollouts.masks[step,:,agent_id]),
                                         torch.tensor(rollouts.available_actions[step,:,agent_id]))
                         
-                    values.append(value.detach().cpu().numpy())
-                    actions.append(action.detach().cpu().numpy())
-                    action_log_probs.append(action_log_prob.detach().cpu().numpy())
-                    recurrent_hidden_statess.append(recurrent_hidden_states.detach().cpu().numpy())
-                    recurrent_hidden_statess_critic.append(recurrent_hidden_states_critic.detach().cpu().numpy())
+                        values.append(value.detach().cpu().numpy())
+                        actions.append(action.detach().cpu().numpy())
+                        action_log_probs.append(action_log_prob.detach().cpu().numpy())
+                        recurrent_hidden_statess.append(recurrent_hidden_states.detach().cpu().numpy())
+                        recurrent_hidden_statess_critic.append(recurrent_hidden_states_critic.detach().cpu().numpy())
+                    # [agents, threads, dim] --> [threads, agents, dim]
+                    values = np.array(values).transpose(1,0,2)
+                    actions = np.array(actions).transpose(1,0,2)
+                    action_log_probs = np.array(action_log_probs).transpose(1,0,2)
+                    recurrent_hidden_statess = np.array(recurrent_hidden_statess).transpose(1,0,2)
+                    recurrent_hidden_statess_critic = np.array(recurrent_hidden_statess_critic).transpose(1,0,2)
             
             # rearrange action           
-            actions_env = []
-            for i in range(args.n_rollout_threads):
-                one_hot_action_env = []
-                for agent_id in range(num_agents):
-                    one_hot_action = np.zeros(envs.action_space[agent_id].n)
-                    one_hot_action[actions[agent_id][i]] = 1
-                    one_hot_action_env.append(one_hot_action)
-                actions_env.append(one_hot_action_env)
+            actions_env = action_encoder(actions)
                        
             # Obser reward and next obs
             obs, share_obs, reward, dones, infos, available_actions = envs.step(actions_env)
 
             # If done then clean the history of observations.
             # insert data in buffer
-            masks = []
-            for i, done in enumerate(dones): 
-                mask = []               
-                for agent_id in range(num_agents): 
-                    if done:    
-                        recurrent_hidden_statess[agent_id][i] = np.zeros(args.hidden_size).astype(np.float32)
-                        recurrent_hidden_statess_critic[agent_id][i] = np.zeros(args.hidden_size).astype(np.float32)    
-                        mask.append([0.0])
-                    else:
-                        mask.append([1.0])
-                masks.append(mask)
+            done_masks(dones, num_agents, masks)
+            zero_where_done(dones, recurrent_hidden_statess, recurrent_hidden_statess_critic)
                 
             bad_masks = []
             high_masks = []
@@ -316,30 +319,30 @@ def main():
                 high_masks.append(high_mask)
                             
             if len(envs.observation_space[0]) == 3:
-                share_obs = np.expand_dims(share_obs,1).repeat(num_agents,axis=1)
+                share_obs = np.expand_dims(share_obs,1)
                 
                 rollouts.insert(share_obs, 
                                 obs, 
-                                np.array(recurrent_hidden_statess).transpose(1,0,2), 
-                                np.array(recurrent_hidden_statess_critic).transpose(1,0,2), 
-                                np.array(actions).transpose(1,0,2),
-                                np.array(action_log_probs).transpose(1,0,2), 
-                                np.array(values).transpose(1,0,2),
+                                recurrent_hidden_statess, 
+                                recurrent_hidden_statess_critic, 
+                                actions,
+                                action_log_probs, 
+                                values,
                                 reward, 
                                 masks, 
                                 bad_masks,
                                 high_masks,
                                 available_actions)
             else:
-                share_obs = np.expand_dims(share_obs,1).repeat(num_agents,axis=1)
+                share_obs = np.expand_dims(share_obs,1)
         
                 rollouts.insert(share_obs, 
                                 obs, 
-                                np.array(recurrent_hidden_statess).transpose(1,0,2), 
-                                np.array(recurrent_hidden_statess_critic).transpose(1,0,2), 
-                                np.array(actions).transpose(1,0,2),
-                                np.array(action_log_probs).transpose(1,0,2), 
-                                np.array(values).transpose(1,0,2),
+                                recurrent_hidden_statess, 
+                                recurrent_hidden_statess_critic, 
+                                actions,
+                                action_log_probs, 
+                                values,
                                 reward, 
                                 masks, 
                                 bad_masks,
@@ -347,39 +350,35 @@ def main():
                                 available_actions)
                            
         with torch.no_grad(): 
-            for agent_id in range(num_agents):         
-                if args.share_policy: 
-                    actor_critic.eval()                
-                    next_value,_,_ = actor_critic.get_value(torch.tensor(rollouts.share_obs[-1,:,agent_id]), 
-                                                   torch.tensor(rollouts.obs[-1,:,agent_id]), 
-                                                   torch.tensor(rollouts.recurrent_hidden_states[-1,:,agent_id]),
-                                                   torch.tensor(rollouts.recurrent_hidden_states_critic[-1,:,agent_id]),
-                                                   torch.tensor(rollouts.masks[-1,:,agent_id]))
-                    next_value = next_value.detach().cpu().numpy()
-                    rollouts.compute_returns(agent_id,
-                                    next_value, 
-                                    args.use_gae, 
-                                    args.gamma,
-                                    args.gae_lambda, 
-                                    args.use_proper_time_limits,
-                                    args.use_popart,
-                                    agents.value_normalizer)
-                else:
+            if args.share_policy:
+                actor_critic.eval()
+                next_values,_,_ = actor_critic.get_value_all(rollouts.get_share_obs(-1), 
+                                               rollouts.obs[-1], 
+                                               rollouts.recurrent_hidden_states[-1],
+                                               rollouts.recurrent_hidden_states_critic[-1],
+                                               rollouts.masks[-1])
+            else:
+                next_values = []
+                for agent_id in range(num_agents):
                     actor_critic[agent_id].eval()
-                    next_value,_,_ = actor_critic[agent_id].get_value(torch.tensor(rollouts.share_obs[-1,:,agent_id]), 
+                    next_value,_,_ = actor_critic[agent_id].get_value(torch.tensor(rollouts.get_agent_share_obs(-1, agent_id)), 
                                                    torch.tensor(rollouts.obs[-1,:,agent_id]), 
                                                    torch.tensor(rollouts.recurrent_hidden_states[-1,:,agent_id]),
                                                    torch.tensor(rollouts.recurrent_hidden_states_critic[-1,:,agent_id]),
                                                    torch.tensor(rollouts.masks[-1,:,agent_id]))
-                    next_value = next_value.detach().cpu().numpy()
-                    rollouts.compute_returns(agent_id,
-                                    next_value, 
+                    next_values.append(next_value.detach().cpu().numpy())
+                next_values = np.array(next_values).transpose(1,0,2)
+            if args.share_policy:
+                value_normalizer = agents.value_normalizer
+            else:
+                value_normalizer = [agents[agent_id].value_normalizer for agent_id in range(num_agents)]
+            rollouts.compute_returns_all(next_values,
                                     args.use_gae, 
                                     args.gamma,
                                     args.gae_lambda, 
                                     args.use_proper_time_limits,
                                     args.use_popart,
-                                    agents[agent_id].value_normalizer)
+                                    value_normalizer)
 
          
         # update the network
@@ -397,11 +396,16 @@ def main():
             
             for agent_id in range(num_agents):
                 actor_critic[agent_id].train()
-                value_loss, action_loss, dist_entropy = agents[agent_id].update(agent_id, rollouts)
-                value_losses.append(value_loss)
-                action_losses.append(action_loss)
-                dist_entropies.append(dist_entropy)
-                                    
+            if args.use_grouped_update:
+                value_losses, action_losses, dist_entropies = update_group(agents, rollouts)
+            else:
+                for agent_id in range(num_agents):
+                    value_loss, action_loss, dist_entropy = agents[agent_id].update(agent_id, rollouts)
+                    value_losses.append(value_loss)
+                    action_losses.append(action_loss)
+                    dist_entropies.append(dist_entropy)
+
+            for agent_id in range(num_agents):
                 logger.add_scalars('agent%i/reward' % agent_id,
                     {'reward': np.mean(rollouts.rewards[:,:,agent_id])},
                     (episode + 1) * args.episode_length * args.n_rollout_threads)
@@ -0,0 +1,93 @@
+import torch
+
+def to_chunks(data_chunk_length, x):
+    """[T*N, Dim] flat array --> [C=T*N/L, L, Dim] tensor sharing x's memory, the tail that does not fill a chunk is dropped."""
+    data_chunks = x.shape[0] // data_chunk_length
+    x = torch.as_tensor(x)
+    return x[:data_chunks * data_chunk_length].reshape(data_chunks, data_chunk_length, *x.shape[1:])
+
+class PinnedStaging(object):
+    """
+    Pinned host buffers, one [N, L, Dim] buffer per chunk field, that chunk_generator gathers the
+    minibatches into before the asynchronous copy to device. Allocated once per update and reused by
+    every minibatch of every ppo epoch; two sets alternate, and a set is only refilled once the copy
+    out of it has finished.
+    """
+    def __init__(self, chunks, num_mini_batch):
+        mini_batch_size = chunks[0].shape[0] // num_mini_batch
+        self.buffers = [[torch.empty((mini_batch_size, *x.shape[1:]), dtype=x.dtype).pin_memory() for x in chunks]
+                        for _ in range(2)]
+        self.events = [None, None]
+        self.turn = 0
+
+    def next(self):
+        """ The buffer set to gather the next minibatch into, once it is free again """
+        self.turn = 1 - self.turn
+        if self.events[self.turn] is not None:
+            self.events[self.turn].synchronize()
+        return self.buffers[self.turn]
+
+    def record(self):
+        """ Mark the copies out of the current buffer set as queued on the current stream """
+        self.events[self.turn] = torch.cuda.Event()
+        self.events[self.turn].record()
+
+def _gather_into(x, indices, out):
+    if isinstance(x, GatherChunks):
+        return x.index_select(0, indices, out=out)
+    return torch.index_select(x, 0, indices, out=out)
+
+def chunk_generator(chunks, num_mini_batch, pin_memory=False, device=None):
+    """
+    Serve minibatches of whole chunks out of [C, L, Dim] tensors (hidden states as [C, 1, Dim]),
+    one index gather per field. Batches come out as [N*L, Dim] ([N, Dim] for hidden states),
+    in the same order and with the same sampling as the per-chunk loop they replace.
+    With pin_memory (True, or the PinnedStaging of the update) host chunks are gathered straight
+    into pinned buffers and copied to a cuda device asynchronously.
+    """
+    data_chunks = chunks[0].shape[0]
+    mini_batch_size = data_chunks // num_mini_batch
+
+    rand = torch.randperm(data_chunks)
+    sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
+
+    staging = None
+    if pin_memory and device is not None and torch.device(device).type == 'cuda':
+        staging = pin_memory if isinstance(pin_memory, PinnedStaging) else PinnedStaging(chunks, num_mini_batch)
+
+    for indices in sampler:
+        batch = []
+        buffers = staging.next() if staging is not None else None
+        for k, x in enumerate(chunks):
+            if buffers is not None and x.device.type == 'cpu':
+                x = _gather_into(x, indices, buffers[k])
+                x = x.reshape(-1, *x.shape[2:]).to(device, non_blocking=True)
+            else:
+                x = x.index_select(0, indices.to(x.device))
+                x = x.reshape(-1, *x.shape[2:])
+                if device is not None:
+                    x = x.to(device)
+            batch.append(x)
+        if staging is not None:
+            staging.record()
+        yield tuple(batch)
+
+class GatherChunks(object):
+    """
+    [C, L, Dim] chunks read through an index: chunk position [c, l] holds source[index[c, l]].
+    Lets many chunk positions share one row of source (the de-duplicated share_obs)
+    without materializing the copies, chunk_generator gathers the rows per minibatch.
+    """
+    def __init__(self, source, index):
+        self.source = torch.as_tensor(source)
+        self.index = torch.as_tensor(index).to(self.source.device)
+        self.shape = self.index.shape + self.source.shape[1:]
+        self.device = self.source.device
+        self.dtype = self.source.dtype
+
+    def index_select(self, dim, indices, out=None):
+        rows = self.index.index_select(dim, indices)
+        if out is None:
+            return self.source[rows]
+        torch.index_select(self.source, 0, rows.reshape(-1), out=out.view(-1, *self.source.shape[1:]))
+        return out
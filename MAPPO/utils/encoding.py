@@ -0,0 +1,69 @@
+import torch
+import numpy as np
+
+class ActionEncoder(object):
+    """
+    Env-ready one-hot actions out of integer actions, for all threads and agents at once.
+    A Discrete action becomes an n-way one-hot, a MultiDiscrete one the concatenation of one
+    one-hot per component. The output is allocated once and rewritten on every call: a
+    [threads, agents, dim] array when every agent has the same action space, otherwise a
+    [threads][agents] nested list of per-agent rows.
+    """
+    def __init__(self, action_spaces, n_rollout_threads):
+        self.offsets = []
+        sizes = []
+        for action_space in action_spaces:
+            if action_space.__class__.__name__ == 'MultiDiscrete':
+                n = action_space.high + 1
+            elif action_space.__class__.__name__ == 'Discrete':
+                n = np.array([action_space.n])
+            else:
+                raise NotImplementedError
+            # column where every component's one-hot starts
+            self.offsets.append(np.concatenate(([0], np.cumsum(n)[:-1])).astype(np.int64))
+            sizes.append(int(np.sum(n)))
+
+        if len(set(sizes)) == 1:
+            self.env_actions = np.zeros((n_rollout_threads, len(sizes), sizes[0]))
+            self.one_hots = [self.env_actions[:, agent_id] for agent_id in range(len(sizes))]
+        else:
+            self.one_hots = [np.zeros((n_rollout_threads, size)) for size in sizes]
+            self.env_actions = [[one_hot[i] for one_hot in self.one_hots] for i in range(n_rollout_threads)]
+
+    def __call__(self, actions, agent_major=False):
+        """
+        actions is [threads, agents, action_dims], or a list with one [threads, action_dims]
+        array per agent with agent_major (the per-agent policies' outputs).
+        """
+        for agent_id, (one_hot, offsets) in enumerate(zip(self.one_hots, self.offsets)):
+            if agent_major:
+                action = np.asarray(actions[agent_id])
+            else:
+                action = actions[:, agent_id]
+            one_hot.fill(0.0)
+            np.put_along_axis(one_hot, action[:, :len(offsets)].astype(np.int64) + offsets, 1.0, axis=1)
+        return self.env_actions
+
+def done_masks(dones, num_agents, out=None):
+    """
+    [threads] (one done per env) or [threads, agents] dones --> [threads, agents, 1] float32
+    masks, 0.0 where done. out is an optional preallocated buffer to fill and return.
+    """
+    dones = np.asarray(dones, dtype=bool).reshape(len(dones), -1, 1)
+    if out is None:
+        out = np.empty((dones.shape[0], num_agents, 1), dtype=np.float32)
+    np.logical_not(dones, out=out)
+    return out
+
+def zero_where_done(dones, *xs):
+    """
+    Zero in place the entries of every [threads, ...] or [threads, agents, ...] x
+    (numpy array or torch tensor) whose env, or agent, is done.
+    None dones (envs that were not stepped) count as not done.
+    """
+    dones = np.asarray(dones, dtype=bool)
+    for x in xs:
+        if torch.is_tensor(x):
+            x[torch.as_tensor(dones, device=x.device)] = 0.0
+        else:
+            x[dones] = 0.0
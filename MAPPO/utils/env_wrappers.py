@@ -1,6 +1,8 @@
 """
 Modified from OpenAI Baselines code to work with multi-agent envs
 """
+import ctypes
+import multiprocessing as mp
 import numpy as np
 import torch
 from multiprocessing import Process, Pipe
@@ -340,6 +342,130 @@ class ChooseSubprocVecEnv(ShareVecEnv):
             p.join()
         self.closed = True
         
+def turnworker(remote, parent_remote, env_fn_wrapper):
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            # data is the action of the current player, the env reads the row of that player
+            action = np.full((env.players, 1), -1)
+            action[env.state.cur_player()] = data
+            ob, s_ob, reward, done, info, available_actions = env.step(action)
+            if done:
+                # the next game starts right away, its first observations are handed out by reset
+                next_game = env.reset(True)
+            else:
+                next_game = None
+            remote.send((ob, s_ob, reward, done, info, available_actions, env.state.cur_player(), next_game))
+        elif cmd == 'reset':
+            ob, s_ob, available_actions = env.reset(True)
+            remote.send((ob, s_ob, available_actions, env.state.cur_player()))
+        elif cmd == 'close':
+            env.close()
+            remote.close()
+            break
+        elif cmd == 'get_spaces':
+            remote.send((env.observation_space, env.share_observation_space, env.action_space))
+        else:
+            raise NotImplementedError
+
+class TurnSubprocVecEnv(ShareVecEnv):
+    """
+    Turn-based envs (Hanabi) where only the current player of an env acts. step() takes one
+    action per env, for that env's current player, messages only the active envs and also
+    returns the next current player of every env. A finished env starts its next game in the
+    same round trip, reset() then hands out its first observations without messaging it again.
+    """
+    def __init__(self, env_fns, spaces=None):
+        """
+        envs: list of gym environments to run in subprocesses
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
+        self.ps = [Process(target=turnworker, args=(work_remote, remote, CloudpickleWrapper(env_fn)))
+            for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)]
+        for p in self.ps:
+            p.daemon = True # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, share_observation_space, action_space = self.remotes[0].recv()
+        ShareVecEnv.__init__(self, len(env_fns), observation_space, share_observation_space, action_space)
+
+        num_agents = len(observation_space)
+        self.obs = np.zeros((nenvs, num_agents) + _space_shape(observation_space[0]), dtype=np.float32)
+        self.share_obs = np.zeros((nenvs, num_agents) + _space_shape(share_observation_space[0]), dtype=np.float32)
+        self.available_actions = np.zeros((nenvs, num_agents, action_space[0].n), dtype=np.float32)
+        self.current_players = np.zeros(nenvs, dtype=np.int64)
+        self.next_games = [None] * nenvs
+        self.active = np.ones(nenvs, dtype=bool)
+
+    def step(self, actions, active=None):
+        self.step_async(actions, active)
+        return self.step_wait()
+
+    def step_async(self, actions, active=None):
+        """ actions is [envs] (or [envs, 1]), active the [envs] mask of the envs to step (all by default) """
+        self.active = np.ones(self.num_envs, dtype=bool) if active is None else np.asarray(active, dtype=bool)
+        for i in np.nonzero(self.active)[0]:
+            self.remotes[i].send(('step', int(np.reshape(actions[i], -1)[0])))
+        self.waiting = True
+
+    def step_wait(self):
+        """
+        obs, share_obs, rewards, dones, infos and available_actions as ChooseSubprocVecEnv, zeros
+        (done False, info {}) for the envs that were not stepped, and the [envs] current players.
+        """
+        rewards = np.zeros((self.num_envs, self.obs.shape[1], 1), dtype=np.float32)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        infos = [{} for _ in range(self.num_envs)]
+        self.obs[~self.active] = 0.0
+        self.share_obs[~self.active] = 0.0
+        self.available_actions[~self.active] = 0.0
+        for i in np.nonzero(self.active)[0]:
+            ob, s_ob, reward, done, info, available_actions, player, next_game = self.remotes[i].recv()
+            self.obs[i] = ob
+            self.share_obs[i] = s_ob
+            rewards[i] = reward
+            dones[i] = done
+            infos[i] = info
+            self.available_actions[i] = available_actions
+            self.current_players[i] = player
+            self.next_games[i] = next_game
+        self.waiting = False
+        return self.obs.copy(), self.share_obs.copy(), rewards, dones, infos, self.available_actions.copy(), self.current_players.copy()
+
+    def reset(self, reset_choose):
+        obs = np.zeros_like(self.obs)
+        share_obs = np.zeros_like(self.share_obs)
+        available_actions = np.zeros_like(self.available_actions)
+        sent = [i for i in np.nonzero(reset_choose)[0] if self.next_games[i] is None]
+        for i in sent:
+            self.remotes[i].send(('reset', None))
+        for i in np.nonzero(reset_choose)[0]:
+            if self.next_games[i] is None:
+                obs[i], share_obs[i], available_actions[i], self.current_players[i] = self.remotes[i].recv()
+            else:
+                obs[i], share_obs[i], available_actions[i] = self.next_games[i]
+                self.next_games[i] = None
+        return obs, share_obs, available_actions
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for i in np.nonzero(self.active)[0]:
+                self.remotes[i].recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
+
 class DummyVecEnv(VecEnv):
     def __init__(self, env_fns):
         self.envs = [fn() for fn in env_fns]
@@ -381,4 +507,332 @@ class DummyVecEnv(VecEnv):
 
     def close(self):
         for env in self.envs:
-            env.close()        
\ No newline at end of file
+            env.close()        
+
+_NP_TO_CT = {np.float32: ctypes.c_float,
+             np.bool_: ctypes.c_bool}
+
+def _space_shape(space):
+    """Shape of one agent's array as stored in RolloutStorage."""
+    if space.__class__.__name__ == 'Box':
+        return tuple(space.shape)
+    elif space.__class__.__name__ == 'list':
+        if space[-1].__class__.__name__ == 'list':#attn
+            return (space[0],)
+        elif len(space) == 3:
+            return tuple(space)
+        else:
+            return (space[0],)
+    else:
+        raise NotImplementedError
+
+def _agents_shape(spaces):
+    shapes = [_space_shape(space) for space in spaces]
+    if not all(shape == shapes[0] for shape in shapes):
+        raise ValueError("shared memory vec envs need the same obs shape for every agent, got %s." % (shapes,))
+    return (len(spaces), *shapes[0])
+
+def _available_actions_shape(action_spaces):
+    if action_spaces[0].__class__.__name__ == 'Discrete':
+        return (len(action_spaces), action_spaces[0].n)
+    return None
+
+class _ShmemBuffer(object):
+    """
+    One preallocated [nenvs, *shape] array living in shared memory. Worker i
+    only ever writes to view(i), the parent reads the whole array after every
+    worker has answered on its pipe.
+    """
+    def __init__(self, ctx, nenvs, shape, dtype=np.float32):
+        self.shape = shape
+        self.dtype = dtype
+        self.array = ctx.RawArray(_NP_TO_CT[dtype], int(nenvs * np.prod(shape)))
+
+    def view(self, index=None):
+        out = np.frombuffer(self.array, dtype=self.dtype).reshape(-1, *self.shape)
+        if index is None:
+            return out
+        return out[index]
+
+def _shmem_write(bufs, index, values):
+    for buf, value in zip(bufs, values):
+        if buf is not None:
+            buf.view(index)[...] = np.asarray(value, dtype=buf.dtype).reshape(buf.shape)
+
+def _make_shmem_procs(self, ctx, env_fns, target, bufs):
+    self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(len(env_fns))])
+    self.ps = [ctx.Process(target=target, args=(work_remote, remote, CloudpickleWrapper(env_fn), index, bufs))
+        for index, (work_remote, remote, env_fn) in enumerate(zip(self.work_remotes, self.remotes, env_fns))]
+    for p in self.ps:
+        p.daemon = True # if the main process crashes, we should not cause things to hang
+        p.start()
+    for remote in self.work_remotes:
+        remote.close()
+
+def _get_spaces(env_fns, spaces, share=False):
+    if spaces is not None:
+        return spaces
+    # same as baselines' ShmemVecEnv: a throwaway env tells us the buffer sizes
+    dummy = env_fns[0]()
+    if share:
+        spaces = (dummy.observation_space, dummy.share_observation_space, dummy.action_space)
+    else:
+        spaces = (dummy.observation_space, dummy.action_space)
+    dummy.close()
+    del dummy
+    return spaces
+
+def simplifyshmemworker(remote, parent_remote, env_fn_wrapper, index, bufs):
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+    obs_buf, rew_buf, done_buf = bufs
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            ob, reward, done, info = env.step(data)
+            if 'bool' in done.__class__.__name__:
+                if done:
+                    ob = env.reset()
+            else:
+                if all(done):
+                    ob = env.reset()
+            _shmem_write((obs_buf, rew_buf, done_buf), index, (ob, reward, np.broadcast_to(done, done_buf.shape)))
+            remote.send((info, np.ndim(done) == 0))
+        elif cmd == 'reset':
+            ob = env.reset()
+            _shmem_write((obs_buf,), index, (ob,))
+            remote.send(None)
+        elif cmd == 'close':
+            env.close()
+            remote.close()
+            break
+        else:
+            raise NotImplementedError
+
+class SimplifyShmemSubprocVecEnv(VecEnv):
+    """
+    SimplifySubprocVecEnv that hands obs, rewards and dones over through shared
+    memory. Only the command and the info dicts go through the pipes.
+    """
+    def __init__(self, env_fns, spaces=None, context='fork'):
+        self.waiting = False
+        self.closed = False
+        ctx = mp.get_context(context)
+        nenvs = len(env_fns)
+        observation_space, action_space = _get_spaces(env_fns, spaces)
+        num_agents = len(observation_space)
+        self.obs_buf = _ShmemBuffer(ctx, nenvs, _agents_shape(observation_space))
+        self.rew_buf = _ShmemBuffer(ctx, nenvs, (num_agents, 1))
+        self.done_buf = _ShmemBuffer(ctx, nenvs, (num_agents,), np.bool_)
+        _make_shmem_procs(self, ctx, env_fns, simplifyshmemworker, (self.obs_buf, self.rew_buf, self.done_buf))
+        VecEnv.__init__(self, nenvs, observation_space, action_space)
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        infos, scalar_dones = zip(*results)
+        dones = self.done_buf.view().copy()
+        if all(scalar_dones):
+            dones = dones[:, 0]
+        return self.obs_buf.view().copy(), self.rew_buf.view().copy(), dones, infos
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.obs_buf.view().copy()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
+
+def shmemworker(remote, parent_remote, env_fn_wrapper, index, bufs):
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+    obs_buf, rew_buf, done_buf, avail_buf = bufs
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            ob, reward, done, info, available_actions = env.step(data)
+            if done.__class__.__name__=='bool':
+                if done:
+                    ob, available_actions = env.reset()
+            else:
+                if all(done):
+                    ob, available_actions = env.reset()
+            _shmem_write((obs_buf, rew_buf, done_buf, avail_buf), index,
+                         (ob, reward, np.broadcast_to(done, done_buf.shape), available_actions))
+            remote.send((info, np.ndim(done) == 0))
+        elif cmd == 'reset':
+            ob, available_actions = env.reset()
+            _shmem_write((obs_buf, avail_buf), index, (ob, available_actions))
+            remote.send(None)
+        elif cmd == 'close':
+            env.close()
+            remote.close()
+            break
+        else:
+            raise NotImplementedError
+
+class ShmemSubprocVecEnv(VecEnv):
+    """
+    SubprocVecEnv that hands obs, rewards, dones and available actions over
+    through shared memory. Only the command and the info dicts go through the
+    pipes. available_actions is None when the action space is not Discrete, or
+    when the envs do not return action masks (available_actions=False, e.g. MPE).
+    """
+    def __init__(self, env_fns, spaces=None, context='fork', available_actions=True):
+        self.waiting = False
+        self.closed = False
+        ctx = mp.get_context(context)
+        nenvs = len(env_fns)
+        observation_space, action_space = _get_spaces(env_fns, spaces)
+        num_agents = len(observation_space)
+        self.obs_buf = _ShmemBuffer(ctx, nenvs, _agents_shape(observation_space))
+        self.rew_buf = _ShmemBuffer(ctx, nenvs, (num_agents, 1))
+        self.done_buf = _ShmemBuffer(ctx, nenvs, (num_agents,), np.bool_)
+        available_actions_shape = _available_actions_shape(action_space) if available_actions else None
+        self.avail_buf = None if available_actions_shape is None else _ShmemBuffer(ctx, nenvs, available_actions_shape)
+        _make_shmem_procs(self, ctx, env_fns, shmemworker, (self.obs_buf, self.rew_buf, self.done_buf, self.avail_buf))
+        VecEnv.__init__(self, nenvs, observation_space, action_space)
+
+    def _available_actions(self):
+        if self.avail_buf is None:
+            return None
+        return self.avail_buf.view().copy()
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        infos, scalar_dones = zip(*results)
+        dones = self.done_buf.view().copy()
+        if all(scalar_dones):
+            dones = dones[:, 0]
+        return self.obs_buf.view().copy(), self.rew_buf.view().copy(), dones, infos, self._available_actions()
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.obs_buf.view().copy(), self._available_actions()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
+
+def shareshmemworker(remote, parent_remote, env_fn_wrapper, index, bufs):
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+    obs_buf, share_obs_buf, rew_buf, done_buf, avail_buf = bufs
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            ob, s_ob, reward, done, info, available_actions = env.step(data)
+            if done.__class__.__name__=='bool':
+                if done:
+                    ob, s_ob, available_actions = env.reset()
+            else:
+                if all(done):
+                    ob, s_ob, available_actions = env.reset()
+            _shmem_write((obs_buf, share_obs_buf, rew_buf, done_buf, avail_buf), index,
+                         (ob, s_ob, reward, np.broadcast_to(done, done_buf.shape), available_actions))
+            remote.send((info, np.ndim(done) == 0))
+        elif cmd == 'reset':
+            ob, s_ob, available_actions = env.reset()
+            _shmem_write((obs_buf, share_obs_buf, avail_buf), index, (ob, s_ob, available_actions))
+            remote.send(None)
+        elif cmd == 'close':
+            env.close()
+            remote.close()
+            break
+        else:
+            raise NotImplementedError
+
+class ShareShmemSubprocVecEnv(ShareVecEnv):
+    """
+    ShareSubprocVecEnv that hands obs, share_obs, rewards, dones and available
+    actions over through shared memory. Only the command and the info dicts go
+    through the pipes.
+    """
+    def __init__(self, env_fns, spaces=None, context='fork'):
+        self.waiting = False
+        self.closed = False
+        ctx = mp.get_context(context)
+        nenvs = len(env_fns)
+        observation_space, share_observation_space, action_space = _get_spaces(env_fns, spaces, share=True)
+        num_agents = len(observation_space)
+        self.obs_buf = _ShmemBuffer(ctx, nenvs, _agents_shape(observation_space))
+        self.share_obs_buf = _ShmemBuffer(ctx, nenvs, _agents_shape(share_observation_space))
+        self.rew_buf = _ShmemBuffer(ctx, nenvs, (num_agents, 1))
+        self.done_buf = _ShmemBuffer(ctx, nenvs, (num_agents,), np.bool_)
+        available_actions_shape = _available_actions_shape(action_space)
+        self.avail_buf = None if available_actions_shape is None else _ShmemBuffer(ctx, nenvs, available_actions_shape)
+        _make_shmem_procs(self, ctx, env_fns, shareshmemworker,
+                          (self.obs_buf, self.share_obs_buf, self.rew_buf, self.done_buf, self.avail_buf))
+        ShareVecEnv.__init__(self, nenvs, observation_space, share_observation_space, action_space)
+
+    def _available_actions(self):
+        if self.avail_buf is None:
+            return None
+        return self.avail_buf.view().copy()
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        infos, scalar_dones = zip(*results)
+        dones = self.done_buf.view().copy()
+        if all(scalar_dones):
+            dones = dones[:, 0]
+        return self.obs_buf.view().copy(), self.share_obs_buf.view().copy(), self.rew_buf.view().copy(), dones, infos, self._available_actions()
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.obs_buf.view().copy(), self.share_obs_buf.view().copy(), self._available_actions()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
@@ -0,0 +1,94 @@
+import queue
+import threading
+import numpy as np
+import torch
+
+class MetricsAccumulator(object):
+    """
+    Per-minibatch training statistics, kept as detached tensors on the device they were computed
+    on. reduce() moves all of them to the host at once, a single device sync instead of one per
+    .item() or logged tensor.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def add(self, **metrics):
+        for name, value in metrics.items():
+            self.values.setdefault(name, []).append(torch.as_tensor(value).detach().reshape(()).float())
+
+    def __len__(self):
+        return len(next(iter(self.values.values()))) if self.values else 0
+
+    def reduce(self):
+        """ {name: [minibatches] array} of everything added since the last call """
+        if not self.values:
+            return {}
+        names = list(self.values)
+        # the values of a name that is not a tensor were made on the cpu
+        device = self.values[names[0]][0].device
+        stacked = torch.stack([torch.stack([value.to(device) for value in self.values[name]])
+                               for name in names]).cpu().numpy()
+        self.values = {}
+        return dict(zip(names, stacked))
+
+class AsyncSummaryWriter(object):
+    """
+    Wraps a tensorboardX SummaryWriter: add_scalars() only queues the scalars and a background
+    thread writes everything queued since its last pass, so the training loop never waits on
+    the event files. Any other SummaryWriter method first waits for the queued writes.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_scalars(self, main_tag, tag_scalar_dict, global_step=None):
+        self.queue.put((main_tag, tag_scalar_dict, global_step))
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in records:
+                if record is None:
+                    continue
+                main_tag, tag_scalar_dict, global_step = record
+                # tensors logged from the training loop are only synced here
+                tag_scalar_dict = {tag: float(value) for tag, value in tag_scalar_dict.items()}
+                self.writer.add_scalars(main_tag, tag_scalar_dict, global_step)
+            for _ in records:
+                self.queue.task_done()
+            if records[-1] is None:
+                break
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.writer.close()
+
+    def __getattr__(self, name):
+        self.flush()
+        return getattr(self.writer, name)
+
+def metric_records(stats, step, interval, prefix=''):
+    """
+    (main_tag, {name: value}, step) records of reduced MetricsAccumulator stats whose first
+    minibatch is at step: every minibatch with interval 'minibatch', otherwise their mean at the
+    step of the last one.
+    """
+    records = []
+    for name, values in stats.items():
+        if interval == 'minibatch':
+            records += [(prefix + name, {name: value}, step + i) for i, value in enumerate(values)]
+        else:
+            records.append((prefix + name, {name: np.mean(values)}, step + len(values) - 1))
+    return records
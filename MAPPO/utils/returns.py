@@ -0,0 +1,71 @@
+import torch
+import numpy as np
+
+def denormalize_values(value_preds, value_normalizer, out=None):
+    """
+    Denormalize a whole value buffer in one call. value_normalizer is either a
+    single PopArt or a list with one PopArt per agent, the agent axis being the
+    second to last one ([..., agents, 1]). The result is written into out (a new
+    buffer by default) on the backend and device of value_preds (numpy array or
+    torch tensor), without copying value_preds anywhere.
+    """
+    if out is None:
+        out = value_preds.clone() if torch.is_tensor(value_preds) else np.empty_like(value_preds)
+    if value_normalizer.__class__.__name__ == 'list':
+        for agent_id in range(len(value_normalizer)):
+            value_normalizer[agent_id].denormalize(value_preds[..., agent_id, :], out=out[..., agent_id, :])
+        return out
+    return value_normalizer.denormalize(value_preds, out=out)
+
+def compute_returns(rewards,
+                    value_preds,
+                    returns,
+                    masks,
+                    bad_masks,
+                    use_gae,
+                    gamma,
+                    gae_lambda,
+                    use_proper_time_limits=True,
+                    use_popart=True,
+                    value_normalizer=None):
+    """
+    Fill returns[:-1] in place for every thread and agent at once.
+    rewards is [T, ...], value_preds/returns/masks/bad_masks are [T+1, ...] and the
+    bootstrap value must already be in value_preds[-1] (gae) or returns[-1].
+    Works with numpy arrays and torch tensors, so the returns stay on the buffer's device.
+    """
+    if use_popart:
+        values = denormalize_values(value_preds, value_normalizer)
+    else:
+        values = value_preds
+
+    if use_gae:
+        deltas = rewards + gamma * values[1:] * masks[1:] - values[:-1]
+        discounts = gamma * gae_lambda * masks[1:]
+        gae = 0
+        for step in reversed(range(rewards.shape[0])):
+            gae = deltas[step] + discounts[step] * gae
+            if use_proper_time_limits:
+                gae = gae * bad_masks[step + 1]
+            returns[step] = gae
+        returns[:-1] += values[:-1]
+    else:
+        for step in reversed(range(rewards.shape[0])):
+            if use_proper_time_limits:
+                returns[step] = (returns[step + 1] * gamma * masks[step + 1] + rewards[step]) * bad_masks[step + 1] \
+                                + (1 - bad_masks[step + 1]) * values[step]
+            else:
+                returns[step] = returns[step + 1] * gamma * masks[step + 1] + rewards[step]
+    return returns
+
+def compute_advantages(returns, value_preds, use_popart=True, value_normalizer=None):
+    """Normalized returns[:-1] - value_preds[:-1], on the backend of the buffers."""
+    if use_popart:
+        advantages = returns[:-1] - denormalize_values(value_preds[:-1], value_normalizer)
+    else:
+        advantages = returns[:-1] - value_preds[:-1]
+    if torch.is_tensor(advantages):
+        std = advantages.std(unbiased=False)
+    else:
+        std = advantages.std()
+    return (advantages - advantages.mean()) / (std + 1e-5)
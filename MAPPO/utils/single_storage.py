@@ -1,6 +1,8 @@
 import torch
 import numpy as np
 from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
+from .returns import compute_returns
+from .chunks import to_chunks, chunk_generator
 import time
 
 def _flatten_helper(T, N, _tensor):
@@ -110,53 +112,21 @@ class SingleRolloutStorage(object):
                         use_proper_time_limits=True,
                         use_popart=True,
                         value_normalizer=None):
-        if use_proper_time_limits:
-            if use_gae:
-                self.value_preds[-1,:] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.shape[0])):
-                    if use_popart:
-                        delta = self.rewards[step,:] + gamma * value_normalizer.denormalize(torch.tensor(self.value_preds[
-                        step + 1,:])).cpu().numpy() * self.masks[step + 1,:] - value_normalizer.denormalize(torch.tensor(self.value_preds[step,:])).cpu().numpy()
-                        gae = delta + gamma * gae_lambda * self.masks[step + 1,:] * gae
-                        gae = gae * self.bad_masks[step + 1,:]
-                        self.returns[step,:] = gae + value_normalizer.denormalize(torch.tensor(self.value_preds[step,:])).cpu().numpy()
-                    else:
-                        delta = self.rewards[step,:] + gamma * self.value_preds[
-                            step + 1,:] * self.masks[step + 1,:] - self.value_preds[step,:]
-                        gae = delta + gamma * gae_lambda * self.masks[step + 1,:] * gae
-                        gae = gae * self.bad_masks[step + 1,:]
-                        self.returns[step,:] = gae + self.value_preds[step,:]
-            else:
-                self.returns[-1,:] = next_value
-                for step in reversed(range(self.rewards.shape[0])):
-                    if use_popart:
-                        self.returns[step,:] = (self.returns[step + 1,:] * \
-                        gamma * self.masks[step + 1,:] + self.rewards[step,:]) * self.bad_masks[step + 1,:] \
-                        + (1 - self.bad_masks[step + 1,:]) * value_normalizer.denormalize(torch.tensor(self.value_preds[step,:])).cpu().numpy()
-                    else:
-                        self.returns[step,:] = (self.returns[step + 1,:] * \
-                            gamma * self.masks[step + 1,:] + self.rewards[step,:]) * self.bad_masks[step + 1,:] \
-                            + (1 - self.bad_masks[step + 1,:]) * self.value_preds[step,:]
+        if use_gae:
+            self.value_preds[-1,:] = next_value
         else:
-            if use_gae:
-                self.value_preds[-1,:] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.shape[0])):
-                    if use_popart:
-                        delta = self.rewards[step,:] + gamma * value_normalizer.denormalize(torch.tensor(self.value_preds[
-                            step + 1,:])).cpu().numpy() * self.masks[step + 1,:] - value_normalizer.denormalize(torch.tensor(self.value_preds[step,:])).cpu().numpy()
-                        gae = delta + gamma * gae_lambda * self.masks[step + 1,:] * gae                       
-                        self.returns[step,:] = gae + value_normalizer.denormalize(torch.tensor(self.value_preds[step,:])).cpu().numpy()
-                    else:
-                        delta = self.rewards[step,:] + gamma * self.value_preds[step + 1,:] * self.masks[step + 1,:] - self.value_preds[step,:]
-                        gae = delta + gamma * gae_lambda * self.masks[step + 1,:] * gae
-                        self.returns[step,:] = gae + self.value_preds[step,:]
-            else:
-                self.returns[-1,:] = next_value
-                for step in reversed(range(self.rewards.shape[0])):
-                    self.returns[step,:] = self.returns[step + 1,:] * \
-                            gamma * self.masks[step + 1,:] + self.rewards[step,:]
+            self.returns[-1,:] = next_value
+        compute_returns(self.rewards,
+                        self.value_preds,
+                        self.returns,
+                        self.masks,
+                        self.bad_masks,
+                        use_gae,
+                        gamma,
+                        gae_lambda,
+                        use_proper_time_limits,
+                        use_popart,
+                        value_normalizer)
 
     def feed_forward_generator(self, advantages, num_mini_batch=None, mini_batch_size=None):
         episode_length, n_rollout_threads = self.rewards.shape[0:2]
@@ -277,15 +247,11 @@ class SingleRolloutStorage(object):
 
             yield share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, adv_targ 
                 
-    def recurrent_generator(self, advantages, num_mini_batch, data_chunk_length):
-        episode_length, n_rollout_threads = self.rewards.shape[0:2]
-        batch_size = n_rollout_threads * episode_length
-        data_chunks = batch_size // data_chunk_length #[C=r*T/L]
-        mini_batch_size = data_chunks // num_mini_batch
-            
-        rand = torch.randperm(data_chunks).numpy()
-        sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
-            
+    def recurrent_chunks(self, advantages, data_chunk_length):
+        """
+        The recurrent_generator data as [num_chunks, L, Dim] tensors (hidden states as [num_chunks, 1, Dim]).
+        Build it once per update and hand it to every ppo epoch's generator.
+        """
         if len(self.share_obs.shape) > 3:
             share_obs = self.share_obs[:-1,:].transpose(1,0,2,3,4).reshape(-1, *self.share_obs.shape[2:])
             obs = self.obs[:-1,:].transpose(1,0,2,3,4).reshape(-1, *self.obs.shape[2:])
@@ -303,68 +269,20 @@ class SingleRolloutStorage(object):
         recurrent_hidden_states = self.recurrent_hidden_states[:-1,:].transpose(1,0,2).reshape(-1, self.recurrent_hidden_states.shape[-1])
         recurrent_hidden_states_critic = self.recurrent_hidden_states_critic[:-1,:].transpose(1,0,2).reshape(-1, self.recurrent_hidden_states_critic.shape[-1])
 
-        for indices in sampler:
-            share_obs_batch = []
-            obs_batch = []
-            recurrent_hidden_states_batch = []
-            recurrent_hidden_states_critic_batch = []
-            actions_batch = []
-            value_preds_batch = []
-            return_batch = []
-            masks_batch = []
-            high_masks_batch = []
-            old_action_log_probs_batch = []
-            adv_targ = []
-            
-            for index in indices:
-                ind = index * data_chunk_length
-                # size [T+1 N M Dim]-->[T N Dim]-->[N T Dim]-->[T*N,Dim]-->[L,Dim]
-                share_obs_batch.append(torch.tensor(share_obs[ind:ind+data_chunk_length]))
-                obs_batch.append(torch.tensor(obs[ind:ind+data_chunk_length]))
-                actions_batch.append(torch.tensor(actions[ind:ind+data_chunk_length]))
-                value_preds_batch.append(torch.tensor(value_preds[ind:ind+data_chunk_length]))
-                return_batch.append(torch.tensor(returns[ind:ind+data_chunk_length]))
-                masks_batch.append(torch.tensor(masks[ind:ind+data_chunk_length]))
-                high_masks_batch.append(torch.tensor(high_masks[ind:ind+data_chunk_length]))
-                old_action_log_probs_batch.append(torch.tensor(action_log_probs[ind:ind+data_chunk_length]))
-                adv_targ.append(torch.tensor(advantages[ind:ind+data_chunk_length]))
-                # size [T+1 N Dim]-->[T N Dim]-->[T*N,Dim]-->[1,Dim]
-                recurrent_hidden_states_batch.append(torch.tensor(recurrent_hidden_states[ind]))
-                recurrent_hidden_states_critic_batch.append(torch.tensor(recurrent_hidden_states_critic[ind]))
-                      
-            L, N =  data_chunk_length, mini_batch_size
-                        
-            # These are all tensors of size (L, N, Dim)
-            share_obs_batch = torch.stack(share_obs_batch)         
-            obs_batch = torch.stack(obs_batch)
-            
-            actions_batch = torch.stack(actions_batch)
-            value_preds_batch = torch.stack(value_preds_batch)
-            return_batch = torch.stack(return_batch)
-            masks_batch = torch.stack(masks_batch)
-            high_masks_batch = torch.stack(high_masks_batch)
-            old_action_log_probs_batch = torch.stack(
-                old_action_log_probs_batch)
-            adv_targ = torch.stack(adv_targ)
+        return [to_chunks(data_chunk_length, share_obs),
+                to_chunks(data_chunk_length, obs),
+                to_chunks(data_chunk_length, recurrent_hidden_states)[:,:1],
+                to_chunks(data_chunk_length, recurrent_hidden_states_critic)[:,:1],
+                to_chunks(data_chunk_length, actions),
+                to_chunks(data_chunk_length, value_preds),
+                to_chunks(data_chunk_length, returns),
+                to_chunks(data_chunk_length, masks),
+                to_chunks(data_chunk_length, high_masks),
+                to_chunks(data_chunk_length, action_log_probs),
+                to_chunks(data_chunk_length, advantages)]
 
-            # States is just a (N, -1) tensor
-            
-            recurrent_hidden_states_batch = torch.stack(
-                recurrent_hidden_states_batch).view(N, -1)
-            recurrent_hidden_states_critic_batch = torch.stack(
-                recurrent_hidden_states_critic_batch).view(N, -1)
-
-            # Flatten the (L, N, ...) tensors to (L * N, ...)
-            share_obs_batch = _flatten_helper(L, N, share_obs_batch)
-            obs_batch = _flatten_helper(L, N, obs_batch)
-            actions_batch = _flatten_helper(L, N, actions_batch)
-            value_preds_batch = _flatten_helper(L, N, value_preds_batch)
-            return_batch = _flatten_helper(L, N, return_batch)
-            masks_batch = _flatten_helper(L, N, masks_batch)
-            high_masks_batch = _flatten_helper(L, N, high_masks_batch)
-            old_action_log_probs_batch = _flatten_helper(L, N, \
-                    old_action_log_probs_batch)
-            adv_targ = _flatten_helper(L, N, adv_targ)
-            
-            yield share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, adv_targ
- 
\ No newline at end of file
+    def recurrent_generator(self, advantages, num_mini_batch, data_chunk_length, chunks=None, pin_memory=False, device=None):
+        if chunks is None:
+            chunks = self.recurrent_chunks(advantages, data_chunk_length)
+        return chunk_generator(chunks, num_mini_batch, pin_memory, device)
+ 
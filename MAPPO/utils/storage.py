@@ -1,6 +1,8 @@
 import torch
 import numpy as np
 from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
+from .returns import compute_returns
+from .chunks import to_chunks, chunk_generator, GatherChunks
 import time
 
 def _flatten_helper(T, N, _tensor):
@@ -8,35 +10,43 @@ def _flatten_helper(T, N, _tensor):
 
 class RolloutStorage(object):
     def __init__(self, num_agents, episode_length, n_rollout_threads, obs_space, action_space,
-                 recurrent_hidden_state_size, use_same_dim=False):
+                 recurrent_hidden_state_size, use_same_dim=False, dedup_share_obs=False):
+        
+        # with dedup_share_obs the centralized observation is the same for every agent,
+        # so it is stored once per [step, thread] as [T+1, N, 1, Dim] and indexed per agent by the generators
+        self.dedup_share_obs = dedup_share_obs
+        if dedup_share_obs:
+            share_obs_agents = 1
+        else:
+            share_obs_agents = num_agents
         
         if obs_space.__class__.__name__ == 'Box':
             obs_shape = obs_space.shape
             if len(obs_shape) == 3:
-                self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0] * num_agents, obs_shape[1], obs_shape[2])).astype(np.float32)
+                self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, share_obs_agents, obs_shape[0] * num_agents, obs_shape[1], obs_shape[2])).astype(np.float32)
                 self.obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, *obs_shape)).astype(np.float32)
             else:
-                self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0] * num_agents)).astype(np.float32)
+                self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, share_obs_agents, obs_shape[0] * num_agents)).astype(np.float32)
                 self.obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0])).astype(np.float32)
         elif obs_space.__class__.__name__ == 'list':
             obs_shape = obs_space
             if obs_shape[-1].__class__.__name__=='list':#attn
                 if use_same_dim:
-                    self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0])).astype(np.float32)
+                    self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, share_obs_agents, obs_shape[0])).astype(np.float32)
                     self.obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0])).astype(np.float32)
                 else:
-                    self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0] * num_agents)).astype(np.float32)
+                    self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, share_obs_agents, obs_shape[0] * num_agents)).astype(np.float32)
                     self.obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0])).astype(np.float32)
             else:
                 if len(obs_shape) == 3:
-                    self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0] * num_agents, obs_shape[1], obs_shape[2])).astype(np.float32)
+                    self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, share_obs_agents, obs_shape[0] * num_agents, obs_shape[1], obs_shape[2])).astype(np.float32)
                     self.obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, *obs_shape)).astype(np.float32)
                 else:
                     if use_same_dim:
-                        self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0])).astype(np.float32)
+                        self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, share_obs_agents, obs_shape[0])).astype(np.float32)
                         self.obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0])).astype(np.float32)
                     else:
-                        self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0] * num_agents)).astype(np.float32)
+                        self.share_obs = np.zeros((episode_length + 1, n_rollout_threads, share_obs_agents, obs_shape[0] * num_agents)).astype(np.float32)
                         self.obs = np.zeros((episode_length + 1, n_rollout_threads, num_agents, obs_shape[0])).astype(np.float32)
         else:
             raise NotImplementedError
@@ -136,6 +146,24 @@ class RolloutStorage(object):
         self.bad_masks[0] = self.bad_masks[-1].copy()
         self.high_masks[0] = self.high_masks[-1].copy()       
         
+    def get_share_obs(self, step):
+        """share_obs[step] as [threads, agents, Dim], a read-only broadcast view when it is stored de-duplicated."""
+        if self.dedup_share_obs:
+            return np.broadcast_to(self.share_obs[step], (self.share_obs.shape[1], self.obs.shape[2], *self.share_obs.shape[3:]))
+        return self.share_obs[step]
+
+    def get_agent_share_obs(self, step, agent_id):
+        """share_obs[step] of one agent as [threads, Dim], a view also when it is stored de-duplicated."""
+        if self.dedup_share_obs:
+            return self.share_obs[step][:, 0]
+        return self.share_obs[step][:, agent_id]
+
+    def _agent_share_obs(self, agent_id):
+        # [T+1, N, Dim] share_obs of one agent
+        if self.dedup_share_obs:
+            return self.share_obs[:,:,0]
+        return self.share_obs[:,:,agent_id]
+
     def compute_returns(self,
                         agent_id,
                         next_value,
@@ -145,53 +173,49 @@ class RolloutStorage(object):
                         use_proper_time_limits=True,
                         use_popart=True,
                         value_normalizer=None):
-        if use_proper_time_limits:
-            if use_gae:
-                self.value_preds[-1,:,agent_id] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.shape[0])):
-                    if use_popart:
-                        delta = self.rewards[step,:,agent_id] + gamma * value_normalizer.denormalize(torch.tensor(self.value_preds[
-                        step + 1,:,agent_id])).cpu().numpy() * self.masks[step + 1,:,agent_id] - value_normalizer.denormalize(torch.tensor(self.value_preds[step,:,agent_id])).cpu().numpy()
-                        gae = delta + gamma * gae_lambda * self.masks[step + 1,:,agent_id] * gae
-                        gae = gae * self.bad_masks[step + 1,:,agent_id]
-                        self.returns[step,:,agent_id] = gae + value_normalizer.denormalize(torch.tensor(self.value_preds[step,:,agent_id])).cpu().numpy()
-                    else:
-                        delta = self.rewards[step,:,agent_id] + gamma * self.value_preds[
-                            step + 1,:,agent_id] * self.masks[step + 1,:,agent_id] - self.value_preds[step,:,agent_id]
-                        gae = delta + gamma * gae_lambda * self.masks[step + 1,:,agent_id] * gae
-                        gae = gae * self.bad_masks[step + 1,:,agent_id]
-                        self.returns[step,:,agent_id] = gae + self.value_preds[step,:,agent_id]
-            else:
-                self.returns[-1,:,agent_id] = next_value
-                for step in reversed(range(self.rewards.shape[0])):
-                    if use_popart:
-                        self.returns[step,:,agent_id] = (self.returns[step + 1,:,agent_id] * \
-                        gamma * self.masks[step + 1,:,agent_id] + self.rewards[step,:,agent_id]) * self.bad_masks[step + 1,:,agent_id] \
-                        + (1 - self.bad_masks[step + 1,:,agent_id]) * value_normalizer.denormalize(torch.tensor(self.value_preds[step,:,agent_id])).cpu().numpy()
-                    else:
-                        self.returns[step,:,agent_id] = (self.returns[step + 1,:,agent_id] * \
-                            gamma * self.masks[step + 1,:,agent_id] + self.rewards[step,:,agent_id]) * self.bad_masks[step + 1,:,agent_id] \
-                            + (1 - self.bad_masks[step + 1,:,agent_id]) * self.value_preds[step,:,agent_id]
+        if use_gae:
+            self.value_preds[-1,:,agent_id] = next_value
         else:
-            if use_gae:
-                self.value_preds[-1,:,agent_id] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.shape[0])):
-                    if use_popart:
-                        delta = self.rewards[step,:,agent_id] + gamma * value_normalizer.denormalize(torch.tensor(self.value_preds[
-                            step + 1,:,agent_id])).cpu().numpy() * self.masks[step + 1,:,agent_id] - value_normalizer.denormalize(torch.tensor(self.value_preds[step,:,agent_id])).cpu().numpy()
-                        gae = delta + gamma * gae_lambda * self.masks[step + 1,:,agent_id] * gae                       
-                        self.returns[step,:,agent_id] = gae + value_normalizer.denormalize(torch.tensor(self.value_preds[step,:,agent_id])).cpu().numpy()
-                    else:
-                        delta = self.rewards[step,:,agent_id] + gamma * self.value_preds[step + 1,:,agent_id] * self.masks[step + 1,:,agent_id] - self.value_preds[step,:,agent_id]
-                        gae = delta + gamma * gae_lambda * self.masks[step + 1,:,agent_id] * gae
-                        self.returns[step,:,agent_id] = gae + self.value_preds[step,:,agent_id]
-            else:
-                self.returns[-1,:,agent_id] = next_value
-                for step in reversed(range(self.rewards.shape[0])):
-                    self.returns[step,:,agent_id] = self.returns[step + 1,:,agent_id] * \
-                            gamma * self.masks[step + 1,:,agent_id] + self.rewards[step,:,agent_id]
+            self.returns[-1,:,agent_id] = next_value
+        compute_returns(self.rewards[:,:,agent_id],
+                        self.value_preds[:,:,agent_id],
+                        self.returns[:,:,agent_id],
+                        self.masks[:,:,agent_id],
+                        self.bad_masks[:,:,agent_id],
+                        use_gae,
+                        gamma,
+                        gae_lambda,
+                        use_proper_time_limits,
+                        use_popart,
+                        value_normalizer)
+
+    def compute_returns_all(self,
+                            next_value,
+                            use_gae,
+                            gamma,
+                            gae_lambda,
+                            use_proper_time_limits=True,
+                            use_popart=True,
+                            value_normalizer=None):
+        """
+        compute_returns for all agents in one pass. next_value is [threads, agents, 1],
+        value_normalizer is the shared PopArt or a list with one PopArt per agent.
+        """
+        if use_gae:
+            self.value_preds[-1] = next_value
+        else:
+            self.returns[-1] = next_value
+        compute_returns(self.rewards,
+                        self.value_preds,
+                        self.returns,
+                        self.masks,
+                        self.bad_masks,
+                        use_gae,
+                        gamma,
+                        gae_lambda,
+                        use_proper_time_limits,
+                        use_popart,
+                        value_normalizer)
 
     def feed_forward_generator(self, agent_id, advantages, num_mini_batch=None, mini_batch_size=None):
         episode_length, n_rollout_threads = self.rewards.shape[0:2]
@@ -209,7 +233,7 @@ class RolloutStorage(object):
         rand = torch.randperm(batch_size).numpy()
         sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
         
-        share_obs = self.share_obs[:-1,:,agent_id].reshape(-1, *self.share_obs.shape[3:])
+        share_obs = self._agent_share_obs(agent_id)[:-1].reshape(-1, *self.share_obs.shape[3:])
         obs = self.obs[:-1,:,agent_id].reshape(-1, *self.obs.shape[3:])
         recurrent_hidden_states = self.recurrent_hidden_states[:-1,:,agent_id].reshape(-1, self.recurrent_hidden_states.shape[-1])
         recurrent_hidden_states_critic = self.recurrent_hidden_states_critic[:-1,:,agent_id].reshape(-1, self.recurrent_hidden_states_critic.shape[-1])
@@ -256,6 +280,8 @@ class RolloutStorage(object):
         rand = torch.randperm(batch_size).numpy()
         sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
         
+        # de-duplicated share_obs has one row per num_agents samples
+        agents_per_share_obs = num_agents // self.share_obs.shape[2]
         share_obs = self.share_obs[:-1].reshape(-1, *self.share_obs.shape[3:])
         obs = self.obs[:-1].reshape(-1, *self.obs.shape[3:])
         recurrent_hidden_states = self.recurrent_hidden_states[:-1].reshape(-1, self.recurrent_hidden_states.shape[-1])
@@ -270,7 +296,7 @@ class RolloutStorage(object):
         
         for indices in sampler:
             # obs size [T+1 N M Dim]-->[T N M Dim]-->[T*N*M,Dim]-->[index,Dim]           
-            share_obs_batch = torch.tensor(share_obs[indices])           
+            share_obs_batch = torch.tensor(share_obs[indices // agents_per_share_obs])
             obs_batch = torch.tensor(obs[indices])
             recurrent_hidden_states_batch = torch.tensor(recurrent_hidden_states[indices])
             recurrent_hidden_states_critic_batch = torch.tensor(recurrent_hidden_states_critic[indices])
@@ -295,6 +321,7 @@ class RolloutStorage(object):
             "PPO mini batches ({}).".format(n_rollout_threads, num_mini_batch))
         num_envs_per_batch = n_rollout_threads // num_mini_batch
         perm = torch.randperm(n_rollout_threads).numpy()
+        share_obs = self._agent_share_obs(agent_id)
         for start_ind in range(0, n_rollout_threads, num_envs_per_batch):
             share_obs_batch = []
             obs_batch = []
@@ -310,7 +337,7 @@ class RolloutStorage(object):
 
             for offset in range(num_envs_per_batch):
                 ind = perm[start_ind + offset]
-                share_obs_batch.append(torch.tensor(self.share_obs[:-1, ind, agent_id]))
+                share_obs_batch.append(torch.tensor(share_obs[:-1, ind]))
                 obs_batch.append(torch.tensor(self.obs[:-1, ind, agent_id]))
                 recurrent_hidden_states_batch.append(
                     torch.tensor(self.recurrent_hidden_states[0:1, ind, agent_id]))
@@ -369,7 +396,8 @@ class RolloutStorage(object):
         num_envs_per_batch = batch_size // num_mini_batch
         perm = torch.randperm(batch_size).numpy()
         
-        share_obs = self.share_obs.reshape(-1, batch_size, *self.share_obs.shape[3:])
+        agents_per_share_obs = num_agents // self.share_obs.shape[2]
+        share_obs = self.share_obs.reshape(-1, batch_size // agents_per_share_obs, *self.share_obs.shape[3:])
         obs = self.obs.reshape(-1, batch_size, *self.obs.shape[3:])
         recurrent_hidden_states = self.recurrent_hidden_states.reshape(-1, batch_size, self.recurrent_hidden_states.shape[-1])
         recurrent_hidden_states_critic = self.recurrent_hidden_states_critic.reshape(-1, batch_size, self.recurrent_hidden_states_critic.shape[-1])
@@ -396,7 +424,7 @@ class RolloutStorage(object):
 
             for offset in range(num_envs_per_batch):
                 ind = perm[start_ind + offset]
-                share_obs_batch.append(torch.tensor(share_obs[:-1, ind]))
+                share_obs_batch.append(torch.tensor(share_obs[:-1, ind // agents_per_share_obs]))
                 obs_batch.append(torch.tensor(obs[:-1, ind]))
                 recurrent_hidden_states_batch.append(
                     torch.tensor(recurrent_hidden_states[0:1, ind]))
@@ -444,20 +472,16 @@ class RolloutStorage(object):
             yield share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, adv_targ
                 
                 
-    def recurrent_generator(self, agent_id, advantages, num_mini_batch, data_chunk_length):
-        episode_length, n_rollout_threads = self.rewards.shape[0:2]
-        batch_size = n_rollout_threads * episode_length
-        data_chunks = batch_size // data_chunk_length #[C=r*T/L]
-        mini_batch_size = data_chunks // num_mini_batch
-            
-        rand = torch.randperm(data_chunks).numpy()
-        sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
-            
+    def recurrent_chunks(self, agent_id, advantages, data_chunk_length):
+        """
+        The recurrent_generator data as [num_chunks, L, Dim] tensors (hidden states as [num_chunks, 1, Dim]).
+        Build it once per update and hand it to every ppo epoch's generator.
+        """
         if len(self.share_obs.shape) > 4:
-            share_obs = self.share_obs[:-1,:,agent_id].transpose(1,0,2,3,4).reshape(-1, *self.share_obs.shape[3:])
+            share_obs = self._agent_share_obs(agent_id)[:-1].transpose(1,0,2,3,4).reshape(-1, *self.share_obs.shape[3:])
             obs = self.obs[:-1,:,agent_id].transpose(1,0,2,3,4).reshape(-1, *self.obs.shape[3:])
         else:
-            share_obs = self.share_obs[:-1,:,agent_id].transpose(1,0,2).reshape(-1, *self.share_obs.shape[3:])
+            share_obs = self._agent_share_obs(agent_id)[:-1].transpose(1,0,2).reshape(-1, *self.share_obs.shape[3:])
             obs = self.obs[:-1,:,agent_id].transpose(1,0,2).reshape(-1, *self.obs.shape[3:])
             
         actions = self.actions[:,:,agent_id].transpose(1,0,2).reshape(-1, self.actions.shape[-1])
@@ -470,86 +494,41 @@ class RolloutStorage(object):
         recurrent_hidden_states = self.recurrent_hidden_states[:-1,:,agent_id].transpose(1,0,2).reshape(-1, self.recurrent_hidden_states.shape[-1])
         recurrent_hidden_states_critic = self.recurrent_hidden_states_critic[:-1,:,agent_id].transpose(1,0,2).reshape(-1, self.recurrent_hidden_states_critic.shape[-1])
 
-        for indices in sampler:
-            share_obs_batch = []
-            obs_batch = []
-            recurrent_hidden_states_batch = []
-            recurrent_hidden_states_critic_batch = []
-            actions_batch = []
-            value_preds_batch = []
-            return_batch = []
-            masks_batch = []
-            high_masks_batch = []
-            old_action_log_probs_batch = []
-            adv_targ = []
-            
-            for index in indices:
-                ind = index * data_chunk_length
-                # size [T+1 N M Dim]-->[T N Dim]-->[N T Dim]-->[T*N,Dim]-->[L,Dim]
-                share_obs_batch.append(torch.tensor(share_obs[ind:ind+data_chunk_length]))
-                obs_batch.append(torch.tensor(obs[ind:ind+data_chunk_length]))
-                actions_batch.append(torch.tensor(actions[ind:ind+data_chunk_length]))
-                value_preds_batch.append(torch.tensor(value_preds[ind:ind+data_chunk_length]))
-                return_batch.append(torch.tensor(returns[ind:ind+data_chunk_length]))
-                masks_batch.append(torch.tensor(masks[ind:ind+data_chunk_length]))
-                high_masks_batch.append(torch.tensor(high_masks[ind:ind+data_chunk_length]))
-                old_action_log_probs_batch.append(torch.tensor(action_log_probs[ind:ind+data_chunk_length]))
-                adv_targ.append(torch.tensor(advantages[ind:ind+data_chunk_length]))
-                # size [T+1 N Dim]-->[T N Dim]-->[T*N,Dim]-->[1,Dim]
-                recurrent_hidden_states_batch.append(torch.tensor(recurrent_hidden_states[ind]))
-                recurrent_hidden_states_critic_batch.append(torch.tensor(recurrent_hidden_states_critic[ind]))
-                      
-            L, N =  data_chunk_length, mini_batch_size
-                        
-            # These are all tensors of size (L, N, Dim)
-            share_obs_batch = torch.stack(share_obs_batch)         
-            obs_batch = torch.stack(obs_batch)
-            
-            actions_batch = torch.stack(actions_batch)
-            value_preds_batch = torch.stack(value_preds_batch)
-            return_batch = torch.stack(return_batch)
-            masks_batch = torch.stack(masks_batch)
-            high_masks_batch = torch.stack(high_masks_batch)
-            old_action_log_probs_batch = torch.stack(
-                old_action_log_probs_batch)
-            adv_targ = torch.stack(adv_targ)
-
-            # States is just a (N, -1) tensor
-            
-            recurrent_hidden_states_batch = torch.stack(
-                recurrent_hidden_states_batch).view(N, -1)
-            recurrent_hidden_states_critic_batch = torch.stack(
-                recurrent_hidden_states_critic_batch).view(N, -1)
+        return [to_chunks(data_chunk_length, share_obs),
+                to_chunks(data_chunk_length, obs),
+                to_chunks(data_chunk_length, recurrent_hidden_states)[:,:1],
+                to_chunks(data_chunk_length, recurrent_hidden_states_critic)[:,:1],
+                to_chunks(data_chunk_length, actions),
+                to_chunks(data_chunk_length, value_preds),
+                to_chunks(data_chunk_length, returns),
+                to_chunks(data_chunk_length, masks),
+                to_chunks(data_chunk_length, high_masks),
+                to_chunks(data_chunk_length, action_log_probs),
+                to_chunks(data_chunk_length, advantages)]
 
-            # Flatten the (L, N, ...) tensors to (L * N, ...)
-            share_obs_batch = _flatten_helper(L, N, share_obs_batch)
-            obs_batch = _flatten_helper(L, N, obs_batch)
-            actions_batch = _flatten_helper(L, N, actions_batch)
-            value_preds_batch = _flatten_helper(L, N, value_preds_batch)
-            return_batch = _flatten_helper(L, N, return_batch)
-            masks_batch = _flatten_helper(L, N, masks_batch)
-            high_masks_batch = _flatten_helper(L, N, high_masks_batch)
-            old_action_log_probs_batch = _flatten_helper(L, N, \
-                    old_action_log_probs_batch)
-            adv_targ = _flatten_helper(L, N, adv_targ)
-            
-            yield share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, adv_targ
+    def recurrent_generator(self, agent_id, advantages, num_mini_batch, data_chunk_length, chunks=None, pin_memory=False, device=None):
+        if chunks is None:
+            chunks = self.recurrent_chunks(agent_id, advantages, data_chunk_length)
+        return chunk_generator(chunks, num_mini_batch, pin_memory, device)
  
-            
-    def recurrent_generator_share(self, advantages, num_mini_batch, data_chunk_length):
-        episode_length, n_rollout_threads, num_agents = self.rewards.shape[0:3]
-        batch_size = n_rollout_threads * episode_length * num_agents
-        data_chunks = batch_size // data_chunk_length #[C=r*T*M/L]
-        mini_batch_size = data_chunks // num_mini_batch
-            
-        rand = torch.randperm(data_chunks).numpy()
-        sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
-            
-        if len(self.share_obs.shape) > 4:    
-            share_obs = self.share_obs[:-1].transpose(1,2,0,3,4,5).reshape(-1, *self.share_obs.shape[3:])
+    def recurrent_chunks_share(self, advantages, data_chunk_length):
+        """
+        The recurrent_generator_share data as [num_chunks, L, Dim] tensors (hidden states as [num_chunks, 1, Dim]).
+        Build it once per update and hand it to every ppo epoch's generator.
+        """
+        if self.dedup_share_obs:
+            # the chunks index the [T*N, Dim] share_obs rows instead of holding num_agents copies of them
+            episode_length, n_rollout_threads, num_agents = self.rewards.shape[0:3]
+            share_obs_rows = np.arange(episode_length * n_rollout_threads).reshape(episode_length, n_rollout_threads, 1)
+            share_obs_rows = np.broadcast_to(share_obs_rows, (episode_length, n_rollout_threads, num_agents)).transpose(1,2,0).reshape(-1)
+            share_obs = GatherChunks(self.share_obs[:-1].reshape(-1, *self.share_obs.shape[3:]), to_chunks(data_chunk_length, share_obs_rows))
+        elif len(self.share_obs.shape) > 4:
+            share_obs = to_chunks(data_chunk_length, self.share_obs[:-1].transpose(1,2,0,3,4,5).reshape(-1, *self.share_obs.shape[3:]))
+        else:
+            share_obs = to_chunks(data_chunk_length, self.share_obs[:-1].transpose(1,2,0,3).reshape(-1, *self.share_obs.shape[3:]))
+        if len(self.obs.shape) > 4:
             obs = self.obs[:-1].transpose(1,2,0,3,4,5).reshape(-1, *self.obs.shape[3:])
         else:
-            share_obs = self.share_obs[:-1].transpose(1,2,0,3).reshape(-1, *self.share_obs.shape[3:])
             obs = self.obs[:-1].transpose(1,2,0,3).reshape(-1, *self.obs.shape[3:])
         
         actions = self.actions.transpose(1,2,0,3).reshape(-1, self.actions.shape[-1])
@@ -562,69 +541,20 @@ class RolloutStorage(object):
         recurrent_hidden_states = self.recurrent_hidden_states[:-1].transpose(1,2,0,3).reshape(-1, self.recurrent_hidden_states.shape[-1])
         recurrent_hidden_states_critic = self.recurrent_hidden_states_critic[:-1].transpose(1,2,0,3).reshape(-1, self.recurrent_hidden_states_critic.shape[-1])
 
-        for indices in sampler:
-            share_obs_batch = []
-            obs_batch = []
-            recurrent_hidden_states_batch = []
-            recurrent_hidden_states_critic_batch = []
-            actions_batch = []
-            value_preds_batch = []
-            return_batch = []
-            masks_batch = []
-            high_masks_batch = []
-            old_action_log_probs_batch = []
-            adv_targ = []
-            
-            for index in indices:
-                
-                ind = index * data_chunk_length
-                # size [T+1 N M Dim]-->[T N M Dim]-->[N T M Dim]-->[N,M,T,Dim]-->[N*M*T,Dim]-->[L,Dim]             
-                share_obs_batch.append(torch.tensor(share_obs[ind:ind+data_chunk_length]))
-                obs_batch.append(torch.tensor(obs[ind:ind+data_chunk_length]))
-                actions_batch.append(torch.tensor(actions[ind:ind+data_chunk_length]))
-                value_preds_batch.append(torch.tensor(value_preds[ind:ind+data_chunk_length]))
-                return_batch.append(torch.tensor(returns[ind:ind+data_chunk_length]))
-                masks_batch.append(torch.tensor(masks[ind:ind+data_chunk_length]))
-                high_masks_batch.append(torch.tensor(high_masks[ind:ind+data_chunk_length]))
-                old_action_log_probs_batch.append(torch.tensor(action_log_probs[ind:ind+data_chunk_length]))
-                adv_targ.append(torch.tensor(advantages[ind:ind+data_chunk_length]))
-                # size [T+1 N M Dim]-->[T N M Dim]-->[N M T Dim]-->[N*M*T,Dim]-->[1,Dim]
-                recurrent_hidden_states_batch.append(torch.tensor(recurrent_hidden_states[ind]))
-                recurrent_hidden_states_critic_batch.append(torch.tensor(recurrent_hidden_states_critic[ind]))
-   
-            L, N =  data_chunk_length, mini_batch_size
-            
-            # These are all tensors of size (N, L, Dim)
-            share_obs_batch = torch.stack(share_obs_batch)         
-            obs_batch = torch.stack(obs_batch)
-            
-            actions_batch = torch.stack(actions_batch)
-            value_preds_batch = torch.stack(value_preds_batch)
-            return_batch = torch.stack(return_batch)
-            masks_batch = torch.stack(masks_batch)
-            high_masks_batch = torch.stack(high_masks_batch)
-            old_action_log_probs_batch = torch.stack(
-                old_action_log_probs_batch)
-            adv_targ = torch.stack(adv_targ)
+        return [share_obs,
+                to_chunks(data_chunk_length, obs),
+                to_chunks(data_chunk_length, recurrent_hidden_states)[:,:1],
+                to_chunks(data_chunk_length, recurrent_hidden_states_critic)[:,:1],
+                to_chunks(data_chunk_length, actions),
+                to_chunks(data_chunk_length, value_preds),
+                to_chunks(data_chunk_length, returns),
+                to_chunks(data_chunk_length, masks),
+                to_chunks(data_chunk_length, high_masks),
+                to_chunks(data_chunk_length, action_log_probs),
+                to_chunks(data_chunk_length, advantages)]
 
-            # States is just a (N, -1) tensor
-            
-            recurrent_hidden_states_batch = torch.stack(
-                recurrent_hidden_states_batch).view(N, -1)
-            recurrent_hidden_states_critic_batch = torch.stack(
-                recurrent_hidden_states_critic_batch).view(N, -1)
-
-            # Flatten the (L, N, ...) tensors to (L * N, ...)
-            share_obs_batch = _flatten_helper(L, N, share_obs_batch)
-            obs_batch = _flatten_helper(L, N, obs_batch)
-            actions_batch = _flatten_helper(L, N, actions_batch)
-            value_preds_batch = _flatten_helper(L, N, value_preds_batch)
-            return_batch = _flatten_helper(L, N, return_batch)
-            masks_batch = _flatten_helper(L, N, masks_batch)
-            high_masks_batch = _flatten_helper(L, N, high_masks_batch)
-            old_action_log_probs_batch = _flatten_helper(L, N, \
-                    old_action_log_probs_batch)
-            adv_targ = _flatten_helper(L, N, adv_targ)
-            
-            yield share_obs_batch, obs_batch, recurrent_hidden_states_batch, recurrent_hidden_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, high_masks_batch, old_action_log_probs_batch, adv_targ
-            
+    def recurrent_generator_share(self, advantages, num_mini_batch, data_chunk_length, chunks=None, pin_memory=False, device=None):
+        if chunks is None:
+            chunks = self.recurrent_chunks_share(advantages, data_chunk_length)
+        return chunk_generator(chunks, num_mini_batch, pin_memory, device)
+ 
@@ -0,0 +1,272 @@
+import torch
+import numpy as np
+from .returns import compute_returns
+from .chunks import to_chunks, chunk_generator, GatherChunks
+
+def _copy(dst, src):
+    # src may be a numpy array, a (nested) list or a tensor on any device
+    dst.copy_(torch.as_tensor(src))
+
+class TorchRolloutStorage(object):
+    """
+    RolloutStorage with every buffer preallocated as a torch tensor on device.
+    Policy outputs are inserted without a numpy round-trip and minibatches are
+    gathered on device, only the env outputs passed to insert cross the host boundary.
+    It takes its layout from a numpy storage (utils.storage or utils.share_storage
+    RolloutStorage) and keeps the same insert / after_update / compute_returns /
+    *_generator interface.
+    """
+    def __init__(self, storage, device=torch.device("cpu")):
+        self.device = device
+        for name, value in vars(storage).items():
+            if value.__class__.__name__ == 'ndarray':
+                value = torch.from_numpy(value).to(device)
+            setattr(self, name, value)
+
+    def insert(self, share_obs, obs, recurrent_hidden_states, recurrent_hidden_states_critic, actions, action_log_probs,
+               value_preds, rewards, masks, bad_masks=None, high_masks=None, available_actions=None):
+        _copy(self.share_obs[self.step + 1], share_obs)
+        _copy(self.obs[self.step + 1], obs)
+        _copy(self.recurrent_hidden_states[self.step + 1], recurrent_hidden_states)
+        _copy(self.recurrent_hidden_states_critic[self.step + 1], recurrent_hidden_states_critic)
+        _copy(self.actions[self.step], actions)
+        _copy(self.action_log_probs[self.step], action_log_probs)
+        _copy(self.value_preds[self.step], value_preds)
+        _copy(self.rewards[self.step], rewards)
+        _copy(self.masks[self.step + 1], masks)
+        if bad_masks is not None:
+            _copy(self.bad_masks[self.step + 1], bad_masks)
+        if high_masks is not None:
+            _copy(self.high_masks[self.step + 1], high_masks)
+        if available_actions is not None:
+            _copy(self.available_actions[self.step + 1], available_actions)
+
+        self.step = (self.step + 1) % self.episode_length
+
+    def chooseinsert(self, share_obs, obs, recurrent_hidden_states, recurrent_hidden_states_critic, actions, action_log_probs,
+               value_preds, rewards, masks, bad_masks=None, high_masks=None, available_actions=None):
+        _copy(self.share_obs[self.step], share_obs)
+        _copy(self.obs[self.step], obs)
+        _copy(self.recurrent_hidden_states[self.step + 1], recurrent_hidden_states)
+        _copy(self.recurrent_hidden_states_critic[self.step + 1], recurrent_hidden_states_critic)
+        _copy(self.actions[self.step], actions)
+        _copy(self.action_log_probs[self.step], action_log_probs)
+        _copy(self.value_preds[self.step], value_preds)
+        _copy(self.rewards[self.step], rewards)
+        _copy(self.masks[self.step + 1], masks)
+        if bad_masks is not None:
+            _copy(self.bad_masks[self.step + 1], bad_masks)
+        if high_masks is not None:
+            _copy(self.high_masks[self.step + 1], high_masks)
+        if available_actions is not None:
+            _copy(self.available_actions[self.step], available_actions)
+
+        self.step = (self.step + 1) % self.episode_length
+
+    def insert_last(self, share_obs, obs, available_actions=None):
+        _copy(self.share_obs[-1], share_obs)
+        _copy(self.obs[-1], obs)
+        if available_actions is not None:
+            _copy(self.available_actions[-1], available_actions)
+
+    def after_update(self):
+        self.share_obs[0].copy_(self.share_obs[-1])
+        self.obs[0].copy_(self.obs[-1])
+        self.recurrent_hidden_states[0].copy_(self.recurrent_hidden_states[-1])
+        self.recurrent_hidden_states_critic[0].copy_(self.recurrent_hidden_states_critic[-1])
+        self.masks[0].copy_(self.masks[-1])
+        self.bad_masks[0].copy_(self.bad_masks[-1])
+        self.high_masks[0].copy_(self.high_masks[-1])
+        if self.available_actions is not None:
+            self.available_actions[0].copy_(self.available_actions[-1])
+
+    def chooseafter_update(self):
+        self.recurrent_hidden_states[0].copy_(self.recurrent_hidden_states[-1])
+        self.recurrent_hidden_states_critic[0].copy_(self.recurrent_hidden_states_critic[-1])
+        self.masks[0].copy_(self.masks[-1])
+        self.bad_masks[0].copy_(self.bad_masks[-1])
+        self.high_masks[0].copy_(self.high_masks[-1])
+
+    def get_share_obs(self, step):
+        if self.dedup_share_obs:
+            return self.share_obs[step].expand(-1, self.obs.shape[2], *self.share_obs.shape[3:])
+        return self.share_obs[step]
+
+    def get_agent_share_obs(self, step, agent_id):
+        if self.dedup_share_obs:
+            return self.share_obs[step][:, 0]
+        return self.share_obs[step][:, agent_id]
+
+    def compute_returns(self,
+                        agent_id,
+                        next_value,
+                        use_gae,
+                        gamma,
+                        gae_lambda,
+                        use_proper_time_limits=True,
+                        use_popart=True,
+                        value_normalizer=None):
+        if use_gae:
+            _copy(self.value_preds[-1,:,agent_id], next_value)
+        else:
+            _copy(self.returns[-1,:,agent_id], next_value)
+        compute_returns(self.rewards[:,:,agent_id],
+                        self.value_preds[:,:,agent_id],
+                        self.returns[:,:,agent_id],
+                        self.masks[:,:,agent_id],
+                        self.bad_masks[:,:,agent_id],
+                        use_gae,
+                        gamma,
+                        gae_lambda,
+                        use_proper_time_limits,
+                        use_popart,
+                        value_normalizer)
+
+    def compute_returns_all(self,
+                            next_value,
+                            use_gae,
+                            gamma,
+                            gae_lambda,
+                            use_proper_time_limits=True,
+                            use_popart=True,
+                            value_normalizer=None):
+        if use_gae:
+            _copy(self.value_preds[-1], next_value)
+        else:
+            _copy(self.returns[-1], next_value)
+        compute_returns(self.rewards,
+                        self.value_preds,
+                        self.returns,
+                        self.masks,
+                        self.bad_masks,
+                        use_gae,
+                        gamma,
+                        gae_lambda,
+                        use_proper_time_limits,
+                        use_popart,
+                        value_normalizer)
+
+    def _fields(self, agent_id=None):
+        # [T(+1), N, M, Dim] --> [T, N, Dim] for one agent, [T, N, M, Dim] for all of them
+        if agent_id is None:
+            index = slice(None)
+        else:
+            index = agent_id
+        if not self.dedup_share_obs:
+            share_obs = self.share_obs[:-1,:,index]
+        elif agent_id is None:
+            # row index into _share_obs_rows() in place of the share_obs itself, see _gather_share_obs
+            T, N, M = self.rewards.shape[0:3]
+            share_obs = torch.arange(T * N, device=self.device).reshape(T, N, 1, 1).expand(T, N, M, 1)
+        else:
+            share_obs = self.share_obs[:-1,:,0]
+        return [share_obs,
+                self.obs[:-1,:,index],
+                self.recurrent_hidden_states[:-1,:,index],
+                self.recurrent_hidden_states_critic[:-1,:,index],
+                self.actions[:,:,index],
+                self.value_preds[:-1,:,index],
+                self.returns[:-1,:,index],
+                self.masks[:-1,:,index],
+                self.high_masks[:-1,:,index],
+                self.action_log_probs[:,:,index]]
+
+    def _share_obs_rows(self):
+        # de-duplicated share_obs as [T*N, Dim]
+        return self.share_obs[:-1].reshape(-1, *self.share_obs.shape[3:])
+
+    def _gather_share_obs(self, batch, share):
+        # swap the share_obs row index of a de-duplicated all-agents batch for the share_obs it points at
+        if self.dedup_share_obs and share:
+            batch[0] = self._share_obs_rows()[batch[0][..., 0]]
+        return batch
+
+    def _feed_forward_generator(self, fields, advantages, batch_dims, num_mini_batch, mini_batch_size):
+        batch_size = int(np.prod(fields[0].shape[:batch_dims]))
+        if mini_batch_size is None:
+            assert batch_size >= num_mini_batch, (
+                "PPO requires the batch size ({}) "
+                "to be greater than or equal to the number of PPO mini batches ({})."
+                "".format(batch_size, num_mini_batch))
+            mini_batch_size = batch_size // num_mini_batch
+
+        rand = torch.randperm(batch_size)
+        sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
+
+        fields = [x.reshape(-1, *x.shape[batch_dims:]) for x in fields]
+        if advantages is not None:
+            advantages = torch.as_tensor(advantages).to(self.device).reshape(-1, 1)
+
+        for indices in sampler:
+            indices = indices.to(self.device)
+            batch = [x[indices] for x in fields]
+            if advantages is None:
+                batch.append(None)
+            else:
+                batch.append(advantages[indices])
+            yield tuple(self._gather_share_obs(batch, batch_dims == 3))
+
+    def feed_forward_generator(self, agent_id, advantages, num_mini_batch=None, mini_batch_size=None):
+        return self._feed_forward_generator(self._fields(agent_id), advantages, 2, num_mini_batch, mini_batch_size)
+
+    def feed_forward_generator_share(self, advantages, num_mini_batch=None, mini_batch_size=None):
+        return self._feed_forward_generator(self._fields(), advantages, 3, num_mini_batch, mini_batch_size)
+
+    def _naive_recurrent_generator(self, fields, advantages, num_mini_batch, share=False):
+        # fields are [T, B, Dim] with B the threads (or threads*agents) that are sampled whole
+        batch_size = fields[0].shape[1]
+        assert batch_size >= num_mini_batch, (
+            "PPO requires the number of processes ({}) "
+            "to be greater than or equal to the number of "
+            "PPO mini batches ({}).".format(batch_size, num_mini_batch))
+        num_envs_per_batch = batch_size // num_mini_batch
+        perm = torch.randperm(batch_size)
+        fields = fields + [torch.as_tensor(advantages).to(self.device).reshape(fields[0].shape[0], batch_size, 1)]
+
+        for start_ind in range(0, batch_size, num_envs_per_batch):
+            indices = perm[start_ind:start_ind + num_envs_per_batch].to(self.device)
+            batch = []
+            for i, x in enumerate(fields):
+                if i in (2, 3):
+                    # States is just a (N, -1) tensor
+                    batch.append(x[0, indices])
+                else:
+                    # Flatten the (T, N, ...) tensors to (T * N, ...)
+                    x = x[:, indices]
+                    batch.append(x.reshape(-1, *x.shape[2:]))
+            yield tuple(self._gather_share_obs(batch, share))
+
+    def naive_recurrent_generator(self, agent_id, advantages, num_mini_batch):
+        return self._naive_recurrent_generator(self._fields(agent_id), advantages, num_mini_batch)
+
+    def naive_recurrent_generator_share(self, advantages, num_mini_batch):
+        fields = [x.reshape(x.shape[0], -1, *x.shape[3:]) for x in self._fields()]
+        return self._naive_recurrent_generator(fields, advantages, num_mini_batch, True)
+
+    def recurrent_chunks(self, agent_id, advantages, data_chunk_length):
+        # [T, N, Dim] --> [N, T, Dim] --> [N*T, Dim] --> [C, L, Dim]
+        fields = self._fields(agent_id) + [torch.as_tensor(advantages).to(self.device)]
+        chunks = [to_chunks(data_chunk_length, x.transpose(0, 1).reshape(-1, *x.shape[2:])) for x in fields]
+        chunks[2] = chunks[2][:,:1]
+        chunks[3] = chunks[3][:,:1]
+        return chunks
+
+    def recurrent_generator(self, agent_id, advantages, num_mini_batch, data_chunk_length, chunks=None, pin_memory=False, device=None):
+        if chunks is None:
+            chunks = self.recurrent_chunks(agent_id, advantages, data_chunk_length)
+        return chunk_generator(chunks, num_mini_batch, pin_memory, device)
+
+    def recurrent_chunks_share(self, advantages, data_chunk_length):
+        # [T, N, M, Dim] --> [N, M, T, Dim] --> [N*M*T, Dim] --> [C, L, Dim]
+        fields = self._fields() + [torch.as_tensor(advantages).to(self.device)]
+        chunks = [to_chunks(data_chunk_length, x.permute(1, 2, 0, *range(3, x.dim())).reshape(-1, *x.shape[3:])) for x in fields]
+        if self.dedup_share_obs:
+            chunks[0] = GatherChunks(self._share_obs_rows(), chunks[0][..., 0])
+        chunks[2] = chunks[2][:,:1]
+        chunks[3] = chunks[3][:,:1]
+        return chunks
+
+    def recurrent_generator_share(self, advantages, num_mini_batch, data_chunk_length, chunks=None, pin_memory=False, device=None):
+        if chunks is None:
+            chunks = self.recurrent_chunks_share(advantages, data_chunk_length)
+        return chunk_generator(chunks, num_mini_batch, pin_memory, device)
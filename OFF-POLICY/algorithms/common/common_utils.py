@@ -117,6 +117,17 @@ def gumbel_softmax(logits, available_actions=None, temperature=1.0, hard=False,
 def gaussian_noise(shape, std):
     return torch.empty(shape).normal_(mean=0, std=std)
 
+def to_device(input, device):
+    """ Float tensor on device of a sampled buffer field, a numpy array or a (pinned) torch tensor. """
+    if type(input) == np.ndarray:
+        input = torch.from_numpy(input)
+    # copies out of pinned memory do not block
+    return input.float().to(device, non_blocking=True)
+
+def episode_td_errors(errors, mask):
+    """ Mean absolute value over the steps mask keeps of [ep_len, batch_size, 1] TD errors: a priority per episode. """
+    return (errors.abs() * mask).sum(dim=0).view(-1) / mask.sum(dim=0).view(-1).clamp(min=1)
+
 def get_dim_from_space(space):
     if isinstance(space, Box):
         dim = space.shape[0]
@@ -1,11 +1,12 @@
 import numpy as np
 import torch
 import random
+from algorithms.common.sum_tree import SumTree
 
 
 class RecReplayBuffer:
     def __init__(self, max_size, episode_len, policy_ids, agent_ids, policy_agents, policy_obs_dim, policy_cent_obs_dim, policy_act_dim, 
-                 use_cent_agent_obs=False, use_available_actions=True):
+                 use_cent_agent_obs=False, use_available_actions=True, compact=False):
         self.max_size = max_size
         self.episode_len = episode_len
         self.policy_ids = policy_ids
@@ -13,12 +14,17 @@ class RecReplayBuffer:
         self.policy_agents = policy_agents
         self.use_cent_agent_obs = use_cent_agent_obs
         self.use_available_actions = use_available_actions
+        self.compact = compact
 
         self.policy_buffers = {
             p_id: RecPolicyBuffer(p_id, self.max_size, episode_len, self.policy_agents[p_id], policy_obs_dim[p_id], policy_cent_obs_dim[p_id],
-                                  policy_act_dim[p_id], self.use_cent_agent_obs, self.use_available_actions) for p_id in self.policy_ids}
+                                  policy_act_dim[p_id], self.use_cent_agent_obs, self.use_available_actions, self.compact) for p_id in self.policy_ids}
         self.size = 0
-        
+
+    @property
+    def nbytes(self):
+        """Memory held by the arrays of all the policy buffers, in bytes."""
+        return sum(p_buffer.nbytes for p_buffer in self.policy_buffers.values())
 
     def push(self, num_envs, obs, cent_obs, acts, rews, nobs, cent_nobs, dones, avail_acts=None, navail_acts=None):
         o, co, a, r, no, cno, d, aa, naa = {}, {}, {}, {}, {}, {}, {}, {}, {}
@@ -41,20 +47,40 @@ class RecReplayBuffer:
             co = np.stack([np.stack([co_t[i]['cent_obs'] for i in range(num_envs)]) for co_t in cent_obs])
             cno = np.stack([np.stack([cno_t[i]['cent_obs'] for i in range(num_envs)]) for cno_t in cent_nobs])
 
+        if self.use_available_actions:
+            self.push_stacked(num_envs, o, co, a, r, no, cno, d, aa, naa)
+        else:
+            self.push_stacked(num_envs, o, co, a, r, no, cno, d)
+
+    def rollout_arrays(self, num_envs):
+        """ Empty RolloutArrays for the episodes of num_envs envs, to collect a rollout into and push_stacked """
+        return RolloutArrays(self, num_envs)
+
+    def push_stacked(self, num_envs, obs, cent_obs, acts, rews, nobs, cent_nobs, dones, avail_acts=None, navail_acts=None):
+        """
+        push() for rollouts that already hold [ep_len, num_envs, dim] arrays (see RolloutArrays): obs, acts, rews,
+        nobs, dones and the available actions map agent ids to them (rews and dones with dim 1, dones also has an
+        'env' entry), cent_obs and cent_nobs too if use_cent_agent_obs, otherwise they are the arrays of the shared
+        cent_obs.
+        """
         for p_buffer in self.policy_buffers.values():
-            if self.use_available_actions:
-                p_buffer.push(num_envs, o, co, a, r, no, cno, d, aa, naa)
-            else:
-                p_buffer.push(num_envs, o, co, a, r, no, cno, d)
+            p_buffer.push(num_envs, obs, cent_obs, acts, rews, nobs, cent_nobs, dones, avail_acts, navail_acts)
 
         assert len(set([p_buffer.num_episodes for p_buffer in self.policy_buffers.values()])) == 1
         self.size = self.policy_buffers[self.policy_ids[0]].size
 
-    def sample_chunks(self, batch_size):
+    def sample_chunks(self, batch_size, as_tensors=False):
+        """
+        batch_size whole episodes, each field a dict from policy id to [num_agents, episode_len, batch_size, dim]
+        arrays ([episode_len, batch_size, dim] for the shared cent_obs and the env dones). With as_tensors they
+        are float32 torch tensors instead, in pinned memory when cuda is available.
+        """
         assert self.size > batch_size, "Cannot sample with no completed episodes in the buffer!"
 
         batch_inds = np.random.choice(self.size, batch_size)
-        # batch_inds = np.array([0])
+        return self.sample_episodes(batch_inds, as_tensors)
+
+    def sample_episodes(self, batch_inds, as_tensors=False):
         obs = {}
         cent_obs = {}
         act = {}
@@ -68,7 +94,7 @@ class RecReplayBuffer:
         done_env_added = False
         for p_id in self.policy_ids:
             p_buffer = self.policy_buffers[p_id]
-            o, co, a, r, no, cno, d, d_env, aa, naa = p_buffer.sample_episodes(batch_inds)
+            o, co, a, r, no, cno, d, d_env, aa, naa = p_buffer.sample_episodes(batch_inds, as_tensors)
             obs[p_id] = o           
             act[p_id] = a
             rew[p_id] = r
@@ -84,8 +110,64 @@ class RecReplayBuffer:
                 done_env_added = True
         return obs, cent_obs, act, rew, nobs, cent_nobs, dones, avail_acts, navail_acts
 
+class PrioritizedRecReplayBuffer(RecReplayBuffer):
+    """
+    RecReplayBuffer sampling episodes in proportion to priority ** alpha (Schaul et al., 2015), with the
+    priorities kept in a SumTree. New episodes get the largest priority seen so far.
+    """
+    def __init__(self, alpha, max_size, episode_len, policy_ids, agent_ids, policy_agents, policy_obs_dim, policy_cent_obs_dim,
+                 policy_act_dim, use_cent_agent_obs=False, use_available_actions=True, compact=False):
+        super(PrioritizedRecReplayBuffer, self).__init__(max_size, episode_len, policy_ids, agent_ids, policy_agents, policy_obs_dim,
+                                                         policy_cent_obs_dim, policy_act_dim, use_cent_agent_obs,
+                                                         use_available_actions, compact)
+        self.alpha = alpha
+        self.sum_tree = SumTree(max_size)
+        self.max_priority = 1.0
+
+    def push_stacked(self, num_envs, obs, cent_obs, acts, rews, nobs, cent_nobs, dones, avail_acts=None, navail_acts=None):
+        super(PrioritizedRecReplayBuffer, self).push_stacked(num_envs, obs, cent_obs, acts, rews, nobs, cent_nobs, dones,
+                                                             avail_acts, navail_acts)
+        # the episodes just written end at the write position
+        end = self.policy_buffers[self.policy_ids[0]].num_episodes
+        self.sum_tree.set(np.arange(end - num_envs, end), self.max_priority ** self.alpha)
+
+    def sample_chunks(self, batch_size, beta, as_tensors=False):
+        """
+        sample_chunks of RecReplayBuffer with the episodes drawn by priority, followed by their [batch_size]
+        importance sampling weights (size * P(i)) ** -beta, normalized by the largest, and the episode indices
+        to pass to update_priorities.
+        """
+        assert self.size > batch_size, "Cannot sample with no completed episodes in the buffer!"
+
+        batch_inds = self.sum_tree.stratified_sample(batch_size)
+        probs = self.sum_tree.get(batch_inds) / self.sum_tree.total()
+        weights = (self.size * probs) ** (-beta)
+        weights = (weights / weights.max()).astype(np.float32)
+        if as_tensors:
+            weights = torch.from_numpy(weights)
+        return self.sample_episodes(batch_inds, as_tensors) + (weights, batch_inds)
+
+    def update_priorities(self, batch_inds, priorities):
+        """ Sets the priorities of the sampled episodes batch_inds, e.g. to their mean absolute TD errors. """
+        priorities = np.asarray(priorities, dtype=np.float64)
+        assert (priorities > 0).all(), "Priorities should be positive"
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.sum_tree.set(batch_inds, priorities ** self.alpha)
+
 class RecPolicyBuffer:
-    def __init__(self, policy_id, max_size, episode_len, policy_agents, obs_dim, cent_obs_dim, act_dim, use_cent_agent_obs=False, use_available_actions=True):
+    """
+    Episodes of one policy. Arrays are episode major, [episode, agent, step, dim] (no agent axis for a shared
+    cent_obs), so the episodes of a sample are contiguous rows; sample_episodes returns them in the
+    [agent, step, episode, dim] layout the trainers use.
+
+    With compact=True observations, actions and rewards are float32 and available actions uint8, and the
+    observation fields keep episode_len + 1 steps: the next step fields are read from the step after, so
+    they are not stored twice. This requires every pushed episode to have nobs[t] equal to obs[t + 1],
+    as in the rollouts where all agents act every step; sample_episodes then returns the same values as
+    the default layout for every step of the pushed episodes.
+    """
+    def __init__(self, policy_id, max_size, episode_len, policy_agents, obs_dim, cent_obs_dim, act_dim, use_cent_agent_obs=False,
+                 use_available_actions=True, compact=False):
         self.max_size = max_size
         self.num_agents = len(policy_agents)
         self.policy_id = policy_id
@@ -93,86 +175,199 @@ class RecPolicyBuffer:
         self.agent_ids = policy_agents
         self.use_cent_agent_obs = use_cent_agent_obs
         self.use_available_actions = use_available_actions
-        
+        self.compact = compact
+
         if isinstance(act_dim, np.ndarray):
             # multidiscrete case
             self.act_dim = int(sum(act_dim))
         else:
             self.act_dim = act_dim
 
-        self.observations = np.zeros((self.num_agents, episode_len, max_size, obs_dim))
+        if self.compact:
+            obs_len, dtype, avail_dtype = episode_len + 1, np.float32, np.uint8
+        else:
+            obs_len, dtype, avail_dtype = episode_len, np.float64, np.float64
+
+        self.observations = np.zeros((max_size, self.num_agents, obs_len, obs_dim), dtype=dtype)
 
         if self.use_cent_agent_obs:
-            self.cent_observations = np.zeros((self.num_agents, episode_len, max_size, cent_obs_dim))
+            self.cent_observations = np.zeros((max_size, self.num_agents, obs_len, cent_obs_dim), dtype=dtype)
         else:
-            self.cent_observations = np.zeros((episode_len, max_size, cent_obs_dim))
+            self.cent_observations = np.zeros((max_size, obs_len, cent_obs_dim), dtype=dtype)
 
-        self.actions = np.zeros((self.num_agents, episode_len, max_size, self.act_dim))
-        self.rewards = np.zeros((self.num_agents, episode_len, max_size,  1))
-        self.next_observations = np.zeros_like(self.observations)
-        self.next_cent_observations = np.zeros_like(self.cent_observations)
+        self.actions = np.zeros((max_size, self.num_agents, episode_len, self.act_dim), dtype=dtype)
+        self.rewards = np.zeros((max_size, self.num_agents, episode_len, 1), dtype=dtype)
+        if not self.compact:
+            self.next_observations = np.zeros_like(self.observations)
+            self.next_cent_observations = np.zeros_like(self.cent_observations)
         # default to done being True
         self.dones = np.ones_like(self.rewards).astype(bool)
-        self.dones_env = np.ones((episode_len, max_size, 1))
+        self.dones_env = np.ones((max_size, episode_len, 1), dtype=dtype)
         if self.use_available_actions:
-            self.available_actions = np.ones((self.num_agents, episode_len, max_size, self.act_dim))
-            self.next_available_actions = np.ones_like(self.available_actions)
+            self.available_actions = np.ones((max_size, self.num_agents, obs_len, self.act_dim), dtype=avail_dtype)
+            if not self.compact:
+                self.next_available_actions = np.ones_like(self.available_actions)
 
         self.num_episodes = 0
         self.num_transitions = 0
         self.size = 0
         self.freeze_size = False
+        # pinned host memory only exists with cuda
+        self.pin_memory = torch.cuda.is_available()
 
+    @property
+    def nbytes(self):
+        """Memory held by the buffer arrays, in bytes."""
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
 
     def push(self, num_eps, obs, cent_obs, acts, rew, nobs, cent_nobs, dones, avail_acts=None, navail_acts=None):
+        # the inputs are [ep_len, num_eps, dim]
         if self.num_episodes + num_eps >= self.max_size:
             self.size = self.num_episodes
             self.num_episodes = 0
             self.freeze_size = True
 
+        episodes = slice(self.num_episodes, self.num_episodes + num_eps)
         ep_len = None
         for i in range(self.num_agents):
             ep_len = obs[self.agent_ids[i]].shape[0]
-            self.observations[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = obs[self.agent_ids[i]]
-            self.actions[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = acts[self.agent_ids[i]]
+            self.observations[episodes, i, 0 : ep_len] = obs[self.agent_ids[i]].swapaxes(0, 1)
+            self.actions[episodes, i, 0 : ep_len] = acts[self.agent_ids[i]].swapaxes(0, 1)
             if self.use_available_actions:
-                self.available_actions[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = avail_acts[self.agent_ids[i]]
-                self.next_available_actions[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = navail_acts[self.agent_ids[i]]
-            self.rewards[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = rew[self.agent_ids[i]]
-            self.next_observations[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = nobs[self.agent_ids[i]]
-            self.dones[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = dones[self.agent_ids[i]]
+                self.available_actions[episodes, i, 0 : ep_len] = avail_acts[self.agent_ids[i]].swapaxes(0, 1)
+                self._push_next('available_actions', navail_acts[self.agent_ids[i]], ep_len, episodes, i)
+            self.rewards[episodes, i, 0 : ep_len] = rew[self.agent_ids[i]].swapaxes(0, 1)
+            self._push_next('observations', nobs[self.agent_ids[i]], ep_len, episodes, i)
+            self.dones[episodes, i, 0 : ep_len] = dones[self.agent_ids[i]].swapaxes(0, 1)
             if self.use_cent_agent_obs:
-                self.cent_observations[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = cent_obs[self.agent_ids[i]]
-                self.next_cent_observations[i, 0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = cent_nobs[self.agent_ids[i]]
+                self.cent_observations[episodes, i, 0 : ep_len] = cent_obs[self.agent_ids[i]].swapaxes(0, 1)
+                self._push_next('cent_observations', cent_nobs[self.agent_ids[i]], ep_len, episodes, i)
         if not self.use_cent_agent_obs:
-            self.cent_observations[0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = cent_obs
-            self.next_cent_observations[0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = cent_nobs
-        self.dones_env[0 : ep_len, self.num_episodes : self.num_episodes + num_eps, :] = dones['env']
+            self.cent_observations[episodes, 0 : ep_len] = cent_obs.swapaxes(0, 1)
+            self._push_next('cent_observations', cent_nobs, ep_len, episodes)
+        self.dones_env[episodes, 0 : ep_len] = dones['env'].swapaxes(0, 1)
         self.num_episodes += num_eps
 
         if not self.freeze_size:
             self.size = self.num_episodes
 
-    def sample_episodes(self, episode_inds):
-        obs = self.observations[:, :, episode_inds, :]
-        acts = self.actions[:, :, episode_inds, :]
-        rews = self.rewards[:, :, episode_inds, :]
-        nobs = self.next_observations[:, :, episode_inds, :]
-        dones = self.dones[:, :, episode_inds, :]
-        if self.use_cent_agent_obs:
-            cent_obs = self.cent_observations[:, :, episode_inds, :]
-            cent_nobs = self.next_cent_observations[:, :, episode_inds, :]
+    def _push_next(self, name, values, ep_len, episodes, agent_ind=None):
+        # next step values of the episodes being pushed, for the current step field name
+        index = (episodes,) if agent_ind is None else (episodes, agent_ind)
+        if self.compact:
+            # all but the last are the current step values of the step after, which are already stored
+            getattr(self, name)[index + (ep_len,)] = values[-1]
         else:
-            cent_obs = self.cent_observations[:, episode_inds, :]
-            cent_nobs = self.next_cent_observations[:, episode_inds, :]
-        dones_env = self.dones_env[:, episode_inds, :]
+            getattr(self, 'next_' + name)[index + (slice(0, ep_len),)] = values.swapaxes(0, 1)
+
+    def _sample_with_next(self, name, episode_inds):
+        # current and next step values of the field name for the sampled episodes, still episode major
+        if not self.compact:
+            return getattr(self, name).take(episode_inds, axis=0), getattr(self, 'next_' + name).take(episode_inds, axis=0)
+        values = getattr(self, name).take(episode_inds, axis=0)
+        return values[..., :-1, :], values[..., 1:, :]
+
+    def _to_layout(self, values, as_tensors):
+        # [episode, (agent,) step, dim] -> [(agent,) step, episode, dim]
+        axes = (1, 2, 0, 3) if values.ndim == 4 else (1, 0, 2)
+        if not as_tensors:
+            return values.transpose(axes)
+        values = torch.from_numpy(values).float()
+        if self.pin_memory:
+            values = values.pin_memory()
+        return values.permute(axes)
+
+    def sample_episodes(self, episode_inds, as_tensors=False):
+        obs, nobs = self._sample_with_next('observations', episode_inds)
+        acts = self.actions.take(episode_inds, axis=0)
+        rews = self.rewards.take(episode_inds, axis=0)
+        dones = self.dones.take(episode_inds, axis=0)
+        cent_obs, cent_nobs = self._sample_with_next('cent_observations', episode_inds)
+        dones_env = self.dones_env.take(episode_inds, axis=0)
 
         if self.use_available_actions:
-            avail_acts = self.available_actions[:, :, episode_inds, :]
-            navail_acts = self.next_available_actions[:, :, episode_inds, :]
+            avail_acts, navail_acts = self._sample_with_next('available_actions', episode_inds)
+            if self.compact and not as_tensors:
+                avail_acts, navail_acts = avail_acts.astype(np.float32), navail_acts.astype(np.float32)
+            avail_acts, navail_acts = self._to_layout(avail_acts, as_tensors), self._to_layout(navail_acts, as_tensors)
         else:
             avail_acts = None
             navail_acts = None
-        
+
+        obs, cent_obs, acts, rews, nobs, cent_nobs, dones, dones_env = [
+            self._to_layout(values, as_tensors) for values in (obs, cent_obs, acts, rews, nobs, cent_nobs, dones, dones_env)]
         return obs, cent_obs, acts, rews, nobs, cent_nobs, dones, dones_env, avail_acts, navail_acts
-        
\ No newline at end of file
+
+class RolloutArrays:
+    """
+    The episodes of a rollout in the [episode_len, num_envs, dim] arrays RecReplayBuffer.push_stacked takes,
+    allocated once and filled in place step by step from the per-env dicts the envs return.
+    """
+    def __init__(self, buffer, num_envs):
+        self.buffer = buffer
+        self.agent_ids = buffer.agent_ids
+        self.use_cent_agent_obs = buffer.use_cent_agent_obs
+        self.use_available_actions = buffer.use_available_actions
+
+        shape = (buffer.episode_len, num_envs)
+        self.obs, self.acts, self.rews, self.nobs, self.dones, self.avail_acts, self.navail_acts = [{} for _ in range(7)]
+        if self.use_cent_agent_obs:
+            self.cent_obs, self.cent_nobs = {}, {}
+        for p_buffer in buffer.policy_buffers.values():
+            dtype = p_buffer.observations.dtype
+            obs_dim, cent_obs_dim = p_buffer.observations.shape[-1], p_buffer.cent_observations.shape[-1]
+            for a_id in p_buffer.agent_ids:
+                self.obs[a_id] = np.zeros(shape + (obs_dim,), dtype=dtype)
+                self.nobs[a_id] = np.zeros(shape + (obs_dim,), dtype=dtype)
+                self.acts[a_id] = np.zeros(shape + (p_buffer.act_dim,), dtype=dtype)
+                self.rews[a_id] = np.zeros(shape + (1,), dtype=dtype)
+                self.dones[a_id] = np.ones(shape + (1,), dtype=bool)
+                if self.use_available_actions:
+                    self.avail_acts[a_id] = np.ones(shape + (p_buffer.act_dim,), dtype=p_buffer.available_actions.dtype)
+                    self.navail_acts[a_id] = np.ones(shape + (p_buffer.act_dim,), dtype=p_buffer.available_actions.dtype)
+                if self.use_cent_agent_obs:
+                    self.cent_obs[a_id] = np.zeros(shape + (cent_obs_dim,), dtype=dtype)
+                    self.cent_nobs[a_id] = np.zeros(shape + (cent_obs_dim,), dtype=dtype)
+            if not self.use_cent_agent_obs:
+                self.cent_obs = np.zeros(shape + (cent_obs_dim,), dtype=dtype)
+                self.cent_nobs = np.zeros(shape + (cent_obs_dim,), dtype=dtype)
+        self.dones['env'] = np.ones(shape + (1,), dtype=bool)
+
+    def insert(self, step, obs, cent_obs, acts, rews, nobs, cent_nobs, dones, avail_acts=None, navail_acts=None, envs=None):
+        """
+        Store step of the episodes of all envs, or of the envs listed in envs. Every argument is a list with a dict
+        per env, from agent id to the value (dones also has 'env'); cent_obs and cent_nobs map 'cent_obs' to the
+        shared cent_obs unless use_cent_agent_obs.
+        """
+        index = (step, slice(None) if envs is None else envs)
+        for a_id in self.agent_ids:
+            self.obs[a_id][index] = [o[a_id] for o in obs]
+            self.acts[a_id][index] = [a[a_id] for a in acts]
+            self.rews[a_id][index + (0,)] = [r[a_id] for r in rews]
+            self.nobs[a_id][index] = [no[a_id] for no in nobs]
+            self.dones[a_id][index + (0,)] = [d[a_id] for d in dones]
+            if self.use_available_actions:
+                self.avail_acts[a_id][index] = [aa[a_id] for aa in avail_acts]
+                self.navail_acts[a_id][index] = [naa[a_id] for naa in navail_acts]
+            if self.use_cent_agent_obs:
+                self.cent_obs[a_id][index] = [co[a_id] for co in cent_obs]
+                self.cent_nobs[a_id][index] = [cno[a_id] for cno in cent_nobs]
+        if not self.use_cent_agent_obs:
+            self.cent_obs[index] = [co['cent_obs'] for co in cent_obs]
+            self.cent_nobs[index] = [cno['cent_obs'] for cno in cent_nobs]
+        self.dones['env'][index + (0,)] = [d['env'] for d in dones]
+
+    def push(self, ep_len, envs=None):
+        """ Push the first ep_len steps of the episodes of all envs, or of the envs listed in envs, to the buffer """
+        index = (slice(0, ep_len), slice(None) if envs is None else envs)
+
+        def take(values):
+            if isinstance(values, dict):
+                return {key: array[index] for key, array in values.items()}
+            return values[index]
+
+        fields = [self.obs, self.cent_obs, self.acts, self.rews, self.nobs, self.cent_nobs, self.dones]
+        if self.use_available_actions:
+            fields += [self.avail_acts, self.navail_acts]
+        num_envs = self.obs[self.agent_ids[0]].shape[1] if envs is None else len(envs)
+        self.buffer.push_stacked(num_envs, *[take(values) for values in fields])
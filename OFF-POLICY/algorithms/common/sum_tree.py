@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class SumTree:
+    """
+    Sum tree over capacity priorities, stored in one flat array: node i has children 2i + 1 and 2i + 2 and the
+    leaves, padded to a power of two with zero priorities, are the last nodes. Sampling and updates take arrays
+    of indices and walk all of them down (or up) the tree together, one numpy operation per level.
+    """
+    def __init__(self, capacity):
+        assert capacity > 0, "Sum tree capacity should be positive"
+        self.capacity = capacity
+        self.depth = int(np.ceil(np.log2(capacity)))
+        # index of the first leaf
+        self.leaf_start = 2 ** self.depth - 1
+        self.nodes = np.zeros(2 * self.leaf_start + 1)
+
+    def total(self):
+        return self.nodes[0]
+
+    def get(self, indices):
+        return self.nodes[self.leaf_start + np.asarray(indices)]
+
+    def set(self, indices, priorities):
+        """ Sets the priorities of indices; for an index given more than once the last priority is kept. """
+        indices = np.asarray(indices).reshape(-1)
+        priorities = np.broadcast_to(priorities, indices.shape)
+        # unique keeps the first occurrence, so look from the end
+        indices, last = np.unique(indices[::-1], return_index=True)
+        nodes = self.leaf_start + indices
+        self.nodes[nodes] = priorities[::-1][last]
+        for _ in range(self.depth):
+            nodes = np.unique((nodes - 1) // 2)
+            self.nodes[nodes] = self.nodes[2 * nodes + 1] + self.nodes[2 * nodes + 2]
+
+    def find(self, query_values):
+        """ Index of the leaf whose prefix sum range [a, a + p) holds each of query_values (in [0, total)). """
+        query_values = np.array(query_values, dtype=np.float64)
+        nodes = np.zeros(query_values.shape, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes + 1
+            left_sums = self.nodes[left]
+            # rounding can leave a query at the total, never step into an empty subtree for it
+            go_right = (query_values >= left_sums) & (self.nodes[left + 1] > 0)
+            query_values -= np.where(go_right, left_sums, 0.0)
+            nodes = left + go_right
+        return nodes - self.leaf_start
+
+    def stratified_sample(self, batch_size):
+        """ One index from each of batch_size equal slices of [0, total), picked with probability priority / total. """
+        assert self.total() > 0, "Cannot sample from an empty sum tree"
+        query_values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) / batch_size
+        return self.find(query_values * self.total())
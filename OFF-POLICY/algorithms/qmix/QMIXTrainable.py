@@ -3,7 +3,7 @@ import numpy as np
 from ray import tune
 from algorithms.qmix.algorithm.QMixPolicy import QMixPolicy
 from algorithms.qmix.qmix import QMix
-from algorithms.common.rec_replay_buffer import RecReplayBuffer
+from algorithms.common.rec_replay_buffer import RecReplayBuffer, PrioritizedRecReplayBuffer
 from tensorboardX import SummaryWriter
 import os
 
@@ -62,7 +62,7 @@ class QMixTrainable(object):
         self.logger = SummaryWriter(self.log_dir)
 
         # set tunable hyperparameters
-        if config.__contains__("use_parallel_envs"):
+        if config.__contains__("use_parallel_envs") and config["use_parallel_envs"]:
             self.num_envs = self.env.num_envs
         else:
             self.num_envs = 1
@@ -82,6 +82,9 @@ class QMixTrainable(object):
         else:
             self.use_available_actions = False
 
+        # MPE rollouts over parallel envs do their own gradient updates, every train_interval env steps
+        self.train_during_rollout = self.num_envs > 1 and not self.use_available_actions and not self.use_cent_agent_obs
+
         if config.__contains__("buffer_length"):
             self.episode_length = config["buffer_length"]
             self.chunk_len = config["buffer_length"]
@@ -89,15 +92,23 @@ class QMixTrainable(object):
             self.episode_length = self.args.episode_length
             self.chunk_len = self.args.episode_length
 
-        self.buffer = RecReplayBuffer(self.buffer_size, self.episode_length,
-                                      self.policy_ids,
-                                      self.agent_ids,
-                                      self.policy_agents,
-                                      self.policy_obs_dim,
-                                      self.policy_central_obs_dim,
-                                      self.policy_act_dim,
-                                      self.use_cent_agent_obs,
-                                      self.use_available_actions)
+        self.use_per = self.args.use_per
+        buffer_args = (self.buffer_size, self.episode_length,
+                       self.policy_ids,
+                       self.agent_ids,
+                       self.policy_agents,
+                       self.policy_obs_dim,
+                       self.policy_central_obs_dim,
+                       self.policy_act_dim,
+                       self.use_cent_agent_obs,
+                       self.use_available_actions,
+                       # turn based rollouts do not have nobs[t] == obs[t + 1]
+                       self.args.use_compact_buffer and not self.take_turn)
+        if self.use_per:
+            self.buffer = PrioritizedRecReplayBuffer(self.args.per_alpha, *buffer_args)
+        else:
+            self.buffer = RecReplayBuffer(*buffer_args)
+        print("replay buffer uses %.2f GB" % (self.buffer.nbytes / 1024 ** 3))
 
         # initialize QMix class for updating policies
         self.trainer = QMix(self.args, self.env.agent_ids, self.policies, self.policy_mapping_fn, self.logger,
@@ -142,30 +153,16 @@ class QMixTrainable(object):
                     avg_train_rew = self.collect_rollout(explore=True, training_episode=True, warmup=False)
                     train_episode_rewards.append(avg_train_rew)
 
-            if self.num_envs > 1:
-                pass
-            else:
-                # do a gradient update if the number of episodes collected since the last training update exceeds the specified amount
-                if ((self.num_episodes_collected - self.last_train_episode) / self.train_interval_episode) >= 1 or self.last_train_episode == 0:
+            # one gradient update for every train_interval_episode episodes collected, whichever envs they came from
+            if not self.train_during_rollout:
+                num_updates = (self.num_episodes_collected - self.last_train_episode) // self.train_interval_episode
+                if self.last_train_episode == 0:
+                    num_updates = max(num_updates, 1)
+                if num_updates > 0:
                     self.trainer.prep_training()
-
-                    sampled_episodes = self.buffer.sample_chunks(self.batch_size)
-
-                    train_stats = self.trainer.train_on_batch(sampled_episodes, self.use_cent_agent_obs)                   
-
-                    if (self.total_env_steps - self.last_log_T) / self.log_interval >= 1:
-                        self.log_stats(train_stats, self.total_env_steps)
-                        self.last_log_T = self.total_env_steps
-                    
-                    if self.use_soft_update:
-                        self.trainer.soft_update_targets()
-                    else:
-                        if (self.num_episodes_collected - self.last_hard_update_episode) / self.hard_update_interval_episode >= 1.0:
-                            self.trainer.update_targets()
-                            self.last_hard_update_episode = self.num_episodes_collected
-
+                    for _ in range(num_updates):
+                        self.train_step()
                     self.last_train_episode = self.num_episodes_collected
-                    self.total_train_steps += 1
 
             if (self.total_env_steps - self.last_save_T) / self.save_interval >= 1:
                 self.save()
@@ -196,6 +193,36 @@ class QMixTrainable(object):
                 self.last_test_T = self.total_env_steps
                 break
 
+    def train_step(self):
+        """ One gradient update on a batch from the buffer, followed by logging and the target network updates. """
+        train_stats = self.train_on_sample()
+
+        if (self.total_env_steps - self.last_log_T) / self.log_interval >= 1:
+            self.log_stats(train_stats, self.total_env_steps)
+            self.last_log_T = self.total_env_steps
+
+        if self.use_soft_update:
+            self.trainer.soft_update_targets()
+        else:
+            if (self.num_episodes_collected - self.last_hard_update_episode) / self.hard_update_interval_episode >= 1.0:
+                self.trainer.update_targets()
+                self.last_hard_update_episode = self.num_episodes_collected
+
+        self.total_train_steps += 1
+
+    def train_on_sample(self):
+        # one update on episodes sampled from the buffer, by priority with use_per
+        if not self.use_per:
+            sampled_episodes = self.buffer.sample_chunks(self.batch_size, as_tensors=True)
+            return self.trainer.train_on_batch(sampled_episodes, self.use_cent_agent_obs)
+        # anneal the importance sampling exponent to 1 over training
+        beta = min(1.0, self.args.per_beta_start + (1.0 - self.args.per_beta_start) * self.total_env_steps / self.args.num_env_steps)
+        sample = self.buffer.sample_chunks(self.batch_size, beta, as_tensors=True)
+        sampled_episodes, importance_weights, episode_inds = sample[:-2], sample[-2], sample[-1]
+        train_stats = self.trainer.train_on_batch(sampled_episodes, self.use_cent_agent_obs, importance_weights)
+        self.buffer.update_priorities(episode_inds, train_stats[-1].cpu().numpy() + self.args.per_eps)
+        return train_stats
+
     def save(self):
         for pid in self.policy_ids:
             policy_Q = self.policies[pid].q_network
@@ -233,7 +260,7 @@ class QMixTrainable(object):
             agent_prev_actions = {a_id: torch.zeros(self.num_envs, self.policy_act_dim[self.policy_mapping_fn(a_id)]) for
                                   a_id in self.agent_ids}
 
-            ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones, ep_avail_acts, ep_navail_acts = [], [], [], [], [], [], [], [], []
+            rollout = self.buffer.rollout_arrays(self.num_envs)
 
             obs, cent_obs, available_actions = env.reset()
             terminate_episodes = False
@@ -373,15 +400,10 @@ class QMixTrainable(object):
                 if turn_count > 0:
                     if training_episode or warmup:
                         self.total_env_steps += env_t
-                    ep_obs.append(turn_obs_last)
-                    ep_nobs.append(turn_nobs_last)
-                    ep_cent_obs.append(turn_cent_obs_last)
-                    ep_cent_nobs.append(turn_cent_nobs_last)
-                    ep_acts.append(turn_acts_last)
-                    ep_rews.append(turn_rew_last)
-                    ep_dones.append(turn_dones_last)
-                    ep_avail_acts.append(turn_avail_acts_last)
-                    ep_navail_acts.append(turn_navail_acts_last)
+                    # the turns after the first are stored, one step each
+                    rollout.insert(turn_count - 1, turn_obs_last, turn_cent_obs_last, turn_acts_last, turn_rew_last,
+                                   turn_nobs_last, turn_cent_nobs_last, turn_dones_last, turn_avail_acts_last,
+                                   turn_navail_acts_last)
 
                 if terminate_episodes:
                     break
@@ -390,8 +412,7 @@ class QMixTrainable(object):
             if (training_episode or warmup) and turn_count > 0:
                 # push all episodes collected in this rollout step to the buffer 
                 success_to_collect_one_episode = True
-                self.buffer.push(self.num_envs, ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones,
-                                 ep_avail_acts, ep_navail_acts)
+                rollout.push(turn_count)
 
             avg_reward = np.mean(np.array(ep_rewards))
 
@@ -407,24 +428,29 @@ class QMixTrainable(object):
             env = self.env  
         else:
             env = self.test_env
+        # the test env may be a single, unvectorized env
+        num_envs = getattr(env, "num_envs", 1)
 
-        ep_rewards = [0 for _ in range(self.num_envs)]
+        ep_rewards = [0 for _ in range(num_envs)]
         # init RNN states and previous actions for each agent
         rnn_states = {
-            p_id: self.policies[p_id].init_hidden(-1, self.num_envs * len(self.policy_agents[p_id])) for
+            p_id: self.policies[p_id].init_hidden(-1, num_envs * len(self.policy_agents[p_id])) for
             p_id in self.policy_ids}
 
-        pol_prev_acts = {p_id: torch.zeros(self.num_envs * len(self.policy_agents[p_id]), self.policy_act_dim[p_id]) for
+        pol_prev_acts = {p_id: torch.zeros(num_envs * len(self.policy_agents[p_id]), self.policy_act_dim[p_id]) for
                          p_id in self.policy_ids}
 
-        ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones, ep_avail_acts, ep_navail_acts = [], [], [], [], [], [], [], [], []
+        # the step data of the episode of each env
+        rollout = self.buffer.rollout_arrays(num_envs)
 
         obs, cent_obs, available_actions = env.reset()
+        # envs whose episode is still running, a finished env is not stepped again
+        running = list(range(num_envs))
         t = 0
         
         while t < self.episode_length:
             # get actions for all agents to step the env
-            env_actions = [dict() for _ in range(self.num_envs)]
+            env_actions = [dict() for _ in range(num_envs)]
 
             for p_id in self.policy_ids:
                 policy = self.policies[p_id]
@@ -443,57 +469,54 @@ class QMixTrainable(object):
                 if eps is not None:
                     self.logger.add_scalar("exploration_eps", eps, global_step=self.total_env_steps)
 
-                agent_acts = act_batch.split(split_size = self.num_envs)
+                agent_acts = act_batch.split(split_size = num_envs)
                 for i in range(len(self.policy_agents[p_id])):
                     agent_id = self.policy_agents[p_id][i]
-                    for j in range(self.num_envs):
+                    for j in range(num_envs):
                         env_actions[j][agent_id] = agent_acts[i][j].cpu().detach().numpy()
 
-            # env step and store the relevant episode information
-            next_obs, cent_next_obs, rew, done, info, next_available_actions = env.step(env_actions)
-        
-            t += 1
-
-            ep_obs.append(obs)
-            ep_cent_obs.append(cent_obs)
-            ep_acts.append(env_actions)
-            ep_rews.append(rew)
-            ep_nobs.append(next_obs)
-            ep_cent_nobs.append(cent_next_obs)
-            ep_dones.append(done)
-            ep_avail_acts.append(available_actions)
-            ep_navail_acts.append(next_available_actions)
+            # step the envs whose episode is still running and store the relevant episode information
+            if len(running) == num_envs:
+                next_obs, cent_next_obs, rew, done, info, next_available_actions = env.step(env_actions)
+            else:
+                next_obs, cent_next_obs, rew, done, info, next_available_actions = env.step_envs(
+                    [env_actions[i] for i in running], running)
 
-            terminate_episodes = any(
-                [d["env"] for d in done]) or t == self.episode_length - 1  # TODO: change any to all?
+            t += 1
 
             if training_episode or warmup:
-                self.total_env_steps += self.num_envs
+                self.total_env_steps += len(running)
 
-            for i in range(self.num_envs):
-                ep_rewards[i] += list(rew[i].values())[0]  # shared reward so take any reward
+            rollout.insert(t - 1, [obs[i] for i in running], [cent_obs[i] for i in running], [env_actions[i] for i in running],
+                           rew, next_obs, cent_next_obs, done, [available_actions[i] for i in running], next_available_actions,
+                           envs=running)
+
+            finished = []
+            for k, i in enumerate(running):
+                ep_rewards[i] += list(rew[k].values())[0]  # shared reward so take any reward
                 # TODO: change to allow for unshared reward
 
-            obs = next_obs
-            cent_obs = cent_next_obs
-            available_actions = next_available_actions
-            
-            if terminate_episodes:
-                for i in range(self.num_envs):
-                    if 'won' in info[i][0].keys():
-                        if info[i][0]['won']:  # take one agent
+                obs[i] = next_obs[k]
+                cent_obs[i] = cent_next_obs[k]
+                available_actions[i] = next_available_actions[k]
+
+                if done[k]["env"] or t == self.episode_length - 1:
+                    finished.append(i)
+                    if 'won' in info[k][0].keys():
+                        if info[k][0]['won']:  # take one agent
                             battles_won += 1
-                break
-        
-        if training_episode or warmup:
-            # push all episodes collected in this rollout to the buffer
-            self.buffer.push(self.num_envs, ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones,
-                             ep_avail_acts, ep_navail_acts)
 
-        avg_reward = np.mean(np.array(ep_rewards))
+            if len(finished) > 0:
+                if training_episode or warmup:
+                    # episodes that ended on the same step have the same length, push them to the buffer together
+                    rollout.push(t, finished)
+                if not warmup and training_episode:
+                    self.num_episodes_collected += len(finished)
+                running = [i for i in running if i not in finished]
+                if len(running) == 0:
+                    break
 
-        if not warmup and training_episode:
-            self.num_episodes_collected += self.num_envs
+        avg_reward = np.mean(np.array(ep_rewards))
 
         return avg_reward, battles_won
 
@@ -522,7 +545,7 @@ class QMixTrainable(object):
                 self.sum_act_dim = temp_act_dim
             pol_prev_acts[p_id] = np.zeros(((self.num_envs * len(self.policy_agents[p_id])), self.sum_act_dim))
          
-        ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones = [], [], [], [], [], [], []
+        rollout = self.buffer.rollout_arrays(self.num_envs)
 
         obs, cent_obs = env.reset()
         t = 0
@@ -589,13 +612,7 @@ class QMixTrainable(object):
                         next_obs = obs
                         cent_next_obs = cent_obs
     
-            ep_obs.append(obs)
-            ep_cent_obs.append(cent_obs)
-            ep_acts.append(buffer_actions)
-            ep_rews.append(rew)
-            ep_nobs.append(next_obs)
-            ep_cent_nobs.append(cent_next_obs)
-            ep_dones.append(done)
+            rollout.insert(t - 1, obs, cent_obs, buffer_actions, rew, next_obs, cent_next_obs, done)
 
             terminate_episodes = any(
                 [d["env"] for d in done]) or t == self.episode_length - 1  # TODO: change any to all?
@@ -619,7 +636,7 @@ class QMixTrainable(object):
         
         if training_episode or warmup:
             # push all episodes collected in this rollout to the buffer
-            self.buffer.push(self.num_envs, ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones)
+            rollout.push(t)
 
         avg_reward = np.mean(np.array(ep_rewards))
 
@@ -650,7 +667,7 @@ class QMixTrainable(object):
                 self.sum_act_dim = temp_act_dim
             pol_prev_acts[p_id] = torch.zeros(((self.num_envs * len(self.policy_agents[p_id])), self.sum_act_dim)).to(self.device)
          
-        ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones = [], [], [], [], [], [], []
+        rollout = self.buffer.rollout_arrays(self.num_envs)
 
         obs = env.reset()
         t = 0
@@ -701,13 +718,7 @@ class QMixTrainable(object):
         
             t += 1
 
-            ep_obs.append(obs)
-            ep_cent_obs.append(cent_obs)
-            ep_acts.append(env_actions)
-            ep_rews.append(rew)
-            ep_nobs.append(next_obs)
-            ep_cent_nobs.append(cent_next_obs)
-            ep_dones.append(done)
+            rollout.insert(t - 1, obs, cent_obs, env_actions, rew, next_obs, cent_next_obs, done)
 
             terminate_episodes = any(
                 [d["env"] for d in done]) or t == self.episode_length - 1  # TODO: change any to all?
@@ -721,33 +732,19 @@ class QMixTrainable(object):
 
             obs = next_obs
 
-            if self.num_envs > 1 and not warmup and training_episode:
+            if self.train_during_rollout and not warmup and training_episode:
                 if ((self.total_env_steps - self.last_train_T) / self.train_interval) >= 1 or self.last_train_T == 0:
                     self.trainer.prep_training()
-
-                    sampled_episodes = self.buffer.sample_chunks(self.batch_size)
-
-                    train_stats = self.trainer.train_on_batch(sampled_episodes, self.use_cent_agent_obs)                   
-
-                    if (self.total_env_steps - self.last_log_T) / self.log_interval >= 1:
-                        self.log_stats(train_stats, self.total_env_steps)
-                        self.last_log_T = self.total_env_steps
-
-                    if (self.num_episodes_collected - self.last_hard_update_episode) / self.hard_update_interval_episode >= 1.0:
-                        self.trainer.update_targets()
-                        self.last_hard_update_episode = self.num_episodes_collected
-
+                    self.train_step()
+                    self.trainer.prep_rollout()
                     self.last_train_T = self.total_env_steps
-                    self.total_train_steps += 1
-            else:
-                pass  
-            
+
             if terminate_episodes:
                 break
         
         if training_episode or warmup:
             # push all episodes collected in this rollout to the buffer
-            self.buffer.push(self.num_envs, ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones)
+            rollout.push(t)
 
         avg_reward = np.mean(np.array(ep_rewards))
 
@@ -818,7 +815,7 @@ class QMixTrainable(object):
 
     def log_stats(self, stats, t_env):
         # unpack the statistics
-        loss, grad_norm, mean_Qs = stats
+        loss, grad_norm, mean_Qs, _ = stats
         # log into tensorboard
         self.logger.add_scalar('loss', loss, global_step=t_env)
         self.logger.add_scalar('grad_norm', grad_norm, global_step=t_env)
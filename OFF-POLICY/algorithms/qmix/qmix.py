@@ -2,7 +2,7 @@ import torch
 import copy
 from algorithms.qmix.algorithm.q_mixer import QMixer
 from torch.optim.rmsprop import RMSprop
-from algorithms.common.common_utils import make_onehot, soft_update
+from algorithms.common.common_utils import make_onehot, soft_update, to_device, episode_td_errors
 import numpy as np
 
 class QMix:
@@ -57,20 +57,20 @@ class QMix:
 
         self.logger = logger
 
-    def train_on_batch(self, batch, use_cent_agent_obs):
+    def train_on_batch(self, batch, use_cent_agent_obs, importance_weights=None):
         # unpack the batch
         obs_batch, cent_obs_batch, act_batch, rew_batch, nobs_batch, cent_nobs_batch, dones_batch, avail_act_batch, navail_act_batch = batch
 
         if use_cent_agent_obs:
             agent_0_pol = self.policy_mapping_fn(self.agent_ids[0])
-            cent_obs_batch = torch.FloatTensor(cent_obs_batch[agent_0_pol][0]).to(self.device)
-            cent_nobs_batch = torch.FloatTensor(cent_nobs_batch[agent_0_pol][0]).to(self.device)
+            cent_obs_batch = to_device(cent_obs_batch[agent_0_pol][0], self.device)
+            cent_nobs_batch = to_device(cent_nobs_batch[agent_0_pol][0], self.device)
         else:
-            cent_obs_batch = torch.FloatTensor(cent_obs_batch[self.policy_ids[0]]).to(self.device)
-            cent_nobs_batch = torch.FloatTensor(cent_nobs_batch[self.policy_ids[0]]).to(self.device)
+            cent_obs_batch = to_device(cent_obs_batch[self.policy_ids[0]], self.device)
+            cent_nobs_batch = to_device(cent_nobs_batch[self.policy_ids[0]], self.device)
 
-        rew_batch = torch.FloatTensor(rew_batch[self.policy_ids[0]]).to(self.device)
-        dones_batch = torch.FloatTensor(dones_batch['env']).to(self.device)
+        rew_batch = to_device(rew_batch[self.policy_ids[0]], self.device)
+        dones_batch = to_device(dones_batch['env'], self.device)
 
         # individual agent q value sequences: each element is of shape (ep_len, batch_size, 1)
         agent_q_sequences = []
@@ -80,9 +80,9 @@ class QMix:
 
         for p_id in self.policy_ids:
             # get data related to the policy id
-            curr_obs_batch = torch.FloatTensor(obs_batch[p_id]).to(self.device)
-            curr_act_batch = torch.FloatTensor(act_batch[p_id]).to(self.device)
-            curr_nobs_batch = torch.FloatTensor(nobs_batch[p_id]).to(self.device)
+            curr_obs_batch = to_device(obs_batch[p_id], self.device)
+            curr_act_batch = to_device(act_batch[p_id], self.device)
+            curr_nobs_batch = to_device(nobs_batch[p_id], self.device)
         
             # stack over agents to process them all at once
             stacked_act_batch = torch.cat(list(curr_act_batch), dim=-2)
@@ -90,7 +90,7 @@ class QMix:
             stacked_nobs_batch = torch.cat(list(curr_nobs_batch), dim=-2)
 
             if navail_act_batch[p_id] is not None:
-                curr_navail_act_batch = torch.FloatTensor(navail_act_batch[p_id]).to(self.device)
+                curr_navail_act_batch = to_device(navail_act_batch[p_id], self.device)
                 stacked_navail_act_batch = torch.cat(list(curr_navail_act_batch), dim=-2)
             else:
                 stacked_navail_act_batch = None
@@ -221,14 +221,20 @@ class QMix:
         predicted_Q_tots = predicted_Q_tot_vals * (1 - curr_dones_mask)
 
         Q_tot_targets = Q_tot_targets * (1 - curr_dones_mask)
-        # loss is MSE Bellman Error
-        loss = (((predicted_Q_tots - Q_tot_targets.detach()) ** 2).sum()) / (1 - curr_dones_mask).sum()
+        errors = predicted_Q_tots - Q_tot_targets.detach()
+        if importance_weights is not None:
+            # prioritized replay: scale each episode's squared errors by its importance sampling weight
+            importance_weights = to_device(importance_weights, self.device).view(1, -1, 1)
+            loss = ((errors ** 2) * importance_weights).sum() / (1 - curr_dones_mask).sum()
+        else:
+            # loss is MSE Bellman Error
+            loss = ((errors ** 2).sum()) / (1 - curr_dones_mask).sum()
         self.optimizer.zero_grad()
         loss.backward()
         grad_norm = torch.nn.utils.clip_grad_norm_(self.parameters, self.args.grad_norm_clip)
         self.optimizer.step()
 
-        return loss, grad_norm, predicted_Q_tots.mean()
+        return loss, grad_norm, predicted_Q_tots.mean(), episode_td_errors(errors.detach(), 1 - curr_dones_mask)
 
     def update_targets(self):
         print("Updating targets")
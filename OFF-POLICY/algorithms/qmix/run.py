@@ -13,6 +13,11 @@ def parse_args(args):
     alg_parser.add_argument('--gamma', type=float, default=0.99, help="Discount factor for env")
     alg_parser.add_argument('--episode_length', type=int, default=80, help="Max length for any episode")
     alg_parser.add_argument('--buffer_size', type=int, default=5000, help="Max # of transitions that replay buffer can contain")
+    alg_parser.add_argument('--use_compact_buffer', action='store_true', default=False, help="Store the replay buffer in float32/uint8 and read next observations from the step after")
+    alg_parser.add_argument('--use_per', action='store_true', default=False, help="Whether to sample episodes by prioritized replay")
+    alg_parser.add_argument('--per_alpha', type=float, default=0.6, help="Exponent of the priorities in prioritized replay")
+    alg_parser.add_argument('--per_beta_start', type=float, default=0.4, help="Importance sampling exponent at the start, annealed to 1 over num_env_steps")
+    alg_parser.add_argument('--per_eps', type=float, default=1e-6, help="Added to the TD errors to form the priorities")
 
     # Architecture Parameters
     alg_parser.add_argument('--hypernet_layers', type=int, default=2, help="Number of layers for hypernetworks. Must be either 1 or 2")
@@ -13,6 +13,7 @@ def parse_args(args):
     alg_parser.add_argument('--gamma', type=float, default=0.99, help="Discount factor for env")
     alg_parser.add_argument('--episode_length', type=int, default=80, help="Max length for any episode")
     alg_parser.add_argument('--buffer_size', type=int, default=5000, help="Max # of transitions that replay buffer can contain")
+    alg_parser.add_argument('--use_compact_buffer', action='store_true', default=False, help="Store the replay buffer in float32/uint8 and read next observations from the step after")
 
     # optimization/training parameters
     alg_parser.add_argument('--share_policy', action='store_false', default=True, help="Whether use a centralized critic")
@@ -2,6 +2,7 @@ import torch
 import numpy as np
 import copy
 import itertools
+from algorithms.common.common_utils import to_device, episode_td_errors
 
 class R_MASAC:
     def __init__(self, args, env, policies, policy_mapping_fn, logger, episode_length=None):
@@ -104,7 +105,7 @@ class R_MASAC:
         return cent_act_sequence_critic, act_sequences, act_sequence_replace_ind_start, cent_nact_sequence, all_agent_nact_log_probs, update_policy_nact_log_probs
 
     # @profile
-    def train_policy_on_batch(self, update_policy_id, batch):
+    def train_policy_on_batch(self, update_policy_id, batch, importance_weights=None):
         # unpack the batch
         obs_batch, cent_obs_batch, act_batch, rew_batch, nobs_batch, cent_nobs_batch, dones_batch, avail_act_batch, navail_act_batch = batch
         # obs_batch: dict mapping policy id to batches where each batch is shape (# agents, chunk_len, batch_size, obs_dim)
@@ -166,10 +167,16 @@ class R_MASAC:
 
         # make sure to detach the targets! Loss is MSE loss, but divide by the number of unmasked elements
         # Mean bellman error for each timestep
-        Q1_loss = (((predicted_Q1_sequence - target_Q_sequence.float().detach()) ** 2).sum()) / (
-                1 - curr_env_dones).sum()
-        Q2_loss = (((predicted_Q2_sequence - target_Q_sequence.float().detach()) ** 2).sum()) / (
-                1 - curr_env_dones).sum()
+        Q1_errors = predicted_Q1_sequence - target_Q_sequence.float().detach()
+        Q2_errors = predicted_Q2_sequence - target_Q_sequence.float().detach()
+        td_errors = episode_td_errors((Q1_errors.detach().abs() + Q2_errors.detach().abs()) / 2, 1 - curr_env_dones)
+        if importance_weights is None:
+            weights = 1.0
+        else:
+            # prioritized replay: scale each episode's squared errors by its importance sampling weight
+            weights = to_device(importance_weights, Q1_errors.device).view(1, -1, 1)
+        Q1_loss = (((Q1_errors ** 2) * weights).sum()) / (1 - curr_env_dones).sum()
+        Q2_loss = (((Q2_errors ** 2) * weights).sum()) / (1 - curr_env_dones).sum()
         critic_loss = Q1_loss + Q2_loss
 
         update_policy.critic_optimizer.zero_grad()
@@ -310,10 +317,10 @@ class R_MASAC:
             alpha_loss = torch.scalar_tensor(0.0)
             ent_diff = torch.scalar_tensor(0.0)
 
-        return critic_loss, actor_loss, alpha_loss, critic_update_grad_norm, actor_update_grad_norm, update_policy.alpha, ent_diff
+        return critic_loss, actor_loss, alpha_loss, critic_update_grad_norm, actor_update_grad_norm, update_policy.alpha, ent_diff, td_errors
 
 
-    def cent_train_policy_on_batch(self, update_policy_id, batch):
+    def cent_train_policy_on_batch(self, update_policy_id, batch, importance_weights=None):
         # unpack the batch
         obs_batch, cent_obs_batch, act_batch, rew_batch, nobs_batch, cent_nobs_batch, dones_batch, avail_act_batch, navail_act_batch = batch
         # obs_batch: dict mapping policy id to batches where each batch is shape (# agents, chunk_len, batch_size, obs_dim)
@@ -374,10 +381,18 @@ class R_MASAC:
 
         # make sure to detach the targets! Loss is MSE loss, but divide by the number of unmasked elements
         # Mean bellman error for each timestep
-        Q1_loss = (((predicted_Q1_sequence - target_Q_sequence.float().detach()) ** 2).sum()) / (
-                1 - curr_env_dones).sum()
-        Q2_loss = (((predicted_Q2_sequence - target_Q_sequence.float().detach()) ** 2).sum()) / (
-                1 - curr_env_dones).sum()
+        Q1_errors = predicted_Q1_sequence - target_Q_sequence.float().detach()
+        Q2_errors = predicted_Q2_sequence - target_Q_sequence.float().detach()
+        # the batch holds every update agent's copy of each episode (agent major), one priority per episode
+        td_errors = episode_td_errors((Q1_errors.detach().abs() + Q2_errors.detach().abs()) / 2, 1 - curr_env_dones)
+        td_errors = td_errors.view(num_update_agents, batch_size).mean(0)
+        if importance_weights is None:
+            weights = 1.0
+        else:
+            # prioritized replay: scale each episode's squared errors by its importance sampling weight
+            weights = to_device(importance_weights, Q1_errors.device).view(1, -1, 1).repeat(1, num_update_agents, 1)
+        Q1_loss = (((Q1_errors ** 2) * weights).sum()) / (1 - curr_env_dones).sum()
+        Q2_loss = (((Q2_errors ** 2) * weights).sum()) / (1 - curr_env_dones).sum()
         critic_loss = Q1_loss + Q2_loss
 
         update_policy.critic_optimizer.zero_grad()
@@ -514,7 +529,7 @@ class R_MASAC:
             alpha_loss = torch.scalar_tensor(0.0)
             ent_diff = torch.scalar_tensor(0.0)
 
-        return critic_loss, actor_loss, alpha_loss, critic_update_grad_norm, actor_update_grad_norm, update_policy.alpha, ent_diff
+        return critic_loss, actor_loss, alpha_loss, critic_update_grad_norm, actor_update_grad_norm, update_policy.alpha, ent_diff, td_errors
 
     def prep_training(self):
         for policy in self.policies.values():
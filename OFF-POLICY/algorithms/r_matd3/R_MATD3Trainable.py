@@ -57,7 +57,7 @@ class RMATD3Trainable(object):
 
         self.logger = SummaryWriter(self.log_dir)
 
-        if config.__contains__("use_parallel_envs"):
+        if config.__contains__("use_parallel_envs") and config["use_parallel_envs"]:
             self.num_envs = self.env.num_envs
         else:
             self.num_envs = 1
@@ -77,6 +77,9 @@ class RMATD3Trainable(object):
         else:
             self.use_available_actions = False
 
+        # MPE rollouts over parallel envs do their own gradient updates, every train_interval env steps
+        self.train_during_rollout = self.num_envs > 1 and not self.use_available_actions and not self.use_cent_agent_obs
+
         if config.__contains__("buffer_length"):
             self.episode_length = config["buffer_length"]
             self.chunk_len = config["buffer_length"]
@@ -91,7 +94,10 @@ class RMATD3Trainable(object):
                                       self.policy_central_obs_dim,
                                       self.policy_act_dim,
                                       self.use_cent_agent_obs,
-                                      self.use_available_actions)
+                                      self.use_available_actions,
+                                      # turn based rollouts do not have nobs[t] == obs[t + 1]
+                                      compact=self.args.use_compact_buffer and not self.take_turn)
+        print("replay buffer uses %.2f GB" % (self.buffer.nbytes / 1024 ** 3))
 
         # initialize rmaddpg class for updating policies
         self.trainer = R_MATD3(self.args, self.env, self.policies, self.policy_mapping_fn, self.logger, self.episode_length)
@@ -132,31 +138,15 @@ class RMATD3Trainable(object):
                     avg_train_rew = self.collect_rollout(explore=True, training_episode=True, warmup=False)
                     train_episode_rewards.append(avg_train_rew)
             
-            # do a gradient update if the number of episodes collected since the last training update exceeds the specified amount
-            if self.num_envs > 1:
-                pass
-            else:
-                if ((self.num_episodes_collected - self.last_train_episode) / self.train_interval_episode) >= 1 or self.last_train_episode == 0:
-                    
-                    update_actor = ((self.total_train_steps % self.actor_train_interval_episode) == 0)
-                    # gradient updates
+            # one gradient update for every train_interval_episode episodes collected, whichever envs they came from
+            if not self.train_during_rollout:
+                num_updates = (self.num_episodes_collected - self.last_train_episode) // self.train_interval_episode
+                if self.last_train_episode == 0:
+                    num_updates = max(num_updates, 1)
+                if num_updates > 0:
                     self.trainer.prep_training()
-                    for p_id in self.policy_ids:
-                        sample = self.buffer.sample_chunks(self.batch_size)
-                        if self.use_cent_agent_obs:
-                            stats = self.trainer.cent_train_policy_on_batch(p_id, sample, update_actor)
-                        else:
-                            stats = self.trainer.train_policy_on_batch(p_id, sample, update_actor)
-                        if (self.total_env_steps - self.last_log_T) / self.log_interval >= 1:
-                            self.log_stats(p_id, stats, self.total_env_steps)
-                            self.last_log_T = self.total_env_steps
-
-                    if update_actor:
-                        # polyak update the targets
-                        for pid in self.policy_ids:
-                            self.policies[pid].soft_target_updates()
-
-                    self.total_train_steps += 1
+                    for _ in range(num_updates):
+                        self.train_step()
                     self.last_train_episode = self.num_episodes_collected
 
             if (self.total_env_steps - self.last_save_T) / self.save_interval >= 1:
@@ -188,6 +178,26 @@ class RMATD3Trainable(object):
                 self.last_test_T = self.total_env_steps
                 break
 
+    def train_step(self):
+        """ One gradient update of every policy, followed by logging and the target network updates. """
+        update_actor = ((self.total_train_steps % self.actor_train_interval_episode) == 0)
+        for p_id in self.policy_ids:
+            sample = self.buffer.sample_chunks(self.batch_size)
+            if self.use_cent_agent_obs:
+                stats = self.trainer.cent_train_policy_on_batch(p_id, sample, update_actor)
+            else:
+                stats = self.trainer.train_policy_on_batch(p_id, sample, update_actor)
+            if (self.total_env_steps - self.last_log_T) / self.log_interval >= 1:
+                self.log_stats(p_id, stats, self.total_env_steps)
+                self.last_log_T = self.total_env_steps
+
+        if update_actor:
+            # polyak update the targets
+            for pid in self.policy_ids:
+                self.policies[pid].soft_target_updates()
+
+        self.total_train_steps += 1
+
     def save(self):
         for pid in self.policy_ids:
             policy_critic = self.policies[pid].critic
@@ -226,7 +236,7 @@ class RMATD3Trainable(object):
             agent_prev_actions = {a_id: np.zeros((self.num_envs, self.policy_act_dim[self.policy_mapping_fn(a_id)])) for
                                   a_id in self.agent_ids}
 
-            ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones, ep_avail_acts, ep_navail_acts = [], [], [], [], [], [], [], [], []
+            rollout = self.buffer.rollout_arrays(self.num_envs)
 
             obs, cent_obs, available_actions = env.reset()
             terminate_episodes = False
@@ -379,15 +389,10 @@ class RMATD3Trainable(object):
                 if turn_count > 0:
                     if training_episode or warmup:
                         self.total_env_steps += env_t
-                    ep_obs.append(turn_obs_last)
-                    ep_nobs.append(turn_nobs_last)
-                    ep_cent_obs.append(turn_cent_obs_last)
-                    ep_cent_nobs.append(turn_cent_nobs_last)
-                    ep_acts.append(turn_acts_last)
-                    ep_rews.append(turn_rew_last)
-                    ep_dones.append(turn_dones_last)
-                    ep_avail_acts.append(turn_avail_acts_last)
-                    ep_navail_acts.append(turn_navail_acts_last)
+                    # the turns after the first are stored, one step each
+                    rollout.insert(turn_count - 1, turn_obs_last, turn_cent_obs_last, turn_acts_last, turn_rew_last,
+                                   turn_nobs_last, turn_cent_nobs_last, turn_dones_last, turn_avail_acts_last,
+                                   turn_navail_acts_last)
 
                 if terminate_episodes:
                     break
@@ -396,8 +401,7 @@ class RMATD3Trainable(object):
             if (training_episode or warmup) and turn_count > 0:
                 # push all episodes collected in this rollout step to the buffer
                 success_to_collect_one_episode = True
-                self.buffer.push(self.num_envs, ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones,
-                                 ep_avail_acts, ep_navail_acts)
+                rollout.push(turn_count)
 
             avg_reward = np.mean(np.array(ep_rewards))
 
@@ -409,23 +413,28 @@ class RMATD3Trainable(object):
     def collect_rollout_avail(self, explore=True, training_episode=True, warmup=False):
         battles_won = 0
         env = self.env if training_episode or warmup else self.test_env
+        # the test env may be a single, unvectorized env
+        num_envs = getattr(env, "num_envs", 1)
 
-        ep_rewards = [0 for _ in range(self.num_envs)]
+        ep_rewards = [0 for _ in range(num_envs)]
         # init RNN states
         rnn_states = {
-            p_id: self.policies[p_id].init_hidden(-1, self.num_envs * len(self.policy_agents[p_id]), use_numpy=True) for
+            p_id: self.policies[p_id].init_hidden(-1, num_envs * len(self.policy_agents[p_id]), use_numpy=True) for
             p_id in self.policy_ids}
-        pol_prev_acts = {p_id: np.zeros(((self.num_envs * len(self.policy_agents[p_id])), self.policy_act_dim[p_id]))
+        pol_prev_acts = {p_id: np.zeros(((num_envs * len(self.policy_agents[p_id])), self.policy_act_dim[p_id]))
                          for
                          p_id in self.policy_ids}
 
-        ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones, ep_avail_acts, ep_navail_acts = [], [], [], [], [], [], [], [], []
+        # the step data of the episode of each env
+        rollout = self.buffer.rollout_arrays(num_envs)
 
         obs, cent_obs, available_actions = env.reset()
+        # envs whose episode is still running, a finished env is not stepped again
+        running = list(range(num_envs))
         t = 0
         while t < self.episode_length:
             # get actions for all agents to step the env
-            env_actions = [dict() for _ in range(self.num_envs)]
+            env_actions = [dict() for _ in range(num_envs)]
 
             for p_id in self.policy_ids:
                 policy = self.policies[p_id]
@@ -464,55 +473,52 @@ class RMATD3Trainable(object):
                 # unpack actions to format needed to step env (list of dicts, dict mapping agent_id to action)
                 for i in range(len(self.policy_agents[p_id])):
                     agent_id = self.policy_agents[p_id][i]
-                    for j in range(self.num_envs):
+                    for j in range(num_envs):
                         env_actions[j][agent_id] = agent_acts[i][j]
 
-            # env step and store the relevant episode information
-            next_obs, cent_next_obs, rew, done, info, next_available_actions = env.step(env_actions)
+            # step the envs whose episode is still running and store the relevant episode information
+            if len(running) == num_envs:
+                next_obs, cent_next_obs, rew, done, info, next_available_actions = env.step(env_actions)
+            else:
+                next_obs, cent_next_obs, rew, done, info, next_available_actions = env.step_envs(
+                    [env_actions[i] for i in running], running)
 
             t += 1
 
-            ep_obs.append(obs)
-            ep_cent_obs.append(cent_obs)
-            ep_acts.append(env_actions)
-            ep_rews.append(rew)
-            ep_nobs.append(next_obs)
-            ep_cent_nobs.append(cent_next_obs)
-            ep_dones.append(done)
-            ep_avail_acts.append(available_actions)
-            ep_navail_acts.append(next_available_actions)
-
-            terminate_episodes = any(
-                [d["env"] for d in done]) or t == self.episode_length - 1  # TODO: change any to all?
-
             if training_episode or warmup:
-                self.total_env_steps += self.num_envs
+                self.total_env_steps += len(running)
 
-            for i in range(self.num_envs):
-                ep_rewards[i] += list(rew[i].values())[0]  # shared reward so take any reward
+            rollout.insert(t - 1, [obs[i] for i in running], [cent_obs[i] for i in running], [env_actions[i] for i in running],
+                           rew, next_obs, cent_next_obs, done, [available_actions[i] for i in running], next_available_actions,
+                           envs=running)
+
+            finished = []
+            for k, i in enumerate(running):
+                ep_rewards[i] += list(rew[k].values())[0]  # shared reward so take any reward
                 # TODO: change to allow for unshared reward
 
-            obs = next_obs
-            cent_obs = cent_next_obs
-            available_actions = next_available_actions
+                obs[i] = next_obs[k]
+                cent_obs[i] = cent_next_obs[k]
+                available_actions[i] = next_available_actions[k]
 
-            if terminate_episodes:
-                for i in range(self.num_envs):
-                    if 'won' in info[i][0].keys():
-                        if info[i][0]['won']:  # take one agent
+                if done[k]["env"] or t == self.episode_length - 1:
+                    finished.append(i)
+                    if 'won' in info[k][0].keys():
+                        if info[k][0]['won']:  # take one agent
                             battles_won += 1
-                break
 
-        if training_episode or warmup:
-            # push all episodes collected in this rollout step to the buffer
-            self.buffer.push(self.num_envs, ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones,
-                             ep_avail_acts, ep_navail_acts)
+            if len(finished) > 0:
+                if training_episode or warmup:
+                    # episodes that ended on the same step have the same length, push them to the buffer together
+                    rollout.push(t, finished)
+                if not warmup and training_episode:
+                    self.num_episodes_collected += len(finished)
+                running = [i for i in running if i not in finished]
+                if len(running) == 0:
+                    break
 
         avg_reward = np.mean(np.array(ep_rewards))
 
-        if not warmup and training_episode:
-            self.num_episodes_collected += self.num_envs
-
         return avg_reward, battles_won
     # for hide and seek
     def collect_rollout_cent(self, explore=True, training_episode=True, warmup=False):
@@ -536,7 +542,7 @@ class RMATD3Trainable(object):
                 self.sum_act_dim = temp_act_dim
             pol_prev_acts[p_id] = np.zeros(((self.num_envs * len(self.policy_agents[p_id])), self.sum_act_dim))
 
-        ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones = [], [], [], [], [], [], []
+        rollout = self.buffer.rollout_arrays(self.num_envs)
 
         obs, cent_obs = env.reset()
         t = 0
@@ -618,13 +624,7 @@ class RMATD3Trainable(object):
                         next_obs = obs
                         cent_next_obs = cent_obs
 
-            ep_obs.append(obs)
-            ep_cent_obs.append(cent_obs)
-            ep_acts.append(buffer_actions)
-            ep_rews.append(rew)
-            ep_nobs.append(next_obs)
-            ep_cent_nobs.append(cent_next_obs)
-            ep_dones.append(done)
+            rollout.insert(t - 1, obs, cent_obs, buffer_actions, rew, next_obs, cent_next_obs, done)
 
             terminate_episodes = any(
                 [d["env"] for d in done]) or t == self.episode_length - 1  # TODO: change any to all?
@@ -648,7 +648,7 @@ class RMATD3Trainable(object):
 
         if training_episode or warmup:
             # push all episodes collected in this rollout step to the buffer
-            self.buffer.push(self.num_envs, ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones)
+            rollout.push(t)
 
         avg_reward = np.mean(np.array(ep_rewards))
 
@@ -676,7 +676,7 @@ class RMATD3Trainable(object):
                 self.sum_act_dim = temp_act_dim
             pol_prev_acts[p_id] = np.zeros(((self.num_envs * len(self.policy_agents[p_id])), self.sum_act_dim))
 
-        ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones = [], [], [], [], [], [], []
+        rollout = self.buffer.rollout_arrays(self.num_envs)
 
         obs = env.reset()
 
@@ -742,13 +742,7 @@ class RMATD3Trainable(object):
                 cent_next_obs.append({'cent_obs':cat_next_agent_obs.reshape(-1)})
 
             t += 1
-            ep_obs.append(obs)
-            ep_cent_obs.append(cent_obs)
-            ep_acts.append(env_actions)
-            ep_rews.append(rew)
-            ep_nobs.append(next_obs)
-            ep_cent_nobs.append(cent_next_obs)
-            ep_dones.append(done)
+            rollout.insert(t - 1, obs, cent_obs, env_actions, rew, next_obs, cent_next_obs, done)
 
             terminate_episodes = any(
                 [d["env"] for d in done]) or t == self.episode_length - 1  # TODO: change any to all?
@@ -762,27 +756,11 @@ class RMATD3Trainable(object):
 
             obs = next_obs
 
-            if self.num_envs > 1 and not warmup and training_episode:
+            if self.train_during_rollout and not warmup and training_episode:
                 if ((self.total_env_steps - self.last_train_T) / self.train_interval) >= 1 or self.last_train_T == 0:
-                    update_actor = ((self.total_train_steps % self.actor_train_interval_episode) == 0)
-                    # gradient updates
                     self.trainer.prep_training()
-                    for p_id in self.policy_ids:
-                        sample = self.buffer.sample_chunks(self.batch_size)
-                        if self.use_cent_agent_obs:
-                            stats = self.trainer.cent_train_policy_on_batch(p_id, sample, update_actor)
-                        else:
-                            stats = self.trainer.train_policy_on_batch(p_id, sample, update_actor)
-                        if (self.total_env_steps - self.last_log_T) / self.log_interval >= 1:
-                            self.log_stats(p_id, stats, self.total_env_steps)
-                            self.last_log_T = self.total_env_steps
-
-                    if update_actor:
-                        # polyak update the targets
-                        for pid in self.policy_ids:
-                            self.policies[pid].soft_target_updates()
-
-                    self.total_train_steps += 1
+                    self.train_step()
+                    self.trainer.prep_rollout()
                     self.last_train_T = self.total_env_steps
             else:
                 pass 
@@ -792,7 +770,7 @@ class RMATD3Trainable(object):
 
         if training_episode or warmup:
             # push all episodes collected in this rollout step to the buffer
-            self.buffer.push(self.num_envs, ep_obs, ep_cent_obs, ep_acts, ep_rews, ep_nobs, ep_cent_nobs, ep_dones)
+            rollout.push(t)
 
         avg_reward = np.mean(np.array(ep_rewards))
 
@@ -158,6 +158,16 @@ class ShareDummyVecEnv(ShareVecEnv):
         self.actions = None
         return np.array(obs), np.array(cent_obs), np.array(rews), np.array(dones), infos, np.array(available_actions)
 
+    def step_envs(self, actions, env_inds):
+        """
+        Step only the envs in env_inds, e.g. those whose episode is still running, the others are left as they are.
+        Returns the step results of these envs, in the order of env_inds.
+        """
+        results = [self.envs[i].step(a) for (a, i) in zip(actions, env_inds)]
+        obs, cent_obs, rews, dones, infos, available_actions = map(np.array, zip(*results))
+        self.ts[env_inds] += 1
+        return np.array(obs), np.array(cent_obs), np.array(rews), np.array(dones), infos, np.array(available_actions)
+
     def reset(self):        
         results = [env.reset() for env in self.envs]
         obs, cent_obs, available_actions = map(np.array, zip(*results))
@@ -230,6 +240,17 @@ class ShareSubprocVecEnv(ShareVecEnv):
         obs, cent_obs, rews, dones, infos, available_actions = zip(*results)
         return np.stack(obs), np.stack(cent_obs), np.stack(rews), np.stack(dones), infos, np.stack(available_actions)
 
+    def step_envs(self, actions, env_inds):
+        """
+        Step only the envs in env_inds, e.g. those whose episode is still running, the others are left as they are.
+        Returns the step results of these envs, in the order of env_inds.
+        """
+        for i, action in zip(env_inds, actions):
+            self.remotes[i].send(('step', action))
+        results = [self.remotes[i].recv() for i in env_inds]
+        obs, cent_obs, rews, dones, infos, available_actions = zip(*results)
+        return np.stack(obs), np.stack(cent_obs), np.stack(rews), np.stack(dones), infos, np.stack(available_actions)
+
     def reset(self):
         for remote in self.remotes:
             remote.send(('reset', None))
@@ -3,6 +3,7 @@ import sys
 import os
 from algorithms.common.common_utils import get_state_dim, get_dim_from_space
 from envs.starcraft2.StarCraft2 import StarCraft2Env
+from envs.starcraft2.starcraft2_multienv import make_parallel_env
 from envs.starcraft2.smac_maps import get_map_params
 from algorithms.r_matd3.R_MATD3Trainable import RMATD3Trainable
 import json
@@ -19,6 +20,7 @@ def main(args):
     )
     env_parser.add_argument('--map_name', type=str, default='3m', help="Which sc env to run on")
     env_parser.add_argument('--use_available_actions', action='store_false', default=True, help="take turn to take action")
+    env_parser.add_argument('--use_parallel_envs', action='store_true', default=False, help="collect training episodes on n_rollout_threads envs")
     
     env_args = env_parser.parse_known_args(args)[0]
 
@@ -41,11 +43,14 @@ def main(args):
         device = torch.device("cpu")
         #torch.set_num_threads(alg_flags.n_training_threads)
 
-    # env for testing and warmup (contains parallel envs)
-    env = StarCraft2Env(map_name=env_args.map_name, seed=alg_flags.seed)
+    # with use_parallel_envs training episodes are collected on n_rollout_threads envs, tests always use one
+    if env_args.use_parallel_envs:
+        env = make_parallel_env(map_name=env_args.map_name, n_rollout_threads=alg_flags.n_rollout_threads, seed=alg_flags.seed)
+    else:
+        env = StarCraft2Env(map_name=env_args.map_name, seed=alg_flags.seed)
     test_env = StarCraft2Env(map_name=env_args.map_name, seed=alg_flags.seed)
     buffer_length = get_map_params(env_args.map_name)["limit"]
-    alg_arg_dict["n_agents"] = env.n_agents
+    alg_arg_dict["n_agents"] = test_env.n_agents
 
     # setup file to output tensorboard, hyperparameters, and saved models
     model_dir = Path('../results') / alg_flags.env_name / env_args.map_name / alg_flags.algorithm_name
@@ -94,7 +99,8 @@ def main(args):
               "agent_ids": env.agent_ids,
               "device": device, 
               "buffer_length": buffer_length,
-              "use_available_actions":env_args.use_available_actions}
+              "use_available_actions":env_args.use_available_actions,
+              "use_parallel_envs":env_args.use_parallel_envs}
 
     trainable = RMATD3Trainable(config=config)
     test_times = (alg_flags.num_env_steps // alg_flags.test_interval) + 1
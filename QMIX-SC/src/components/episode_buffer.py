@@ -1,3 +1,4 @@
+import threading
 import torch as th
 import numpy as np
 from types import SimpleNamespace as SN
@@ -54,21 +55,10 @@ class EpisodeBatch:
         })
 
         for field_key, field_info in scheme.items():
-            assert "vshape" in field_info, "Scheme must define vshape for {}".format(field_key)
-            vshape = field_info["vshape"]
+            shape = field_shape(field_key, field_info, groups)
             episode_const = field_info.get("episode_const", False)
-            group = field_info.get("group", None)
             dtype = field_info.get("dtype", th.float32)
 
-            if isinstance(vshape, int):
-                vshape = (vshape,)
-
-            if group:
-                assert group in groups, "Group {} must have its number of members defined in _groups_".format(group)
-                shape = (groups[group], *vshape)
-            else:
-                shape = vshape
-
             if episode_const:
                 self.data.episode_data[field_key] = th.zeros((batch_size, *shape), dtype=dtype, device=self.device)
             else:
@@ -100,11 +90,18 @@ class EpisodeBatch:
                 raise KeyError("{} not found in transition or episode data".format(k))
 
             dtype = self.scheme[k].get("dtype", th.float32)
-            v = th.tensor(v, dtype=dtype, device=self.device)
+            if isinstance(v, th.Tensor):
+                # no copy when it is already on our device, e.g. StagingBuffer rows or another batch
+                v = v.to(device=self.device, dtype=dtype)
+            elif isinstance(v, np.ndarray):
+                v = th.as_tensor(v, dtype=dtype, device=self.device)
+            else:
+                v = th.tensor(v, dtype=dtype, device=self.device)
             self._check_safe_view(v, target[k][_slices])
             target[k][_slices] = v.view_as(target[k][_slices])
 
-            if k in self.preprocess:
+            # Skip transforms whose output is given too, as when inserting another batch
+            if k in self.preprocess and self.preprocess[k][0] not in data:
                 new_k = self.preprocess[k][0]
                 v = target[k][_slices]
                 for transform in self.preprocess[k][1]:
@@ -204,6 +201,44 @@ class EpisodeBatch:
                                                                                      self.groups.keys())
 
 
+def field_shape(field_key, field_info, groups):
+    # Shape of one entry of a scheme field, with the group dimension first
+    assert "vshape" in field_info, "Scheme must define vshape for {}".format(field_key)
+    vshape = field_info["vshape"]
+    group = field_info.get("group", None)
+
+    if isinstance(vshape, int):
+        vshape = (vshape,)
+
+    if group:
+        assert group in groups, "Group {} must have its number of members defined in _groups_".format(group)
+        return (groups[group], *vshape)
+    return tuple(vshape)
+
+
+class StagingBuffer:
+    """
+    Host arrays for one timestep of some scheme keys across a runner's envs. Runners write env results
+    straight into the rows of arrays, then update_batch copies the first rows into an EpisodeBatch with one
+    copy per key, from pinned memory when the batch lives on a gpu, instead of building tensors from lists.
+    """
+    def __init__(self, scheme, groups, keys, batch_size, device="cpu"):
+        pin_memory = th.device(device).type == "cuda"
+        self.tensors = {}
+        self.arrays = {}
+        for k in keys:
+            t = th.zeros((batch_size, *field_shape(k, scheme[k], groups)), dtype=scheme[k].get("dtype", th.float32))
+            # torch 0.4.1 factories take no pin_memory keyword
+            if pin_memory:
+                t = t.pin_memory()
+            self.tensors[k] = t
+            # numpy views of the same memory, for filling rows from env results
+            self.arrays[k] = self.tensors[k].numpy()
+
+    def update_batch(self, batch, n_rows, bs=slice(None), ts=slice(None), mark_filled=True):
+        batch.update({k: v[:n_rows] for k, v in self.tensors.items()}, bs=bs, ts=ts, mark_filled=mark_filled)
+
+
 class ReplayBuffer(EpisodeBatch):
     def __init__(self, scheme, groups, buffer_size, max_seq_length, preprocess=None, device="cpu"):
         super(ReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length, preprocess=preprocess, device=device)
@@ -246,3 +281,33 @@ class ReplayBuffer(EpisodeBatch):
                                                                         self.scheme.keys(),
                                                                         self.groups.keys())
 
+
+class ThreadSafeReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer that a collector thread inserts episodes into while the learner samples from it. Samples are
+    always copies, so later inserts can't change them, and are drawn with the buffer's own random state, seeded
+    for reproducible runs.
+    """
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, preprocess=None, device="cpu", seed=None):
+        super(ThreadSafeReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length,
+                                                     preprocess=preprocess, device=device)
+        self.lock = threading.RLock()
+        self.random_state = np.random.RandomState(seed)
+
+    def insert_episode_batch(self, ep_batch):
+        with self.lock:
+            super(ThreadSafeReplayBuffer, self).insert_episode_batch(ep_batch)
+
+    def can_sample(self, batch_size):
+        with self.lock:
+            return self.episodes_in_buffer >= batch_size
+
+    def sample(self, batch_size):
+        with self.lock:
+            assert self.can_sample(batch_size)
+            if self.episodes_in_buffer == batch_size:
+                ep_ids = np.arange(batch_size)
+            else:
+                # Uniform sampling only atm
+                ep_ids = self.random_state.choice(self.episodes_in_buffer, batch_size, replace=False)
+            return self[ep_ids]
@@ -27,13 +27,32 @@ class BasicMAC:
         agent_inputs = self._build_inputs(ep_batch, t)
         avail_actions = ep_batch["avail_actions"][:, t]
         agent_outs, self.hidden_states = self.agent(agent_inputs, self.hidden_states)
+        agent_outs = self._process_outputs(agent_outs, avail_actions, test_mode)
+        return agent_outs.view(ep_batch.batch_size, self.n_agents, -1)
 
+    def forward_seq(self, ep_batch, t_end=None, test_mode=False, return_hidden=False):
+        # The outputs of forward for t in range(t_end) (default all timesteps) as [b, t, a, -1],
+        # from one agent call over the whole sequence. Learners use it, acting uses forward.
+        t_end = ep_batch.max_seq_length if t_end is None else t_end
+        agent_inputs = self._build_seq_inputs(ep_batch, t_end)
+        avail_actions = ep_batch["avail_actions"][:, :t_end].transpose(0, 1)
+        agent_outs, hidden_states = self.agent.forward_seq(agent_inputs, self.hidden_states)
+        self.hidden_states = hidden_states[-1]
+        agent_outs = self._process_outputs(agent_outs.reshape(-1, agent_outs.size(-1)), avail_actions, test_mode)
+        agent_outs = agent_outs.view(t_end, ep_batch.batch_size, self.n_agents, -1).transpose(0, 1)
+        if return_hidden:
+            hidden_states = hidden_states.view(t_end, ep_batch.batch_size, self.n_agents, -1).transpose(0, 1)
+            return agent_outs, hidden_states
+        return agent_outs
+
+    def _process_outputs(self, agent_outs, avail_actions, test_mode):
+        # agent_outs has one row per agent (and timestep), in the order of avail_actions
         # Softmax the agent outputs if they're policy logits
         if self.agent_output_type == "pi_logits":
 
             if getattr(self.args, "mask_before_softmax", True):
                 # Make the logits for unavailable actions very negative to minimise their affect on the softmax
-                reshaped_avail_actions = avail_actions.reshape(ep_batch.batch_size * self.n_agents, -1)
+                reshaped_avail_actions = avail_actions.reshape(agent_outs.size(0), -1)
                 agent_outs[reshaped_avail_actions == 0] = -1e10
 
             agent_outs = th.nn.functional.softmax(agent_outs, dim=-1)
@@ -51,7 +70,7 @@ class BasicMAC:
                     # Zero out the unavailable actions
                     agent_outs[reshaped_avail_actions == 0] = 0.0
 
-        return agent_outs.view(ep_batch.batch_size, self.n_agents, -1)
+        return agent_outs
 
     def init_hidden(self, batch_size):
         self.hidden_states = self.agent.init_hidden().unsqueeze(0).expand(batch_size, self.n_agents, -1)  # bav
@@ -91,6 +110,21 @@ class BasicMAC:
         inputs = th.cat([x.reshape(bs*self.n_agents, -1) for x in inputs], dim=1)
         return inputs
 
+    def _build_seq_inputs(self, batch, t_end):
+        # The inputs of _build_inputs for t in range(t_end), as [t, b*a, -1]
+        bs = batch.batch_size
+        inputs = []
+        inputs.append(batch["obs"][:, :t_end])  # btav
+        if self.args.obs_last_action:
+            last_actions = th.zeros_like(batch["actions_onehot"][:, :t_end])
+            last_actions[:, 1:] = batch["actions_onehot"][:, :t_end - 1]
+            inputs.append(last_actions)
+        if self.args.obs_agent_id:
+            inputs.append(th.eye(self.n_agents, device=batch.device).expand(bs, t_end, -1, -1))
+
+        inputs = th.cat([x.transpose(0, 1).reshape(t_end, bs*self.n_agents, -1) for x in inputs], dim=2)
+        return inputs
+
     def _get_input_shape(self, scheme):
         input_shape = scheme["obs"]["vshape"]
         if self.args.obs_last_action:
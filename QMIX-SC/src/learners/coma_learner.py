@@ -49,12 +49,8 @@ class COMALearner:
 
         actions = actions[:,:-1]
 
-        mac_out = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length - 1):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
+        mac_out = self.mac.forward_seq(batch, t_end=batch.max_seq_length - 1)  # All timesteps in one sequence pass
 
         # Mask out unavailable actions, renormalise (as in action selection)
         mac_out[avail_actions == 0] = 0
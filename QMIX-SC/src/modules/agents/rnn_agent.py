@@ -71,6 +71,14 @@ class RNNAgent(nn.Module):
        
         self.fc2 = nn.Linear(args.rnn_hidden_dim, args.n_actions)
 
+        # forward_seq runs an nn.GRU on the GRUCell's own Parameter objects. It is kept in a list, not as a
+        # submodule, so state_dict() and parameters() are unchanged; .to()/.cuda() of the agent move the shared
+        # Parameters in place
+        seq_rnn = nn.GRU(args.rnn_hidden_dim, args.rnn_hidden_dim)
+        for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+            setattr(seq_rnn, name + '_l0', getattr(self.rnn, name))
+        self._seq_rnn = [seq_rnn]
+
     def init_hidden(self):
         # make hidden states on same device as model
         return self.mlp.fc1[0].weight.new(1, self.args.rnn_hidden_dim).zero_()
@@ -83,3 +91,13 @@ class RNNAgent(nn.Module):
         h1 = self.norm(h)
         q = self.fc2(h1)
         return q, h
+
+    def forward_seq(self, inputs, hidden_state):
+        # inputs [T, N, input_shape]: the whole sequence in one nn.GRU call (cuDNN on gpu)
+        # with the GRUCell's own weights, the same outputs as T calls of forward
+        x = self.mlp(inputs)
+        h_in = hidden_state.reshape(1, -1, self.args.rnn_hidden_dim).contiguous()
+        h, _ = self._seq_rnn[0](x, h_in)
+        h1 = self.norm(h)
+        q = self.fc2(h1)
+        return q, h
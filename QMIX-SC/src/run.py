@@ -1,4 +1,6 @@
+import copy
 import datetime
+import numpy as np
 import os
 import pprint
 import time
@@ -12,7 +14,7 @@ from os.path import dirname, abspath
 from learners import REGISTRY as le_REGISTRY
 from runners import REGISTRY as r_REGISTRY
 from controllers import REGISTRY as mac_REGISTRY
-from components.episode_buffer import ReplayBuffer
+from components.episode_buffer import ReplayBuffer, ThreadSafeReplayBuffer
 from components.transforms import OneHot
 
 
@@ -100,9 +102,16 @@ def run_sequential(args, logger):
         "actions": ("actions_onehot", [OneHot(out_dim=args.n_actions)])
     }
 
-    buffer = ReplayBuffer(scheme, groups, args.buffer_size, env_info["episode_limit"] + 1,
-                          preprocess=preprocess,
-                          device="cpu" if args.buffer_cpu_only else args.device)
+    if args.async_training:
+        # The runner inserts from a collector thread while the learner samples
+        buffer = ThreadSafeReplayBuffer(scheme, groups, args.buffer_size, env_info["episode_limit"] + 1,
+                                        preprocess=preprocess,
+                                        device="cpu" if args.buffer_cpu_only else args.device,
+                                        seed=args.seed)
+    else:
+        buffer = ReplayBuffer(scheme, groups, args.buffer_size, env_info["episode_limit"] + 1,
+                              preprocess=preprocess,
+                              device="cpu" if args.buffer_cpu_only else args.device)
 
     # Setup multiagent controller here
     mac = mac_REGISTRY[args.mac](buffer.scheme, groups, args)
@@ -149,6 +158,10 @@ def run_sequential(args, logger):
             evaluate_sequential(args, runner)
             return
 
+    if args.async_training:
+        run_async(args, logger, runner, buffer, mac, learner)
+        return
+
     # start training
     episode = 0
     last_test_T = -args.test_interval - 1
@@ -213,6 +226,144 @@ def run_sequential(args, logger):
     logger.console_logger.info("Finished Training")
 
 
+def run_async(args, logger, runner, buffer, mac, learner):
+    # A collector thread runs episodes (and the test runs) with a snapshot of the mac's weights, refreshed
+    # every async_weight_sync_interval learner updates, while this thread trains on the replay buffer at
+    # async_train_ratio updates per collected run. With async_deterministic, episode inserts, weight
+    # refreshes and buffer samples happen in the same order as updates on every run.
+    if args.async_deterministic:
+        th.backends.cudnn.deterministic = True
+        th.backends.cudnn.benchmark = False
+
+    acting_mac = copy.deepcopy(mac)
+    runner.mac = acting_mac
+    schedule = threading.Condition()
+    # Held while the learner changes the mac's weights and while they are copied to acting_mac
+    weights_lock = threading.Lock()
+    # runs: inserted runs, trainable_runs: the runs inserted once the buffer could sample a batch,
+    # updates: learner updates, t_env and episode: as of the last insert,
+    # staleness: learner updates between the weights a run was collected with and its insert
+    state = SN(runs=0, trainable_runs=0, updates=0, t_env=runner.t_env, episode=0, staleness=[],
+               done=False, error=None)
+
+    def updates_due():
+        return int(state.trainable_runs * args.async_train_ratio)
+
+    start_time = time.time()
+
+    def collect():
+        last_test_T = -args.test_interval - 1
+        last_time = start_time
+        synced_update = 0
+        try:
+            while runner.t_env <= args.t_max and not state.done:
+                episode_batch = runner.run(test_mode=False)
+
+                with schedule:
+                    if args.async_deterministic:
+                        # Wait for the updates due before this run, so that every update samples the same buffer
+                        schedule.wait_for(lambda: state.updates >= updates_due() or state.done)
+                    buffer.insert_episode_batch(episode_batch)
+                    state.staleness.append(state.updates - synced_update)
+                    state.runs += 1
+                    if buffer.can_sample(args.batch_size):
+                        state.trainable_runs += 1
+                    state.t_env = runner.t_env
+                    state.episode += args.batch_size_run
+                    if state.updates - synced_update >= args.async_weight_sync_interval:
+                        with weights_lock:
+                            acting_mac.load_state(mac)
+                        synced_update = state.updates
+                    schedule.notify_all()
+
+                # Execute test runs once in a while, here so they don't hold up training
+                n_test_runs = max(1, args.test_nepisode // runner.batch_size)
+                if (runner.t_env - last_test_T) / args.test_interval >= 1.0:
+
+                    logger.console_logger.info("t_env: {} / {}".format(runner.t_env, args.t_max))
+                    logger.console_logger.info("Estimated time left: {}. Time passed: {}".format(
+                        time_left(last_time, last_test_T, runner.t_env, args.t_max), time_str(time.time() - start_time)))
+                    last_time = time.time()
+
+                    last_test_T = runner.t_env
+                    for _ in range(n_test_runs):
+                        runner.run(test_mode=True)
+        except Exception as e:
+            state.error = e
+        finally:
+            with schedule:
+                state.done = True
+                schedule.notify_all()
+
+    last_log_T = 0
+    model_save_time = 0
+    last_log = SN(time=start_time, episode=0, updates=0, staleness=0)
+
+    logger.console_logger.info("Beginning asynchronous training for {} timesteps".format(args.t_max))
+
+    collector = threading.Thread(target=collect, name="episode_collector", daemon=True)
+    collector.start()
+    try:
+        while True:
+            with schedule:
+                # Wake up once in a while to log and save models even when no update is due
+                schedule.wait_for(lambda: state.updates < updates_due() or state.done, timeout=1.0)
+                train = state.updates < updates_due() and state.error is None
+                if state.done and not train:
+                    break
+                if train:
+                    episode_sample = buffer.sample(args.batch_size)
+                t_env, episode = state.t_env, state.episode
+
+            if train:
+                # Truncate batch to only filled timesteps
+                max_ep_t = episode_sample.max_t_filled()
+                episode_sample = episode_sample[:, :max_ep_t]
+
+                if episode_sample.device != args.device:
+                    episode_sample.to(args.device)
+
+                with weights_lock:
+                    learner.train(episode_sample, t_env, episode)
+                with schedule:
+                    state.updates += 1
+                    schedule.notify_all()
+
+            if args.save_model and (t_env - model_save_time >= args.save_model_interval or model_save_time == 0):
+                model_save_time = t_env
+                save_path = os.path.join(args.local_results_path, "models", args.env_args['map_name'], args.unique_token, str(t_env))
+                os.makedirs(save_path, exist_ok=True)
+                logger.console_logger.info("Saving models to {}".format(save_path))
+                learner.save_models(save_path)
+
+            if (t_env - last_log_T) >= args.log_interval:
+                now = time.time()
+                with schedule:
+                    updates = state.updates
+                    staleness = state.staleness[last_log.staleness:]
+                    last_log.staleness = len(state.staleness)
+                logger.log_stat("episode", episode, t_env)
+                logger.log_stat("async_episodes_per_sec", (episode - last_log.episode) / (now - last_log.time), t_env)
+                logger.log_stat("async_updates_per_sec", (updates - last_log.updates) / (now - last_log.time), t_env)
+                if staleness:
+                    logger.log_stat("async_staleness_mean", np.mean(staleness), t_env)
+                    logger.log_stat("async_staleness_max", max(staleness), t_env)
+                logger.print_recent_stats()
+                last_log_T = t_env
+                last_log.time, last_log.episode, last_log.updates = now, episode, updates
+    finally:
+        with schedule:
+            state.done = True
+            schedule.notify_all()
+        collector.join()
+
+    if state.error is not None:
+        raise state.error
+
+    runner.close_env()
+    logger.console_logger.info("Finished Training")
+
+
 def args_sanity_check(config, _log):
 
     # set CUDA flags
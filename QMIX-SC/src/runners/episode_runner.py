@@ -1,6 +1,6 @@
 from envs import REGISTRY as env_REGISTRY
 from functools import partial
-from components.episode_buffer import EpisodeBatch
+from components.episode_buffer import EpisodeBatch, StagingBuffer
 import numpy as np
 import time
 
@@ -30,6 +30,11 @@ class EpisodeRunner:
         self.new_batch = partial(EpisodeBatch, scheme, groups, self.batch_size, self.episode_limit + 1,
                                  preprocess=preprocess, device=self.args.device)
         self.mac = mac
+        # Env results are written into these and copied into the batch once per key and step
+        self.pre_transition_staging = StagingBuffer(scheme, groups, ["state", "avail_actions", "obs"],
+                                                    self.batch_size, device=self.args.device)
+        self.post_transition_staging = StagingBuffer(scheme, groups, ["reward", "terminated"],
+                                                     self.batch_size, device=self.args.device)
 
     def get_env_info(self):
         return self.env.get_env_info()
@@ -55,13 +60,8 @@ class EpisodeRunner:
 
         while not terminated:
 
-            pre_transition_data = {
-                "state": [self.env.get_state()],
-                "avail_actions": [self.env.get_avail_actions()],
-                "obs": [self.env.get_obs()]
-            }
-
-            self.batch.update(pre_transition_data, ts=self.t)
+            self._stage_pre_transition_data()
+            self.pre_transition_staging.update_batch(self.batch, 1, ts=self.t)
 
             # Pass the entire batch of experiences up till now to the agents
             # Receive the actions for each agent at this timestep in a batch of size 1
@@ -70,22 +70,17 @@ class EpisodeRunner:
             
             episode_return += reward
 
-            post_transition_data = {
-                "actions": actions,
-                "reward": [(reward,)],
-                "terminated": [(terminated != env_info.get("episode_limit", False),)],
-            }
+            post_transition_data = self.post_transition_staging.arrays
+            post_transition_data["reward"][0] = reward
+            post_transition_data["terminated"][0] = terminated != env_info.get("episode_limit", False)
 
-            self.batch.update(post_transition_data, ts=self.t)
+            self.batch.update({"actions": actions}, ts=self.t)
+            self.post_transition_staging.update_batch(self.batch, 1, ts=self.t)
 
             self.t += 1
 
-        last_data = {
-            "state": [self.env.get_state()],
-            "avail_actions": [self.env.get_avail_actions()],
-            "obs": [self.env.get_obs()]
-        }
-        self.batch.update(last_data, ts=self.t)
+        self._stage_pre_transition_data()
+        self.pre_transition_staging.update_batch(self.batch, 1, ts=self.t)
 
         # Select actions in the last stored state
         actions = self.mac.select_actions(self.batch, t_ep=self.t, t_env=self.t_env, test_mode=test_mode)
@@ -113,6 +108,12 @@ class EpisodeRunner:
 
         return self.batch
 
+    def _stage_pre_transition_data(self):
+        pre_transition_data = self.pre_transition_staging.arrays
+        pre_transition_data["state"][0] = self.env.get_state()
+        pre_transition_data["avail_actions"][0] = self.env.get_avail_actions()
+        pre_transition_data["obs"][0] = self.env.get_obs()
+
     def _log(self, returns, stats, prefix):
         self.logger.log_stat(prefix + "return_mean", np.mean(returns), self.t_env)
         self.logger.log_stat(prefix + "return_std", np.std(returns), self.t_env)
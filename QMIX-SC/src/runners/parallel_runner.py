@@ -1,6 +1,6 @@
 from envs import REGISTRY as env_REGISTRY
 from functools import partial
-from components.episode_buffer import EpisodeBatch
+from components.episode_buffer import EpisodeBatch, StagingBuffer
 from multiprocessing import Pipe, Process
 import numpy as np
 import torch as th
@@ -47,6 +47,11 @@ class ParallelRunner:
         self.scheme = scheme
         self.groups = groups
         self.preprocess = preprocess
+        # Worker results are written into these and copied into the batch once per key and step
+        self.pre_transition_staging = StagingBuffer(scheme, groups, ["state", "avail_actions", "obs"],
+                                                    self.batch_size, device=self.args.device)
+        self.post_transition_staging = StagingBuffer(scheme, groups, ["reward", "terminated"],
+                                                     self.batch_size, device=self.args.device)
 
     def get_env_info(self):
         return self.env_info
@@ -65,19 +70,15 @@ class ParallelRunner:
         for parent_conn in self.parent_conns:
             parent_conn.send(("reset", None))
 
-        pre_transition_data = {
-            "state": [],
-            "avail_actions": [],
-            "obs": []
-        }
+        pre_transition_data = self.pre_transition_staging.arrays
         # Get the obs, state and avail_actions back
-        for parent_conn in self.parent_conns:
+        for idx, parent_conn in enumerate(self.parent_conns):
             data = parent_conn.recv()
-            pre_transition_data["state"].append(data["state"])
-            pre_transition_data["avail_actions"].append(data["avail_actions"])
-            pre_transition_data["obs"].append(data["obs"])
+            pre_transition_data["state"][idx] = data["state"]
+            pre_transition_data["avail_actions"][idx] = data["avail_actions"]
+            pre_transition_data["obs"][idx] = data["obs"]
 
-        self.batch.update(pre_transition_data, ts=0)
+        self.pre_transition_staging.update_batch(self.batch, self.batch_size, ts=0)
 
         self.t = 0
         self.env_steps_this_run = 0
@@ -120,24 +121,18 @@ class ParallelRunner:
             if all_terminated:
                 break
 
-            # Post step data we will insert for the current timestep
-            post_transition_data = {
-                "reward": [],
-                "terminated": []
-            }
+            # Post step data we will insert for the current timestep, one row per unterminated env
+            post_transition_data = self.post_transition_staging.arrays
             # Data for the next step we will insert in order to select an action
-            pre_transition_data = {
-                "state": [],
-                "avail_actions": [],
-                "obs": []
-            }
+            pre_transition_data = self.pre_transition_staging.arrays
 
             # Receive data back for each unterminated env
+            row = 0
             for idx, parent_conn in enumerate(self.parent_conns):
                 if not terminated[idx]:
                     data = parent_conn.recv()
                     # Remaining data for this current timestep
-                    post_transition_data["reward"].append((data["reward"],))
+                    post_transition_data["reward"][row] = data["reward"]
 
                     episode_returns[idx] += data["reward"]
                     episode_lengths[idx] += 1
@@ -150,21 +145,24 @@ class ParallelRunner:
                     if data["terminated"] and not data["info"].get("episode_limit", False):
                         env_terminated = True
                     terminated[idx] = data["terminated"]
-                    post_transition_data["terminated"].append((env_terminated,))
+                    post_transition_data["terminated"][row] = env_terminated
 
                     # Data for the next timestep needed to select an action
-                    pre_transition_data["state"].append(data["state"])
-                    pre_transition_data["avail_actions"].append(data["avail_actions"])
-                    pre_transition_data["obs"].append(data["obs"])
+                    pre_transition_data["state"][row] = data["state"]
+                    pre_transition_data["avail_actions"][row] = data["avail_actions"]
+                    pre_transition_data["obs"][row] = data["obs"]
+                    row += 1
 
             # Add post_transiton data into the batch
-            self.batch.update(post_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=False)
+            self.post_transition_staging.update_batch(self.batch, row, bs=envs_not_terminated, ts=self.t,
+                                                      mark_filled=False)
 
             # Move onto the next timestep
             self.t += 1
 
             # Add the pre-transition data
-            self.batch.update(pre_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=True)
+            self.pre_transition_staging.update_batch(self.batch, row, bs=envs_not_terminated, ts=self.t,
+                                                     mark_filled=True)
 
         if not test_mode:
             self.t_env += self.env_steps_this_run
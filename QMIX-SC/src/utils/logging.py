@@ -1,5 +1,6 @@
 from collections import defaultdict
 import logging
+import threading
 import numpy as np
 
 class Logger:
@@ -11,6 +12,8 @@ class Logger:
         self.use_hdf = False
 
         self.stats = defaultdict(lambda: [])
+        # Runners and learners may log from different threads (async_training)
+        self.lock = threading.RLock()
 
     def setup_tb(self, directory_name):
         # Import here so it doesn't have to be installed if you don't use it
@@ -24,6 +27,10 @@ class Logger:
         self.use_sacred = True
 
     def log_stat(self, key, value, t, to_sacred=True):
+        with self.lock:
+            self._log_stat(key, value, t, to_sacred)
+
+    def _log_stat(self, key, value, t, to_sacred):
         self.stats[key].append((t, value))
 
         if self.use_tb:
@@ -38,6 +45,10 @@ class Logger:
                 self.sacred_info[key] = [value]
 
     def print_recent_stats(self):
+        with self.lock:
+            self._print_recent_stats()
+
+    def _print_recent_stats(self):
         log_str = "Recent Stats | t_env: {:>10} | Episode: {:>8}\n".format(*self.stats["episode"][-1])
         i = 0
         for (k, v) in sorted(self.stats.items()):